@@ -0,0 +1,199 @@
+"""
+Compression of the HTTP bodies of the API.
+
+Responses are compressed with zstd or gzip, as preferred by the `Accept-Encoding`
+header of the request. Requests with a body compressed with one of them, as told
+by their `Content-Encoding` header, are decompressed before reaching the routes.
+"""
+
+import gzip
+import io
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import zstandard
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Responses smaller than this are sent as they are
+MINIMUM_SIZE = 500
+# Maximum size of a decompressed request body
+MAX_BODY_SIZE = 64 * 1024 * 1024
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+ENCODINGS = ["zstd", "gzip"]  # by order of preference, on equal quality
+UNCOMPRESSED_MEDIA_TYPES = ["text/event-stream"]
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def decompress(body: bytes, encoding: str, max_size: int = MAX_BODY_SIZE) -> bytes:
+    if encoding == "zstd":
+        reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body))
+        data = reader.read(max_size + 1)
+    else:
+        decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        data = decompressor.decompress(body, max_size + 1)
+    if len(data) > max_size:
+        raise BodyTooLarge()
+    return data
+
+
+def parse_qualities(header: str) -> Dict[str, float]:
+    """Returns the quality of each item of an `Accept` or `Accept-Encoding` header."""
+    qualities = {}
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            qualities[name.strip().lower()] = quality
+    return qualities
+
+
+def choose_encoding(header: Optional[str]) -> Optional[str]:
+    """The supported encoding of the highest quality in an `Accept-Encoding` header."""
+    if not header:
+        return None
+    qualities = parse_qualities(header)
+    candidates = [
+        (qualities.get(encoding, qualities.get("*", 0.0)), -position, encoding)
+        for position, encoding in enumerate(ENCODINGS)
+    ]
+    quality, _, encoding = max(candidates)
+    return encoding if quality > 0 else None
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, minimum_size: int = MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        content_encoding = headers.get("content-encoding", "").strip().lower()
+        if content_encoding in ENCODINGS:
+            try:
+                scope, receive = await self.decompress_request(
+                    scope, receive, content_encoding
+                )
+            except BodyTooLarge:
+                await self.send_error(send, 413, b"Request body too large")
+                return
+            except (OSError, EOFError, zlib.error, zstandard.ZstdError):
+                await self.send_error(send, 400, b"Invalid compressed request body")
+                return
+        elif content_encoding not in ("", "identity"):
+            await self.send_error(send, 415, b"Unsupported request content encoding")
+            return
+
+        encoding = choose_encoding(headers.get("accept-encoding"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, CompressedSender(send, encoding, self))
+
+    @staticmethod
+    async def decompress_request(
+        scope: Scope, receive: Receive, encoding: str
+    ) -> Tuple[Scope, Receive]:
+        chunks: List[bytes] = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        body = decompress(b"".join(chunks), encoding)
+
+        scope = dict(scope)
+        scope["headers"] = [
+            (key, value)
+            for key, value in scope["headers"]
+            if key not in (b"content-encoding", b"content-length")
+        ] + [(b"content-length", str(len(body)).encode())]
+        sent = False
+
+        async def receive_body() -> Message:
+            nonlocal sent
+            if sent:
+                return await receive()
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        return scope, receive_body
+
+    @staticmethod
+    async def send_error(send: Send, status: int, detail: bytes):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", b"text/plain; charset=utf-8")],
+            }
+        )
+        await send({"type": "http.response.body", "body": detail})
+
+
+class CompressedSender:
+    """
+    Compresses the body of complete responses sent in a single message. Streamed
+    responses are sent as they are.
+    """
+
+    def __init__(self, send: Send, encoding: str, middleware: CompressionMiddleware):
+        self.send = send
+        self.encoding = encoding
+        self.minimum_size = middleware.minimum_size
+        self.start: Optional[Message] = None
+        self.passthrough = False
+
+    async def __call__(self, message: Message):
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            media_type = headers.get("content-type", "").split(";")[0].strip()
+            self.passthrough = (
+                "content-encoding" in headers or media_type in UNCOMPRESSED_MEDIA_TYPES
+            )
+            if self.passthrough:
+                await self.send(message)
+            else:
+                self.start = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        start, self.start = self.start, None
+        body = message.get("body", b"")
+        if message.get("more_body", False) or len(body) < self.minimum_size:
+            self.passthrough = True
+            await self.send(start)
+            await self.send(message)
+            return
+
+        body = compress(body, self.encoding)
+        headers = MutableHeaders(raw=list(start["headers"]))
+        headers["Content-Encoding"] = self.encoding
+        headers["Content-Length"] = str(len(body))
+        headers.add_vary_header("Accept-Encoding")
+        await self.send({**start, "headers": headers.raw})
+        await self.send({"type": "http.response.body", "body": body})
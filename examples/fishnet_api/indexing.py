@@ -0,0 +1,554 @@
+"""
+Persistence and synchronization of the indices of the API.
+
+Indices are stored in the VM cache together with a sync mark, the time and hash
+of the last message applied to them. On startup, only the messages posted on the
+channel since shortly before that mark are fetched and applied, instead of
+rebuilding every index from the whole channel history. The times of messages are
+set by their senders, so messages reaching the node late are fetched again by
+starting `SYNC_MARGIN` seconds before the mark, and the messages already applied
+are skipped. The snapshot is saved after every synchronization, and at most every
+`SNAPSHOT_INTERVAL` seconds while events are applied.
+
+Synchronizations run as a single background task. Full rebuilds are applied to
+copies of the indices, which replace the served ones once complete.
+"""
+
+import asyncio
+import base64
+import bisect
+import json
+import logging
+import sys
+import time
+from enum import Enum
+from typing import Any, Dict, List, Optional, Set, Tuple, Type
+
+from aars import AARS, Index, Record
+from aleph.sdk.vm.cache import BaseVmCache
+from aleph_message.models import MessageType, PostMessage
+from pydantic import BaseModel, ValidationError
+
+from fishnet_cod import (
+    Algorithm,
+    Dataset,
+    Execution,
+    Permission,
+    Result,
+    ResultChunk,
+    Timeseries,
+    UserInfo,
+)
+from fishnet_cod.index import (
+    SortedIndex,
+    as_key,
+    get_keys,
+    load_index,
+    move_record,
+)
+
+from .permissions import PermissionMatrix, PermissionMatrixSnapshot
+
+logger = logging.getLogger(__name__)
+
+INDEX_SNAPSHOT_KEY = "fishnet_api_indices"
+SYNC_PAGE_SIZE = 200
+# Number of messages applied between two yields to the event loop
+APPLY_BATCH_SIZE = 500
+# Seconds before the sync mark from which messages are fetched again, to get the
+# ones which reached the node after newer ones
+SYNC_MARGIN = 300
+# Minimum seconds between two snapshots of the indices saved on events
+SNAPSHOT_INTERVAL = 60
+
+INDEXED_RECORD_TYPES: Dict[str, Type[Record]] = {
+    record_type.__name__: record_type
+    for record_type in [
+        Timeseries,
+        UserInfo,
+        Dataset,
+        Algorithm,
+        Execution,
+        Permission,
+        Result,
+        ResultChunk,
+    ]
+}
+
+
+class SyncMark(BaseModel):
+    """Time and item hash of the last message applied to the indices."""
+
+    time: float = 0
+    item_hash: Optional[str] = None
+
+    def is_after(self, message: PostMessage) -> bool:
+        return (self.time, self.item_hash or "") >= (message.time, message.item_hash)
+
+
+class IndexSnapshot(BaseModel):
+    mark: SyncMark
+    record_types: Dict[str, str]  # id_hash -> record type name
+    indices: Dict[str, List[Tuple[List[Any], List[str]]]]  # index name -> buckets
+    kinds: Dict[str, str] = {}  # index name -> index class name
+    permissions: Optional[PermissionMatrixSnapshot] = None
+    revisions: Dict[str, Tuple[float, str]] = {}  # id_hash -> indexed revision
+
+
+class IndexSet:
+    """
+    The indices of all indexed record types, along with the sync mark they are
+    up to date with.
+    """
+
+    def __init__(self, indices: Dict[str, Index]):
+        self.indices = indices
+        self.mark = SyncMark()
+        # Type of every indexed record, needed to apply the amends referencing them
+        self.record_types: Dict[str, str] = {}
+        # id_hash -> time and item hash of the indexed revision of the record, to
+        # skip the messages already applied and older revisions received late
+        self.revisions: Dict[str, Tuple[float, str]] = {}
+        # index name -> id_hash -> keys of the buckets holding the record, to
+        # move it out of the buckets of its previous revision when amended
+        self.record_keys: Dict[str, Dict[str, Set[Any]]] = {
+            name: {} for name in indices
+        }
+        self.permissions = PermissionMatrix()
+
+    @classmethod
+    def declared(cls) -> "IndexSet":
+        """The indices declared on the record types, which are used by queries."""
+        return cls(
+            {
+                repr(index): index
+                for record_type in INDEXED_RECORD_TYPES.values()
+                for index in record_type.get_indices()
+            }
+        )
+
+    def empty_copy(self) -> "IndexSet":
+        copies = {}
+        for name, index in self.indices.items():
+            copies[name] = index.copy()
+            copies[name].regenerate([])
+        return IndexSet(copies)
+
+    def replace_with(self, other: "IndexSet"):
+        """Swaps the content of `other` into these indices, in one step."""
+        for name, index in self.indices.items():
+            source = other.indices[name]
+            index.hashmap = source.hashmap
+            if isinstance(index, SortedIndex):
+                index.sorted_keys = source.sorted_keys
+        self.mark = other.mark
+        self.record_types = other.record_types
+        self.revisions = other.revisions
+        self.record_keys = other.record_keys
+        self.permissions = other.permissions
+
+    def rebuild_record_keys(self):
+        self.record_keys = {name: {} for name in self.indices}
+        for name, index in self.indices.items():
+            record_keys = self.record_keys[name]
+            for key, id_hashes in index.hashmap.items():
+                for id_hash in id_hashes:
+                    record_keys.setdefault(id_hash, set()).add(key)
+
+    def get_kinds(self) -> Dict[str, str]:
+        return {name: type(index).__name__ for name, index in self.indices.items()}
+
+    def get_record_indices(self, record_type: Type[Record]) -> List[Index]:
+        return [
+            index for index in self.indices.values() if index.record_type is record_type
+        ]
+
+    def is_applied(self, message: PostMessage) -> bool:
+        """Whether `message`, or a newer revision of its record, was applied."""
+        revision = self.revisions.get(message.content.ref or message.item_hash)
+        return revision is not None and revision >= (message.time, message.item_hash)
+
+    def apply_message(self, message: PostMessage) -> Optional[Record]:
+        """
+        Adds the record posted or amended by `message` to the indices, removing
+        it from the buckets its previous revision was in, and advances the sync
+        mark. Revisions older than the indexed one are skipped.
+        :return: the record as of `message`, or None if it is not an indexed record
+            or an older revision
+        """
+        if message.content.type == "amend":
+            record_type_name = self.record_types.get(message.content.ref)
+        else:
+            record_type_name = message.content.type
+        record_type = INDEXED_RECORD_TYPES.get(record_type_name)
+        if record_type is None:
+            return None
+
+        try:
+            record = record_type(**message.content.content)
+        except ValidationError as error:
+            logger.warning(
+                f"Skipping invalid {record_type_name} {message.item_hash}: {error}"
+            )
+            return None
+        record.id_hash = message.content.ref or message.item_hash
+        record.timestamp = message.time
+        revision = (message.time, message.item_hash)
+        if self.revisions.get(record.id_hash, revision) > revision:
+            return None
+        self.revisions[record.id_hash] = revision
+        self.record_types[record.id_hash] = record_type_name
+
+        for name, index in self.indices.items():
+            if index.record_type is not record_type:
+                continue
+            record_keys = self.record_keys[name]
+            try:
+                keys = get_keys(index, record)
+            except TypeError as error:
+                logger.warning(f"Cannot add {record!r} to {index}: {error}")
+                keys = set()
+            move_record(
+                index, record.id_hash, record_keys.get(record.id_hash, set()), keys
+            )
+            if keys:
+                record_keys[record.id_hash] = keys
+            else:
+                record_keys.pop(record.id_hash, None)
+        self.permissions.apply_record(record)
+
+        if not self.mark.is_after(message):
+            self.mark = SyncMark(time=message.time, item_hash=message.item_hash)
+        return record
+
+    def dump(self) -> IndexSnapshot:
+        return IndexSnapshot(
+            mark=self.mark,
+            record_types=self.record_types,
+            indices={
+                name: [
+                    (list(as_key(key)), list(id_hashes))
+                    for key, id_hashes in index.hashmap.items()
+                ]
+                for name, index in self.indices.items()
+            },
+            kinds=self.get_kinds(),
+            permissions=self.permissions.dump(),
+            revisions=self.revisions,
+        )
+
+    def restore(self, snapshot: IndexSnapshot) -> bool:
+        """
+        Replaces the indices with the ones of `snapshot`.
+        :return: whether the snapshot matched the declared indices and was restored
+        """
+        if (
+            set(snapshot.indices) != set(self.indices)
+            or snapshot.kinds != self.get_kinds()
+            or snapshot.permissions is None
+        ):
+            logger.info("Index snapshot does not match the declared indices")
+            return False
+        restored = self.empty_copy()
+        for name, buckets in snapshot.indices.items():
+            load_index(
+                restored.indices[name],
+                {tuple(key): set(id_hashes) for key, id_hashes in buckets},
+            )
+        restored.mark = snapshot.mark
+        restored.record_types = snapshot.record_types
+        restored.revisions = {
+            id_hash: tuple(revision) for id_hash, revision in snapshot.revisions.items()
+        }
+        restored.permissions = PermissionMatrix.restore(snapshot.permissions)
+        restored.rebuild_record_keys()
+        self.replace_with(restored)
+        return True
+
+
+indices = IndexSet.declared()
+
+
+async def fetch_messages(start_date: Optional[float] = None) -> List[PostMessage]:
+    """
+    Fetches the record messages of the channel posted since `start_date`.
+    :return: the messages in the order they were posted
+    """
+    messages: List[PostMessage] = []
+    page = 1
+    while True:
+        response = await AARS.session.get_messages(
+            channels=[AARS.channel],
+            message_type=MessageType.post,
+            content_types=list(INDEXED_RECORD_TYPES) + ["amend"],
+            start_date=start_date,
+            pagination=SYNC_PAGE_SIZE,
+            page=page,
+        )
+        messages.extend(response.messages)
+        if page * response.pagination_per_page >= response.pagination_total:
+            break
+        page += 1
+    return sorted(messages, key=lambda message: (message.time, message.item_hash))
+
+
+async def save_indices(cache: BaseVmCache):
+    await cache.set(INDEX_SNAPSHOT_KEY, indices.dump().json())
+
+
+async def load_indices(cache: BaseVmCache) -> bool:
+    """
+    Restores the indices saved in `cache`.
+    :return: whether a snapshot was found and restored
+    """
+    raw_snapshot = await cache.get(INDEX_SNAPSHOT_KEY)
+    if raw_snapshot is None:
+        return False
+    try:
+        snapshot = IndexSnapshot.parse_raw(raw_snapshot)
+    except ValidationError as error:
+        logger.warning(f"Discarding invalid index snapshot: {error}")
+        return False
+    return indices.restore(snapshot)
+
+
+class IndexStats(BaseModel):
+    name: str
+    keys: int
+    records: int
+    entries: int  # sum of the bucket sizes
+    maxBucketSize: int
+    meanBucketSize: float
+    memoryEstimate: int  # bytes held by the hashmap, its keys, buckets and ids
+    largestBuckets: List[Tuple[List[Any], int]]
+
+
+class IndexPage(BaseModel):
+    name: str
+    buckets: List[Tuple[List[Any], List[str]]]
+    nextCursor: Optional[str]
+
+
+def get_index_stats(name: str, index: Index, largest: int = 5) -> IndexStats:
+    bucket_sizes = {key: len(id_hashes) for key, id_hashes in index.hashmap.items()}
+    records = set()
+    memory = sys.getsizeof(index.hashmap)
+    for key, id_hashes in index.hashmap.items():
+        records.update(id_hashes)
+        memory += sys.getsizeof(key) + sum(
+            sys.getsizeof(value) for value in as_key(key)
+        )
+        memory += sys.getsizeof(id_hashes)
+        memory += sum(sys.getsizeof(id_hash) for id_hash in id_hashes)
+    entries = sum(bucket_sizes.values())
+    largest_keys = sorted(bucket_sizes, key=bucket_sizes.get, reverse=True)[:largest]
+    return IndexStats(
+        name=name,
+        keys=len(bucket_sizes),
+        records=len(records),
+        entries=entries,
+        maxBucketSize=max(bucket_sizes.values(), default=0),
+        meanBucketSize=entries / len(bucket_sizes) if bucket_sizes else 0,
+        memoryEstimate=memory,
+        largestBuckets=[(list(as_key(key)), bucket_sizes[key]) for key in largest_keys],
+    )
+
+
+def encode_index_key(key: Tuple) -> str:
+    return json.dumps(list(as_key(key)), default=str)
+
+
+def encode_cursor(encoded_key: str) -> str:
+    return base64.urlsafe_b64encode(encoded_key.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> str:
+    return base64.urlsafe_b64decode(cursor.encode()).decode()
+
+
+def get_index_page(
+    name: str, index: Index, cursor: Optional[str] = None, limit: int = 100
+) -> IndexPage:
+    """
+    Returns the buckets of `index` following the key encoded in `cursor`, in the
+    order of their JSON-encoded keys.
+    """
+    keys = {encode_index_key(key): key for key in index.hashmap}
+    encoded_keys = sorted(keys)
+    start = bisect.bisect_right(encoded_keys, decode_cursor(cursor)) if cursor else 0
+    page_keys = encoded_keys[start : start + limit]
+    has_more = start + limit < len(encoded_keys)
+    return IndexPage(
+        name=name,
+        buckets=[
+            (list(as_key(keys[encoded_key])), sorted(index.hashmap[keys[encoded_key]]))
+            for encoded_key in page_keys
+        ],
+        nextCursor=encode_cursor(page_keys[-1]) if has_more else None,
+    )
+
+
+class ReindexState(str, Enum):
+    IDLE = "IDLE"
+    RUNNING = "RUNNING"
+    DONE = "DONE"
+    FAILED = "FAILED"
+
+
+class ReindexStatus(BaseModel):
+    state: ReindexState = ReindexState.IDLE
+    full: bool = False
+    ready: bool = False  # whether the indices have been synchronized at least once
+    messagesFetched: int = 0
+    messagesApplied: int = 0
+    startedAt: Optional[float] = None
+    finishedAt: Optional[float] = None
+    error: Optional[str] = None
+    mark: Optional[SyncMark] = None
+
+
+class Reindexer:
+    """
+    Synchronizes the indices with the channel in a background task. Requests
+    made while a synchronization runs are coalesced into it, or into a single
+    full rebuild following it.
+
+    Events keep being applied to the served indices during a full rebuild. They
+    are also buffered, and the ones the rebuilt indices did not catch up with
+    are applied again once these replace the served ones. Otherwise, the indices
+    are saved at most every `SNAPSHOT_INTERVAL` seconds while events are applied.
+    """
+
+    def __init__(self, cache: BaseVmCache):
+        self.cache = cache
+        self.status = ReindexStatus()
+        self.task: Optional[asyncio.Task] = None
+        self.full_requested = False
+        # events received during a full rebuild
+        self.buffered: Optional[List[PostMessage]] = None
+        self.saved_at = 0.0
+        self.saving: Optional[asyncio.Task] = None
+
+    def apply_event(self, message: PostMessage) -> Optional[Record]:
+        """
+        Applies a message received as event to the served indices, and schedules
+        a snapshot of them. Events received out of order advance the sync mark
+        past older messages, which the next synchronization fetches again as
+        long as they are less than `SYNC_MARGIN` seconds older.
+        """
+        if self.buffered is not None:
+            self.buffered.append(message)
+        record = indices.apply_message(message)
+        self.schedule_save()
+        return record
+
+    def schedule_save(self):
+        """Saves the indices in `SNAPSHOT_INTERVAL` seconds at most, unless a sync does."""
+        if self.running or (self.saving is not None and not self.saving.done()):
+            return
+        delay = max(self.saved_at + SNAPSHOT_INTERVAL - time.time(), 0)
+        self.saving = asyncio.create_task(self.save_later(delay))
+
+    async def save_later(self, delay: float):
+        await asyncio.sleep(delay)
+        if self.running:
+            return  # saved once the synchronization is done
+        try:
+            await save_indices(self.cache)
+        except Exception:
+            logger.exception("Failed to save the indices")
+        self.saved_at = time.time()
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def start(self, full: bool = False) -> ReindexStatus:
+        """Starts a synchronization, unless one is already running."""
+        if self.running:
+            self.full_requested |= full and not self.status.full
+        else:
+            self.reset_status(full)
+            self.task = asyncio.create_task(self.run(full))
+        return self.status
+
+    def reset_status(self, full: bool):
+        self.status = ReindexStatus(
+            state=ReindexState.RUNNING,
+            full=full,
+            ready=self.status.ready,
+            startedAt=time.time(),
+            mark=indices.mark,
+        )
+
+    async def wait(self):
+        while self.running:
+            await asyncio.shield(self.task)
+
+    async def run(self, full: bool):
+        while True:
+            self.full_requested = False
+            await self.sync(full)
+            if not self.full_requested:
+                return
+            full = True
+            self.reset_status(full)
+
+    async def sync(self, full: bool):
+        logger.info(f"API re-indexing (full: {full})")
+        try:
+            if (
+                not full
+                and not indices.mark.time
+                and not await load_indices(self.cache)
+            ):
+                full = True
+                self.status.full = True
+            if full:
+                self.buffered = []
+                target = indices.empty_copy()
+            else:
+                self.status.ready = True
+                target = indices
+            await self.apply_messages_since(target)
+            if full:
+                # catch up with the messages posted during the rebuild
+                await self.apply_messages_since(target)
+                indices.replace_with(target)
+                self.replay_buffered()
+            await save_indices(self.cache)
+            self.saved_at = time.time()
+        except Exception as error:
+            logger.exception("API re-indexing failed")
+            self.status.state = ReindexState.FAILED
+            self.status.error = str(error)
+        else:
+            logger.info(
+                f"API re-indexing done, {self.status.messagesApplied} messages applied"
+            )
+            self.status.state = ReindexState.DONE
+            self.status.ready = True
+        finally:
+            self.buffered = None
+        self.status.finishedAt = time.time()
+        self.status.mark = indices.mark
+
+    def replay_buffered(self):
+        """Applies the buffered events that the rebuilt indices did not catch up with."""
+        buffered, self.buffered = self.buffered or [], None
+        for message in sorted(buffered, key=lambda m: (m.time, m.item_hash)):
+            if not indices.is_applied(message):
+                indices.apply_message(message)
+
+    async def apply_messages_since(self, target: IndexSet):
+        """Applies the messages since `SYNC_MARGIN` seconds before the mark of `target`."""
+        start_date = target.mark.time - SYNC_MARGIN
+        messages = await fetch_messages(start_date if start_date > 0 else None)
+        self.status.messagesFetched += len(messages)
+        for position, message in enumerate(messages, start=1):
+            if target.is_applied(message):
+                continue
+            if target.apply_message(message) is not None:
+                self.status.messagesApplied += 1
+            if position % APPLY_BATCH_SIZE == 0:
+                await asyncio.sleep(0)
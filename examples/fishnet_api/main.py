@@ -2,6 +2,8 @@ import asyncio
 import logging
 import os
 from os import listdir, getenv
+from typing import Any, Dict, List, Optional, Set, Tuple, Type, Union
+from uuid import uuid4
 
 from aleph_message.models import PostMessage
 
@@ -12,20 +14,45 @@ from aleph.sdk.vm.cache import VmCache, TestVmCache
 from aleph.sdk.vm.app import AlephApp
 
 logger.debug("import aars")
-from aars import AARS
+from aars import AARS, Index
+from pydantic import BaseModel
 
 logger.debug("import fastapi")
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 logger.debug("import project modules")
 from fishnet_cod import *
+from .indexing import (
+    IndexPage,
+    IndexStats,
+    Reindexer,
+    ReindexStatus,
+    get_index_page,
+    get_index_stats,
+    indices,
+)
+from .compression import CompressionMiddleware
+from .permissions import is_usable, remaining_executions, transition_permissions
+from .responses import (
+    RECORD_INTERNAL_FIELDS,
+    FastJSONResponse,
+    FastJSONRoute,
+    negotiated_response,
+)
+from .streaming import ExecutionWatcher, parse_last_event_id, stream_execution
 from .requests import *
-import numpy as np
 
 logger.debug("imports done")
 
-http_app = FastAPI()
+http_app = FastAPI(default_response_class=FastJSONResponse)
+http_app.router.route_class = FastJSONRoute
+
+# Header holding the cursor of the next page of the list endpoints
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 1000
 
 origins = ["*"]
 
@@ -35,7 +62,9 @@ http_app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
+http_app.add_middleware(CompressionMiddleware)
 
 if getenv("TEST_CACHE") is not None and getenv("TEST_CACHE").lower() == "true":
     cache = TestVmCache()
@@ -43,17 +72,13 @@ else:
     cache = VmCache()
 app = AlephApp(http_app=http_app)
 aars = AARS(channel="FISHNET_TEST", cache=cache)
-
-
-async def re_index():
-    logger.info("API re-indexing")
-    await asyncio.wait_for(AARS.sync_indices(), timeout=None)
-    logger.info("API re-indexing done")
+reindexer = Reindexer(cache)
+watcher = ExecutionWatcher()
 
 
 @http_app.on_event("startup")
 async def startup():
-    await re_index()
+    reindexer.start()
 
 
 @app.get("/")
@@ -82,186 +107,481 @@ async def index():
 
 
 @app.get("/indices")
-async def index():
-    ts = [list(index.hashmap.items()) for index in Timeseries.get_indices()]
-    ui = [list(index.hashmap.items()) for index in UserInfo.get_indices()]
-    ds = [list(index.hashmap.items()) for index in Dataset.get_indices()]
-    al = [list(index.hashmap.items()) for index in Algorithm.get_indices()]
-    ex = [list(index.hashmap.items()) for index in Execution.get_indices()]
-    pe = [list(index.hashmap.items()) for index in Permission.get_indices()]
-    return ts, ui, ds, al, ex, pe
+async def index_stats(
+        largest: int = Query(default=5, ge=0, le=100)
+) -> List[IndexStats]:
+    """
+    Get the statistics of all indices: key, record and entry counts, bucket sizes,
+    memory estimate and their `largest` buckets.
+    """
+    return [
+        get_index_stats(name, index, largest=largest)
+        for name, index in indices.indices.items()
+    ]
 
 
 @app.get("/indices/reindex")
-async def index():
-    await re_index()
+async def reindex() -> ReindexStatus:
+    """
+    Starts rebuilding all indices in the background. The current indices are
+    served until the new ones replace them. Returns the status of the running
+    reindexing if one was already started.
+    """
+    return reindexer.start(full=True)
+
+
+@app.get("/indices/status")
+async def index_status() -> ReindexStatus:
+    return reindexer.status
+
+
+def get_named_index(index_name: str) -> Index:
+    if index_name not in indices.indices:
+        raise HTTPException(status_code=404, detail=f"No index {index_name} found")
+    return indices.indices[index_name]
+
+
+@app.get("/indices/{index_name}")
+async def index_buckets(
+        index_name: str,
+        cursor: Optional[str] = None,
+        limit: int = Query(default=100, ge=1, le=1000),
+) -> IndexPage:
+    """
+    Get a page of the buckets of an index, as `(key, id_hashes)` pairs.
+    :param `cursor`: `nextCursor` of the previous page, to get the following one
+    :param `limit`: maximum number of buckets in the page
+    """
+    index = get_named_index(index_name)
+    try:
+        return get_index_page(index_name, index, cursor=cursor, limit=limit)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@app.get("/indices/{index_name}/stats")
+async def named_index_stats(
+        index_name: str, largest: int = Query(default=5, ge=0, le=100)
+) -> IndexStats:
+    return get_index_stats(index_name, get_named_index(index_name), largest=largest)
+
+
+async def paginate(
+        response: Response,
+        record_type: Type[Record],
+        cursor: Optional[str],
+        page: Optional[int],
+        page_size: Optional[int],
+        **conditions,
+) -> List[Record]:
+    """
+    Fetches the records fulfilling `conditions` through the indices, ordered by id hash.
+    Pages follow the `cursor` returned in the `X-Next-Cursor` header of the previous page,
+    or are numbered by `page`. Pages hold `DEFAULT_PAGE_SIZE` records unless `page_size`
+    is given, and at most `MAX_PAGE_SIZE`.
+    """
+    page_size = min(page_size or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    offset = (page - 1) * page_size if page else 0
+    records_page = await fetch_page(
+        record_type, after=cursor, limit=page_size, offset=offset, **conditions
+    )
+    if records_page.next_cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = records_page.next_cursor
+    return records_page.records
+
+
+def get_projection(
+        model: Type[BaseModel], fields: Optional[List[str]]
+) -> Optional[Set[str]]:
+    """
+    Returns the names of the `fields` of `model` to respond with, given as repeated
+    or comma separated `fields` parameters, or None to respond with every field.
+    The `id_hash` of the records is always included.
+    """
+    if not fields:
+        return None
+    names = {name.strip() for field in fields for name in field.split(",")} - {""}
+    unknown = names - (set(model.__fields__) - RECORD_INTERNAL_FIELDS)
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields of {model.__name__}: {', '.join(sorted(unknown))}",
+        )
+    return names | {"id_hash"}
+
+
+def projected_response(content: Any, response: Response) -> Response:
+    """Responds with the projected records, keeping the pagination cursor."""
+    headers = {}
+    if NEXT_CURSOR_HEADER in response.headers:
+        headers[NEXT_CURSOR_HEADER] = response.headers[NEXT_CURSOR_HEADER]
+    return negotiated_response(content, headers=headers)
+
+
+def project(
+        records: List[BaseModel], projection: Optional[Set[str]], response: Response
+) -> Union[List[BaseModel], Response]:
+    if projection is None:
+        return records
+    return projected_response(
+        [record.dict(include=projection) for record in records], response
+    )
 
 
 @app.get("/datasets")
 async def datasets(
+        response: Response,
         view_as: Optional[str] = None,
         by: Optional[str] = None,
+        cursor: Optional[str] = None,
         page: Optional[int] = None,
         page_size: Optional[int] = None,
+        fields: Optional[List[str]] = Query(default=None),
 ) -> List[Tuple[Dataset, Optional[DatasetPermissionStatus]]]:
     """
     Get all datasets. Returns a list of tuples of datasets and their permission status for the given `view_as` user.
     If `view_as` is not given, the permission status will be `none` for all datasets.
     :param `view_as`: address of the user to view the datasets as and give additional permission information
     :param `by`: address of the dataset owner to filter by
+    :param `cursor`: cursor of the page to fetch, returned in the `X-Next-Cursor` header of the previous page
     :param `page_size´: size of the pages to fetch
     :param `page`: page number to fetch
+    :param `fields`: fields of the datasets to return, all of them if not given
     """
-    if by:
-        datasets = await Dataset.where_eq(owner=by).all()
-
-    else:
-        datasets = await Dataset.fetch_objects().page(page=page, page_size=page_size)
-
-    datasets = await Dataset.fetch_objects().page(page=page, page_size=page_size)
-    ts_ids = [rec.timeseriesIDs for rec in datasets]
-
-    ts_ids_np = np.array(ts_ids)
-    ts_ids_lists = np.hstack(ts_ids_np)
-    ts_ids_unique = np.unique(ts_ids_lists)
-
-    ts_ids_lst = list(ts_ids_unique)
-
-    dataset_by_requestor = await Dataset.where_eq(timeseriesIDs=ts_ids_lst).all()
+    projection = get_projection(Dataset, fields)
+    datasets = await paginate(
+        response, Dataset, cursor, page, page_size, owner=by
+    )
+    if view_as is None:
+        returned_datasets = [(rec, None) for rec in datasets]
+        return project_datasets(returned_datasets, projection, response)
+
+    permission_records = await where(
+        Permission,
+        timeseriesID=sorted({ts_id for rec in datasets for ts_id in rec.timeseriesIDs}),
+        requestor=view_as,
+    ).all()
+    permission_statuses: Dict[str, List[PermissionStatus]] = {}
+    for perm_rec in permission_records:
+        permission_statuses.setdefault(perm_rec.timeseriesID, []).append(
+            perm_rec.status
+        )
 
     returned_datasets = []
-
-    for rec in dataset_by_requestor:
-        permission_records = await Permission.where_eq(
-            timeseriesID=rec.timeseriesIDs, requestor=view_as
-        ).page(page=page, page_size=page_size)
-
-        if not permission_records:
+    for rec in datasets:
+        permission_status = [
+            status
+            for ts_id in rec.timeseriesIDs
+            for status in permission_statuses.get(ts_id, [])
+        ]
+        if not permission_status:
             returned_datasets.append((rec, DatasetPermissionStatus.NOT_REQUESTED))
-            continue
-
-        permission_status = [perm_rec.status for perm_rec in permission_records]
-        if all(status == PermissionStatus.GRANTED for status in permission_status):
+        elif all(status == PermissionStatus.GRANTED for status in permission_status):
             returned_datasets.append((rec, DatasetPermissionStatus.GRANTED))
         elif PermissionStatus.DENIED in permission_status:
             returned_datasets.append((rec, DatasetPermissionStatus.DENIED))
-        elif PermissionStatus.REQUESTED in permission_status:
+        else:
             returned_datasets.append((rec, DatasetPermissionStatus.REQUESTED))
-    return returned_datasets
+    return project_datasets(returned_datasets, projection, response)
+
+
+def project_datasets(
+        datasets: List[Tuple[Dataset, Optional[DatasetPermissionStatus]]],
+        projection: Optional[Set[str]],
+        response: Response,
+):
+    if projection is None:
+        return datasets
+    return projected_response(
+        [(rec.dict(include=projection), status) for rec, status in datasets],
+        response,
+    )
 
 
 @app.get("/user/{userAddress}/permissions/incoming")
 async def in_permission_requests(
-        userAddress: str, page: Optional[int] = None, page_size: Optional[int] = None
+        userAddress: str,
+        response: Response,
+        cursor: Optional[str] = None,
+        page: Optional[int] = None,
+        page_size: Optional[int] = None,
+        fields: Optional[List[str]] = Query(default=None),
 ) -> List[Permission]:
-    permission_records = await Permission.where_eq(owner=userAddress).page(
-        page=page, page_size=page_size
+    projection = get_projection(Permission, fields)
+    permissions = await paginate(
+        response, Permission, cursor, page, page_size, owner=userAddress
     )
-    return permission_records
+    return project(permissions, projection, response)
 
 
 @app.get("/user/{userAddress}/permissions/outgoing")
 async def out_permission_requests(
-        userAddress: str, page: Optional[int] = None, page_size: Optional[int] = None
+        userAddress: str,
+        response: Response,
+        cursor: Optional[str] = None,
+        page: Optional[int] = None,
+        page_size: Optional[int] = None,
+        fields: Optional[List[str]] = Query(default=None),
 ) -> List[Permission]:
-    permission_records = await Permission.where_eq(requestor=userAddress).page(
-        page=page, page_size=page_size
+    projection = get_projection(Permission, fields)
+    permissions = await paginate(
+        response, Permission, cursor, page, page_size, requestor=userAddress
     )
-    return permission_records
+    return project(permissions, projection, response)
 
 
 @app.get("/algorithms")
 async def query_algorithms(
+        response: Response,
         id: Optional[str] = None,
         name: Optional[str] = None,
         by: Optional[str] = None,
+        cursor: Optional[str] = None,
         page: Optional[int] = None,
         page_size: Optional[int] = None,
+        fields: Optional[List[str]] = Query(default=None),
 ) -> List[Algorithm]:
     """
     - query for own algos
     - query other algos
-    - page, page_size and by
+    - page, page_size and by, or cursor to fetch the page following the `X-Next-Cursor` header
+    - fields to return only some fields of the algorithms, like their name without their code
     """
+    projection = get_projection(Algorithm, fields)
 
     if id:
-        algo_id = await Algorithm.fetch(id).page(page=page, page_size=page_size)
+        algo_id = await Algorithm.fetch(id).all()
         if not algo_id:
             raise HTTPException(status_code=404, detail="No Algorithms found")
-        return algo_id
-
-    if name:
-        algo_name = await Algorithm.where_eq(name=name).page(
-            page=page, page_size=page_size
-        )
-        if not algo_name:
-            raise HTTPException(status_code=404, detail="No Algorithms found")
-        return algo_name
-
-    elif by:
-        algo_owner = await Algorithm.where_eq(owner=by).page(
-            page=page, page_size=page_size
-        )
-        if not algo_owner:
-            raise HTTPException(status_code=404, detail="No Algorithm found")
-        return algo_owner
-
-    elif page or page_size:
-        return await Algorithm.fetch_objects().page(page=page, page_size=page_size)
+        return project(algo_id, projection, response)
 
-    else:
-        return await Algorithm.fetch_objects().page(page=1)
+    algorithms = await paginate(
+        response, Algorithm, cursor, page, page_size, name=name, owner=by
+    )
+    if (name or by) and not algorithms:
+        raise HTTPException(status_code=404, detail="No Algorithms found")
+    return project(algorithms, projection, response)
 
 
 @app.get("/user/{address}/algorithms")
 async def get_user_algorithms(
-        address: str, page: Optional[int] = None, page_size: Optional[int] = None
+        address: str,
+        response: Response,
+        cursor: Optional[str] = None,
+        page: Optional[int] = None,
+        page_size: Optional[int] = None,
+        fields: Optional[List[str]] = Query(default=None),
 ) -> List[Algorithm]:
-    return await Algorithm.where_eq(owner=address).page(page=page, page_size=page_size)
+    projection = get_projection(Algorithm, fields)
+    algorithms = await paginate(
+        response, Algorithm, cursor, page, page_size, owner=address
+    )
+    return project(algorithms, projection, response)
 
 
 @app.get("/executions")
 async def get_executions(
-        dataset_id: Optional[str],
+        response: Response,
+        dataset_id: Optional[str] = None,
         by: Optional[str] = None,
-        status: Optional[ExecutionStatus] = None,
+        status: Optional[List[ExecutionStatus]] = Query(default=None),
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        cursor: Optional[str] = None,
         page: Optional[int] = None,
         page_size: Optional[int] = None,
+        fields: Optional[List[str]] = Query(default=None),
 ) -> List[Execution]:
-    if dataset_id or by or status:
-        execution_requests = Execution.where_eq(
-            datasetID=dataset_id, owner=by, status=status
-        )
-    else:
-        execution_requests = Execution.fetch_objects().page(
-            page=page, page_size=page_size
-        )
-    if not execution_requests:
+    """
+    Get executions, optionally filtered through the indices.
+    :param `dataset_id`: dataset of the executions
+    :param `by`: address of the execution owner
+    :param `status`: statuses of the executions, can be given multiple times to match any of them
+    :param `since`: earliest time at which the executions were posted
+    :param `until`: latest time at which the executions were posted
+    :param `cursor`: cursor of the page to fetch, returned in the `X-Next-Cursor` header of the previous page
+    :param `fields`: fields of the executions to return, all of them if not given
+    """
+    projection = get_projection(Execution, fields)
+    timestamp = None
+    if since is not None or until is not None:
+        timestamp = Range(start=since, end=until)
+    executions = await paginate(
+        response,
+        Execution,
+        cursor,
+        page,
+        page_size,
+        datasetID=dataset_id,
+        owner=by,
+        status=status or None,
+        timestamp=timestamp,
+    )
+    if not executions:
         raise HTTPException(status_code=404, detail="No Execution found")
-    return await execution_requests
+    return project(executions, projection, response)
 
 
 @app.get("/user/{address}/results")
 async def get_user_results(
-        address: str, page: Optional[int] = None, page_size: Optional[int] = None
+        address: str,
+        response: Response,
+        cursor: Optional[str] = None,
+        page: Optional[int] = None,
+        page_size: Optional[int] = None,
+        fields: Optional[List[str]] = Query(default=None),
 ) -> List[Result]:
-    return await Result.where_eq(owner=address).page(page=page, page_size=page_size)
+    """
+    Get the results of the finished executions of a user, found through their
+    `resultID`, as memoized executions reuse the result of an earlier execution
+    which may be owned by another user. Pages follow the executions by id hash.
+    """
+    projection = get_projection(Result, fields)
+    executions = await paginate(
+        response,
+        Execution,
+        cursor,
+        page,
+        page_size,
+        owner=address,
+        status=[ExecutionStatus.SUCCESS, ExecutionStatus.FAILED],
+    )
+    result_ids = list(
+        dict.fromkeys(e.resultID for e in executions if e.resultID is not None)
+    )
+    results = {}
+    if result_ids:
+        results = {
+            result.id_hash: result for result in await Result.fetch(result_ids).all()
+        }
+    return project(
+        [results[result_id] for result_id in result_ids if result_id in results],
+        projection,
+        response,
+    )
 
 
-@app.get("/executions/{execution_id}/possible_execution_count")
-async def get_possible_execution_count(execution_id: str) -> int:
+def summarize_timeseries(
+        timeseries: List[Timeseries],
+        summary: bool,
+        projection: Optional[Set[str]],
+        response: Response,
+):
+    if summary:
+        timeseries = [TimeseriesSummary.from_timeseries(ts) for ts in timeseries]
+    return project(timeseries, projection, response)
+
+
+@app.get("/datasets/{dataset_id}/timeseries")
+async def get_dataset_timeseries(
+        dataset_id: str,
+        response: Response,
+        summary: bool = False,
+        fields: Optional[List[str]] = Query(default=None),
+) -> List[Union[TimeseriesSummary, Timeseries]]:
+    """
+    Get the timeseries of a dataset.
+    :param `summary`: return the count, time range and value range of the timeseries instead of their data
+    :param `fields`: fields of the timeseries or their summaries to return, all of them if not given
     """
-    THIS IS AN OPTIONAL ENDPOINT. It is a nice challenge to implement this endpoint, as the code is not trivial, and
-    it might be still good to have this code in the future.
+    projection = get_projection(TimeseriesSummary if summary else Timeseries, fields)
+    dataset = await Dataset.fetch(dataset_id).first()
+    if dataset is None:
+        raise HTTPException(status_code=404, detail="No Dataset found")
+    timeseries = await Timeseries.fetch(dataset.timeseriesIDs).all()
+    return summarize_timeseries(timeseries, summary, projection, response)
 
+
+@app.get("/user/{address}/timeseries")
+async def get_user_timeseries(
+        address: str,
+        response: Response,
+        summary: bool = False,
+        cursor: Optional[str] = None,
+        page: Optional[int] = None,
+        page_size: Optional[int] = None,
+        fields: Optional[List[str]] = Query(default=None),
+) -> List[Union[TimeseriesSummary, Timeseries]]:
+    """
+    Get the timeseries owned by a user.
+    :param `summary`: return the count, time range and value range of the timeseries instead of their data
+    :param `fields`: fields of the timeseries or their summaries to return, all of them if not given
+    """
+    projection = get_projection(TimeseriesSummary if summary else Timeseries, fields)
+    timeseries = await paginate(
+        response, Timeseries, cursor, page, page_size, owner=address
+    )
+    return summarize_timeseries(timeseries, summary, projection, response)
+
+
+@app.get("/executions/{execution_id}/possible_execution_count")
+async def get_possible_execution_count(execution_id: str) -> Optional[int]:
+    """
     This endpoint returns the number of times the execution can be executed.
     This is the maximum number of times
     the algorithm can be executed on the dataset, given the permissions of each timeseries.
     It can only be executed
     as many times as the least available timeseries can be executed.
+    Returns `null` if there is no limit, i.e. the execution owner owns all the timeseries
+    or was granted permissions without a maximum execution count.
+    """
+    execution = await Execution.fetch(execution_id).first()
+    if execution is None:
+        raise HTTPException(status_code=404, detail="No Execution found")
+    return indices.permissions.get_count(execution.owner, execution.datasetID)
+
+
+@app.get("/executions/{execution_id}/stream")
+async def stream_execution_results(
+        execution_id: str, last_event_id: Optional[str] = Header(default=None)
+) -> StreamingResponse:
     """
+    Streams the partial results of an execution as server-sent events: `status`
+    events when its status changes, a `chunk` event for every chunk of the values
+    yielded by its algorithm, with the index of the chunk as event id, and a final
+    `result` event with its `Result`. Streams end after `FISHNET_STREAM_MAX_DURATION`
+    seconds, and resume after the chunk given in the `Last-Event-ID` header.
+    """
+    execution = await Execution.fetch(execution_id).first()
+    if execution is None:
+        raise HTTPException(status_code=404, detail="No Execution found")
+    return StreamingResponse(
+        stream_execution(execution_id, watcher, parse_last_event_id(last_event_id)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+def raise_for_failures(report: SaveReport):
+    """Raises a 502 error with the outcome of every save if some of them failed."""
+    if report.ok:
+        return
+    items = [
+        SaveItemReport(
+            position=position,
+            type=type(outcome.record).__name__,
+            id_hash=outcome.record.id_hash,
+            saved=outcome.ok,
+            attempts=outcome.attempts,
+            error=None if outcome.ok else repr(outcome.error),
+        )
+        for position, outcome in enumerate(report.outcomes)
+    ]
+    raise HTTPException(
+        status_code=502,
+        detail=SaveReportResponse(
+            saved=len(report.saved), failed=len(report.failed), items=items
+        ).dict(),
+    )
+
 
-    return -1
+async def save_record(record: Record) -> Record:
+    """Saves a single record through a `SaveBatch`, to be retried like the others."""
+    batch = SaveBatch()
+    batch.add(record)
+    report = await batch.submit()
+    raise_for_failures(report)
+    return report.saved[0]
 
 
 @app.put("/timeseries/upload")
@@ -269,11 +589,11 @@ async def upload_timeseries(req: UploadTimeseriesRequest) -> List[Timeseries]:
     """
     Upload a list of timeseries. If the passed timeseries has an `id_hash` and it already exists,
     it will be overwritten. If the timeseries does not exist, it will be created.
-    A list of the created/updated timeseries is returned. If the list is shorter than the passed list, then
-    it might be that a passed timeseries contained illegal data.
+    A list of the created/updated timeseries is returned. If some timeseries could not be saved,
+    a 502 error is returned with the outcome of each save, so that only the failed ones need to be uploaded again.
     """
     ids_to_fetch = [ts.id_hash for ts in req.timeseries if ts.id_hash is not None]
-    requests = []
+    batch = SaveBatch()
     old_time_series = (
         {ts.id_hash: ts for ts in await Timeseries.fetch(ids_to_fetch).all()}
         if ids_to_fetch
@@ -281,7 +601,7 @@ async def upload_timeseries(req: UploadTimeseriesRequest) -> List[Timeseries]:
     )
     for ts in req.timeseries:
         if old_time_series.get(ts.id_hash) is None:
-            requests.append(Timeseries(**dict(ts)).save())
+            batch.add(Timeseries(**dict(ts)))
             continue
         old_ts: Timeseries = old_time_series[ts.id_hash]
         if ts.owner != old_ts.owner:
@@ -292,9 +612,10 @@ async def upload_timeseries(req: UploadTimeseriesRequest) -> List[Timeseries]:
         old_ts.name = ts.name
         old_ts.data = ts.data
         old_ts.desc = ts.desc
-        requests.append(old_ts.save())
-    upserted_timeseries = await asyncio.gather(*requests)
-    return [ts for ts in upserted_timeseries if not isinstance(ts, BaseException)]
+        batch.add(old_ts)
+    report = await batch.submit()
+    raise_for_failures(report)
+    return report.saved
 
 
 @app.put("/datasets/upload")
@@ -320,8 +641,8 @@ async def upload_dataset(dataset: UploadDatasetRequest) -> Dataset:
             old_dataset.desc = dataset.desc
             old_dataset.timeseriesIDs = dataset.timeseriesIDs
             old_dataset.ownsAllTimeseries = dataset.ownsAllTimeseries
-            return await old_dataset.save()
-    return await Dataset(**dataset.dict()).save()
+            return await save_record(old_dataset)
+    return await save_record(Dataset(**dataset.dict()))
 
 
 @app.put("/algorithms/upload")
@@ -341,8 +662,147 @@ async def upload_algorithm(algorithm: UploadAlgorithmRequest) -> Algorithm:
             old_algorithm.name = algorithm.name
             old_algorithm.desc = algorithm.desc
             old_algorithm.code = algorithm.code
-            return await old_algorithm.save()
-    return await Algorithm(**algorithm.dict()).save()
+            return await save_record(old_algorithm)
+    return await save_record(Algorithm(**algorithm.dict()))
+
+
+def get_permission_updates(
+        permission: Optional[Permission], executions: int
+) -> Optional[Permission]:
+    """
+    Returns the permission to save for a requestor to run `executions` more
+    executions on a timeseries, or None if `permission` allows it already.
+    A pending request is raised by `executions`, as the executions requested
+    before wait for the count it already asks for.
+    """
+    if permission is None:
+        return None
+    if permission.status == PermissionStatus.REQUESTED:
+        if permission.maxExecutionCount is None:
+            return None
+        permission.maxExecutionCount = (
+            max(permission.maxExecutionCount, permission.executionCount) + executions
+        )
+        return permission
+    needs_update = False
+    if permission.status == PermissionStatus.DENIED:
+        permission.status = PermissionStatus.REQUESTED
+        needs_update = True
+    remaining = remaining_executions(permission)
+    if remaining is not None and remaining < executions:
+        permission.maxExecutionCount = permission.executionCount + executions
+        permission.status = PermissionStatus.REQUESTED
+        needs_update = True
+    return permission if needs_update else None
+
+
+async def request_executions(
+        requests: List[RequestExecutionRequest], batch_id: Optional[str] = None
+) -> List[RequestExecutionResponse]:
+    """
+    Creates the executions of `requests` and the permission requests they need.
+    Datasets, timeseries and permissions are fetched once for all of them, and
+    the new records are saved in a single batch.
+    """
+    dataset_ids = sorted({request.datasetID for request in requests})
+    datasets = {
+        dataset.id_hash: dataset for dataset in await Dataset.fetch(dataset_ids).all()
+    }
+    missing = [dataset_id for dataset_id in dataset_ids if dataset_id not in datasets]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Datasets not found: {missing}")
+
+    def owns_all(request: RequestExecutionRequest) -> bool:
+        dataset = datasets[request.datasetID]
+        return dataset.owner == request.owner and dataset.ownsAllTimeseries
+
+    timeseries_ids = sorted(
+        {
+            timeseries_id
+            for request in requests
+            if not owns_all(request)
+            for timeseries_id in datasets[request.datasetID].timeseriesIDs
+        }
+    )
+    timeseries: Dict[str, Timeseries] = {}
+    permissions: Dict[Tuple[str, str], Permission] = {}
+    if timeseries_ids:
+        timeseries = {
+            ts.id_hash: ts for ts in await Timeseries.fetch(timeseries_ids).all()
+        }
+        permissions = {
+            (permission.requestor, permission.timeseriesID): permission
+            for permission in await where(
+                Permission,
+                timeseriesID=timeseries_ids,
+                requestor=sorted({request.owner for request in requests}),
+            ).all()
+        }
+
+    # timeseries of others that each execution needs a permission on
+    unavailable: Dict[int, List[Timeseries]] = {}
+    needed: Dict[int, List[Tuple[str, str]]] = {}
+    for position, request in enumerate(requests):
+        if owns_all(request):
+            continue
+        foreign = [
+            timeseries[timeseries_id]
+            for timeseries_id in datasets[request.datasetID].timeseriesIDs
+            if timeseries_id in timeseries
+            and timeseries[timeseries_id].owner != request.owner
+        ]
+        unavailable[position] = [ts for ts in foreign if not ts.available]
+        if not unavailable[position]:
+            needed[position] = [(request.owner, ts.id_hash) for ts in foreign]
+
+    executions_needing: Dict[Tuple[str, str], List[int]] = {}
+    for position, keys in needed.items():
+        for key in keys:
+            executions_needing.setdefault(key, []).append(position)
+
+    batch = SaveBatch()
+    requested: Dict[Tuple[str, str], Permission] = {}
+    for (requestor, timeseries_id), positions in executions_needing.items():
+        permission = permissions.get((requestor, timeseries_id))
+        if permission is None:
+            algorithm_ids = {requests[position].algorithmID for position in positions}
+            permission = Permission(
+                timeseriesID=timeseries_id,
+                algorithmID=algorithm_ids.pop() if len(algorithm_ids) == 1 else None,
+                owner=timeseries[timeseries_id].owner,
+                requestor=requestor,
+                status=PermissionStatus.REQUESTED,
+                executionCount=0,
+                maxExecutionCount=len(positions),
+            )
+        else:
+            permission = get_permission_updates(permission, len(positions))
+        if permission is not None:
+            requested[(requestor, timeseries_id)] = batch.add(permission)
+
+    responses = []
+    for position, request in enumerate(requests):
+        keys = needed.get(position, [])
+        if unavailable.get(position):
+            request.status = ExecutionStatus.DENIED
+        elif any(
+            key in requested or not is_usable(permissions[key]) for key in keys
+        ):
+            request.status = ExecutionStatus.REQUESTED
+        else:
+            request.status = ExecutionStatus.PENDING
+        execution = batch.add(Execution(**request.dict(), batchID=batch_id))
+        responses.append(
+            RequestExecutionResponse(
+                execution=execution,
+                permissionRequests=[requested[key] for key in keys if key in requested]
+                or None,
+                unavailableTimeseries=unavailable.get(position) or None,
+            )
+        )
+
+    raise_for_failures(await batch.submit())
+    return responses
 
 
 @app.post("/executions/request")
@@ -358,72 +818,20 @@ async def request_execution(
     unavailable timeseries are returned.
     If the user has all permissions, the execution is started and the execution is returned.
     """
-    dataset = await Dataset.fetch(execution.datasetID).first()
+    return (await request_executions([execution]))[0]
 
-    if dataset.owner == execution.owner and dataset.ownsAllTimeseries:
-        execution.status = ExecutionStatus.PENDING
-        return RequestExecutionResponse(
-            execution=await Execution(**execution.dict()).save()
-        )
 
-    requested_timeseries = await Timeseries.fetch(dataset.timeseriesIDs).all()
-    permissions = {
-        permission.timeseriesID: permission
-        for permission in await Permission.where_eq(
-            timeseriesID=dataset.timeseriesIDs, requestor=execution.owner
-        ).all()
-    }
-    requests = []
-    unavailable_timeseries = []
-    for ts in requested_timeseries:
-        if ts.owner == execution.owner:
-            continue
-        if not ts.available:
-            unavailable_timeseries.append(ts)
-        if requested_timeseries:
-            continue
-        if ts.id_hash not in permissions:
-            requests.append(
-                Permission(
-                    timeseriesID=ts.id_hash,
-                    algorithmID=execution.algorithmID,
-                    owner=ts.owner,
-                    requestor=execution.owner,
-                    status=PermissionStatus.REQUESTED,
-                    executionCount=0,
-                    maxExecutionCount=1,
-                ).save()
-            )
-        else:
-            permission = permissions[ts.id_hash]
-            needs_update = False
-            if permission.status == PermissionStatus.DENIED:
-                permission.status = PermissionStatus.REQUESTED
-                needs_update = True
-            if permission.maxExecutionCount <= permission.executionCount:
-                permission.maxExecutionCount = permission.executionCount + 1
-                permission.status = PermissionStatus.REQUESTED
-                needs_update = True
-            if needs_update:
-                requests.append(permission.save())
-    if unavailable_timeseries:
-        execution.status = ExecutionStatus.DENIED
-        return RequestExecutionResponse(
-            execution=await Execution(**execution.dict()).save(),
-            unavailableTimeseries=unavailable_timeseries,
-        )
-    if requests:
-        new_permission_requests = await asyncio.gather(*requests)
-        execution.status = ExecutionStatus.REQUESTED
-        return RequestExecutionResponse(
-            execution=await Execution(**execution.dict()).save(),
-            permissionRequests=new_permission_requests,
-        )
-    else:
-        execution.status = ExecutionStatus.PENDING
-        return RequestExecutionResponse(
-            execution=await Execution(**execution.dict()).save()
-        )
+@app.post("/executions/request/batch")
+async def request_execution_batch(
+        request: RequestExecutionBatchRequest,
+) -> List[RequestExecutionResponse]:
+    """
+    Requests the executions of an algorithm over several datasets, or of several algorithms over a dataset,
+    like `/executions/request` does for each of them. The permissions needed are requested once for all of
+    them. The executions share a batch id, so that executors run them together and load their shared inputs
+    only once.
+    """
+    return await request_executions(request.get_requests(), batch_id=uuid4().hex)
 
 
 @app.put("/permissions/approve")
@@ -432,37 +840,18 @@ async def approve_permissions(permission_hashes: List[str]) -> List[Permission]:
     Approve permission.
     This EndPoint will approve a list of permissions by their item hashes
     If an 'id_hashes' is provided, it will change all the Permission status
-    to 'Granted'.
+    to 'Granted'. The requested executions of the requestors which are then
+    authorized on all the timeseries of their dataset are set to 'Pending'.
     """
-
-    ts_ids = []
-    requests = []
-
     permission_records = await Permission.fetch(permission_hashes).all()
     if not permission_records:
         raise HTTPException(
             status_code=404, detail="No Permission Found with this Hashes"
         )
-
-    for rec in permission_records:
-        rec.status = PermissionStatus.GRANTED
-        ts_ids.append(rec.timeseriesID)
-        requests.append(rec.save())
-
-    ds_ids = []
-    dataset_records = await Dataset.where_eq(timeseriesIDs=ts_ids).all()
-    if not dataset_records:
-        raise HTTPException(status_code=404, detail="No Dataset found")
-    for rec in dataset_records:
-        if rec.id_hash in ds_ids:
-            ds_ids.append(rec.id_hash)
-
-    executions_records = await Execution.where_eq(datasetID=ds_ids).all()
-    for rec in executions_records:
-        if ds_ids and rec.datasetID in ds_ids:
-            rec.status = ExecutionStatus.PENDING
-            requests.append(rec.save())
-    await asyncio.gather(*requests)
+    transition = await transition_permissions(
+        permission_records, PermissionStatus.GRANTED
+    )
+    raise_for_failures(transition.report)
     return permission_records
 
 
@@ -472,33 +861,18 @@ async def deny_permissions(permission_hashes: List[str]) -> List[Permission]:
     Deny permission.
     This EndPoint will deny a list of permissions by their item hashes
     If an `id_hashes` is provided, it will change all the Permission status
-    to 'Denied'.
+    to 'Denied'. The executions of the requestors waiting on these permissions
+    are set to 'Denied'.
     """
     permission_records = await Permission.fetch(permission_hashes).all()
     if not permission_records:
         raise HTTPException(
             status_code=404, detail="No Permission found with this Hashes"
         )
-
-    ts_ids = []
-    requests = []
-    for rec in permission_records:
-        rec.status = PermissionStatus.DENIED
-        ts_ids.append(rec.timeseriesID)
-        requests.append(rec.save())
-    dataset_records = await Dataset.where_eq(timeseriesIDs=ts_ids).all()
-    ds_ids = []
-    if not dataset_records:
-        raise HTTPException(status_code=424, detail="No Timeseries found")
-    for rec in dataset_records:
-        ds_ids.append(rec.id_hash)
-    executions_records = await Execution.where_eq(datasetID=ds_ids).all()
-    for rec in executions_records:
-        if rec.datasetID in ds_ids and rec.status == ExecutionStatus.PENDING:
-            rec.status = ExecutionStatus.DENIED
-            requests.append(rec.save())
-
-    await asyncio.gather(*requests)
+    transition = await transition_permissions(
+        permission_records, PermissionStatus.DENIED
+    )
+    raise_for_failures(transition.report)
     return permission_records
 
 
@@ -511,12 +885,12 @@ async def set_dataset_available(dataset_id: str, available: bool) -> Dataset:
     param 'available':put the Boolean value
     """
 
-    requests = []
+    batch = SaveBatch()
     dataset = await Dataset.fetch(dataset_id).first()
     if not dataset:
         raise HTTPException(status_code=404, detail="No Dataset found")
     dataset.available = available
-    requests.append(dataset.save())
+    batch.add(dataset)
 
     ts_list = await Timeseries.fetch(dataset.timeseriesIDs).all()
     if not ts_list:
@@ -525,14 +899,14 @@ async def set_dataset_available(dataset_id: str, available: bool) -> Dataset:
     for rec in ts_list:
         if rec.available != available:
             rec.available = available
-            requests.append(rec.save())
+            batch.add(rec)
     executions_records = await Execution.fetch(dataset_id).all()
     for rec in executions_records:
         if rec.status == ExecutionStatus.PENDING:
             rec.status = ExecutionStatus.DENIED
-            requests.append(rec.save())
+            batch.add(rec)
 
-    await asyncio.gather(*requests)
+    raise_for_failures(await batch.submit())
     return dataset
 
 
@@ -546,24 +920,41 @@ filters = [
             "Dataset",
             "Timeseries",
             "Algorithm",
+            "Result",
+            "ResultChunk",
             "amend",
         ],
     }
 ]
 
 
+async def apply_events(messages: List[PostMessage]):
+    posted = {message.item_hash for message in messages}
+    # amends of records posted before the indices were synchronized
+    unknown = {
+        message.content.ref
+        for message in messages
+        if message.content.type == "amend"
+        and message.content.ref not in indices.record_types
+        and message.content.ref not in posted
+    }
+    originals = await asyncio.gather(
+        *[
+            AARS.session.get_message(item_hash=ref, message_type=PostMessage)
+            for ref in unknown
+        ]
+    )
+    for message in [*originals, *messages]:
+        record = reindexer.apply_event(message)
+        if isinstance(record, Execution):
+            watcher.notify(record.id_hash)
+        elif isinstance(record, ResultChunk):
+            watcher.notify(record.executionID)
+
+
+events = EventQueue(apply_events)
+
+
 @app.event(filters=filters)
 async def fishnet_event(event: PostMessage):
-    print("fishnet_event", event)
-    if event.content.type in [
-        "Execution",
-        "Permission",
-        "Dataset",
-        "Timeseries",
-        "Algorithm",
-    ]:
-        cls: Record = globals()[event.content.type]
-        record = await cls.from_post(event)
-    else:
-        record = Record.fetch(event.content.ref)
-    [index.add_record(record) for index in record.get_indices()]
+    events.put(event)
@@ -0,0 +1,369 @@
+"""
+Aggregates of the permissions granted to requestors on datasets.
+
+The number of times a requestor can still execute algorithms on a dataset is
+the minimum, over the timeseries of the dataset, of the executions left on the
+permissions granted to them. It is maintained for every (requestor, dataset)
+pair from the records applied to the indices, so that it does not need to be
+computed from all the permissions of the dataset on every request.
+
+Permissions are granted and denied in batches, which also move the executions
+waiting for them, with a single lookup of the affected datasets, executions
+and permissions.
+"""
+
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from aars import Record
+from pydantic import BaseModel
+
+from fishnet_cod import (
+    Dataset,
+    Execution,
+    ExecutionStatus,
+    Permission,
+    PermissionStatus,
+    SaveBatch,
+    SaveReport,
+    Timeseries,
+    where,
+)
+from fishnet_cod.index import lookup
+
+
+def remaining_executions(permission: Permission) -> Optional[int]:
+    """Executions left on a granted permission, None if it has no limit."""
+    if permission.maxExecutionCount is None:
+        return None
+    return max(permission.maxExecutionCount - permission.executionCount, 0)
+
+
+def min_count(counts: Iterable[Optional[int]]) -> Optional[int]:
+    """Minimum of execution counts, where None stands for no limit."""
+    limited = [count for count in counts if count is not None]
+    return min(limited) if limited else None
+
+
+class TimeseriesState(BaseModel):
+    owner: str
+    available: bool = True
+
+
+class DatasetState(BaseModel):
+    owner: str
+    available: bool = True
+    ownsAllTimeseries: bool = False
+    timeseriesIDs: List[str] = []
+
+
+class PermissionMatrixSnapshot(BaseModel):
+    timeseries: Dict[str, TimeseriesState] = {}
+    datasets: Dict[str, DatasetState] = {}
+    # (requestor, timeseries id, permission id, remaining executions)
+    grants: List[Tuple[str, str, str, Optional[int]]] = []
+
+
+class PermissionMatrix:
+    """
+    Executions left per (requestor, dataset), updated incrementally as
+    permissions, datasets and timeseries are posted or amended.
+    """
+
+    def __init__(self):
+        self.timeseries: Dict[str, TimeseriesState] = {}
+        self.datasets: Dict[str, DatasetState] = {}
+        # (requestor, timeseries id) -> permission id -> remaining executions
+        self.grants: Dict[Tuple[str, str], Dict[str, Optional[int]]] = {}
+        # permission id -> (requestor, timeseries id), to move amended permissions
+        self.granted_on: Dict[str, Tuple[str, str]] = {}
+        # timeseries id -> requestors with grants on it
+        self.requestors_by_timeseries: Dict[str, Set[str]] = {}
+        self.datasets_by_timeseries: Dict[str, Set[str]] = {}
+        # (requestor, dataset id) -> remaining executions
+        self.counts: Dict[Tuple[str, str], Optional[int]] = {}
+        self.requestors_by_dataset: Dict[str, Set[str]] = {}
+
+    def get_count(self, requestor: str, dataset_id: str) -> Optional[int]:
+        """
+        Returns how many more times `requestor` can execute an algorithm on the
+        dataset, or None if there is no limit.
+        """
+        key = (requestor, dataset_id)
+        if key not in self.counts:
+            self.update_count(requestor, dataset_id)
+        return self.counts[key]
+
+    def compute_count(self, requestor: str, dataset_id: str) -> Optional[int]:
+        dataset = self.datasets.get(dataset_id)
+        if dataset is None or not dataset.available:
+            return 0
+        if dataset.owner == requestor and dataset.ownsAllTimeseries:
+            return None
+        counts = []
+        for timeseries_id in dataset.timeseriesIDs:
+            timeseries = self.timeseries.get(timeseries_id)
+            if timeseries is not None:
+                if not timeseries.available:
+                    return 0
+                if timeseries.owner == requestor:
+                    continue
+            grants = self.grants.get((requestor, timeseries_id))
+            if not grants:
+                return 0
+            counts.append(self.max_grant(grants.values()))
+        return min_count(counts)
+
+    @staticmethod
+    def max_grant(counts: Iterable[Optional[int]]) -> Optional[int]:
+        counts = list(counts)
+        if None in counts:
+            return None
+        return max(counts)
+
+    def update_count(self, requestor: str, dataset_id: str):
+        self.counts[(requestor, dataset_id)] = self.compute_count(requestor, dataset_id)
+        self.requestors_by_dataset.setdefault(dataset_id, set()).add(requestor)
+
+    def update_dataset_counts(self, dataset_id: str, requestors: Iterable[str]):
+        for requestor in list(requestors):
+            self.update_count(requestor, dataset_id)
+
+    def apply_record(self, record: Record):
+        """Updates the matrix with the latest revision of `record`."""
+        if isinstance(record, Permission):
+            self.apply_permission(record)
+        elif isinstance(record, Dataset):
+            self.apply_dataset(record)
+        elif isinstance(record, Timeseries):
+            self.apply_timeseries(record)
+
+    def add_grant(self, key: Tuple[str, str], permission_id: str, count: Optional[int]):
+        self.grants.setdefault(key, {})[permission_id] = count
+        self.granted_on[permission_id] = key
+        requestor, timeseries_id = key
+        self.requestors_by_timeseries.setdefault(timeseries_id, set()).add(requestor)
+
+    def remove_grant(self, key: Tuple[str, str], permission_id: str):
+        grants = self.grants[key]
+        grants.pop(permission_id, None)
+        if not grants:
+            del self.grants[key]
+            requestor, timeseries_id = key
+            requestors = self.requestors_by_timeseries[timeseries_id]
+            requestors.discard(requestor)
+            if not requestors:
+                del self.requestors_by_timeseries[timeseries_id]
+
+    def apply_permission(self, permission: Permission):
+        key = (permission.requestor, permission.timeseriesID)
+        previous_key = self.granted_on.pop(permission.id_hash, None)
+        if previous_key is not None:
+            self.remove_grant(previous_key, permission.id_hash)
+        if permission.status == PermissionStatus.GRANTED:
+            self.add_grant(key, permission.id_hash, remaining_executions(permission))
+        for requestor, timeseries_id in {key, previous_key} - {None}:
+            for dataset_id in self.datasets_by_timeseries.get(timeseries_id, ()):
+                self.update_count(requestor, dataset_id)
+
+    def apply_dataset(self, dataset: Dataset):
+        state = DatasetState(
+            owner=dataset.owner,
+            available=dataset.available,
+            ownsAllTimeseries=dataset.ownsAllTimeseries,
+            timeseriesIDs=dataset.timeseriesIDs,
+        )
+        previous = self.datasets.get(dataset.id_hash)
+        if previous == state:
+            return
+        if previous is not None:
+            for timeseries_id in set(previous.timeseriesIDs) - set(state.timeseriesIDs):
+                self.datasets_by_timeseries[timeseries_id].discard(dataset.id_hash)
+        self.datasets[dataset.id_hash] = state
+        for timeseries_id in state.timeseriesIDs:
+            self.datasets_by_timeseries.setdefault(timeseries_id, set()).add(
+                dataset.id_hash
+            )
+        # only the cells of the requestors with grants on its timeseries, or
+        # with a count already computed, can change
+        requestors = set(self.requestors_by_dataset.get(dataset.id_hash, ()))
+        for timeseries_id in state.timeseriesIDs:
+            requestors.update(self.requestors_by_timeseries.get(timeseries_id, ()))
+        self.update_dataset_counts(dataset.id_hash, requestors)
+
+    def apply_timeseries(self, timeseries: Timeseries):
+        state = TimeseriesState(owner=timeseries.owner, available=timeseries.available)
+        if self.timeseries.get(timeseries.id_hash) == state:
+            return
+        self.timeseries[timeseries.id_hash] = state
+        for dataset_id in self.datasets_by_timeseries.get(timeseries.id_hash, ()):
+            self.update_dataset_counts(
+                dataset_id, self.requestors_by_dataset.get(dataset_id, ())
+            )
+
+    def dump(self) -> PermissionMatrixSnapshot:
+        return PermissionMatrixSnapshot(
+            timeseries=self.timeseries,
+            datasets=self.datasets,
+            grants=[
+                (requestor, timeseries_id, permission_id, count)
+                for (requestor, timeseries_id), grants in self.grants.items()
+                for permission_id, count in grants.items()
+            ],
+        )
+
+    @classmethod
+    def restore(cls, snapshot: PermissionMatrixSnapshot) -> "PermissionMatrix":
+        """Rebuilds a matrix from `snapshot`, the counts being computed on demand."""
+        matrix = cls()
+        matrix.timeseries = dict(snapshot.timeseries)
+        matrix.datasets = dict(snapshot.datasets)
+        for dataset_id, dataset in matrix.datasets.items():
+            for timeseries_id in dataset.timeseriesIDs:
+                matrix.datasets_by_timeseries.setdefault(timeseries_id, set()).add(
+                    dataset_id
+                )
+        for requestor, timeseries_id, permission_id, count in snapshot.grants:
+            matrix.add_grant((requestor, timeseries_id), permission_id, count)
+        return matrix
+
+
+def is_usable(permission: Permission) -> bool:
+    """Whether the permission is granted and has executions left."""
+    if permission.status != PermissionStatus.GRANTED:
+        return False
+    count = remaining_executions(permission)
+    return count is None or count > 0
+
+
+@dataclass
+class PermissionTransition:
+    permissions: List[Permission] = field(default_factory=list)  # status changed
+    executions: List[Execution] = field(default_factory=list)  # status changed
+    report: SaveReport = field(default_factory=SaveReport)
+
+
+async def get_authorized_executions(
+    executions: List[Execution],
+    datasets: Dict[str, Dataset],
+    changed_permissions: List[Permission],
+) -> List[Execution]:
+    """
+    Returns the `executions` whose requestor has now usable permissions on all
+    the timeseries of their dataset that they do not own. Oldest first, at most
+    as many executions as a permission has left are authorized on it.
+    """
+    requestors = sorted({execution.owner for execution in executions})
+    timeseries_ids = sorted(
+        {
+            timeseries_id
+            for execution in executions
+            for timeseries_id in datasets[execution.datasetID].timeseriesIDs
+        }
+    )
+    permissions = {
+        permission.id_hash: permission
+        for permission in await where(
+            Permission, requestor=requestors, timeseriesID=timeseries_ids
+        ).all()
+    }
+    permissions.update(
+        {permission.id_hash: permission for permission in changed_permissions}
+    )
+    # (requestor, timeseries) -> executions left on its usable permissions,
+    # None if one has no limit
+    remaining: Dict[Tuple[str, str], Optional[int]] = {}
+    for permission in permissions.values():
+        if not is_usable(permission):
+            continue
+        key = (permission.requestor, permission.timeseriesID)
+        count = remaining_executions(permission)
+        if count is None or remaining.get(key, 0) is None:
+            remaining[key] = None
+        else:
+            remaining[key] = remaining.get(key, 0) + count
+    owned = {
+        requestor: lookup(Timeseries, owner=requestor)[0] for requestor in requestors
+    }
+
+    authorized = []
+    for execution in sorted(executions, key=lambda e: (e.timestamp or 0, e.id_hash)):
+        dataset = datasets[execution.datasetID]
+        if dataset.owner == execution.owner and dataset.ownsAllTimeseries:
+            authorized.append(execution)
+            continue
+        keys = [
+            (execution.owner, timeseries_id)
+            for timeseries_id in dataset.timeseriesIDs
+            if timeseries_id not in owned[execution.owner]
+        ]
+        if all(key in remaining and remaining[key] != 0 for key in keys):
+            for key in keys:
+                if remaining[key] is not None:
+                    remaining[key] -= 1
+            authorized.append(execution)
+    return authorized
+
+
+async def transition_permissions(
+    permissions: List[Permission], status: PermissionStatus
+) -> PermissionTransition:
+    """
+    Sets the status of `permissions` and updates the executions waiting for them:
+    granting permissions moves the requested executions which became fully
+    authorized to PENDING, denying them moves the waiting executions of their
+    requestors to DENIED. Only the records whose status changed are saved.
+    """
+    changed = [permission for permission in permissions if permission.status != status]
+    for permission in changed:
+        permission.status = status
+    if not changed:
+        return PermissionTransition()
+
+    requestors = {permission.requestor for permission in changed}
+    changed_on = {
+        (permission.requestor, permission.timeseriesID) for permission in changed
+    }
+    datasets = {
+        dataset.id_hash: dataset
+        for dataset in await where(
+            Dataset,
+            timeseriesIDs=sorted({permission.timeseriesID for permission in changed}),
+        ).all()
+    }
+
+    executions: List[Execution] = []
+    if datasets:
+        if status == PermissionStatus.GRANTED:
+            waiting = [ExecutionStatus.REQUESTED]
+        else:
+            waiting = [ExecutionStatus.REQUESTED, ExecutionStatus.PENDING]
+        executions = [
+            execution
+            for execution in await where(
+                Execution,
+                datasetID=sorted(datasets),
+                owner=sorted(requestors),
+                status=waiting,
+            ).all()
+            # the status bucket may be stale, finished executions must not move
+            if execution.status in waiting
+            and any(
+                (execution.owner, timeseries_id) in changed_on
+                for timeseries_id in datasets[execution.datasetID].timeseriesIDs
+            )
+        ]
+
+    if status == PermissionStatus.GRANTED:
+        executions = await get_authorized_executions(executions, datasets, changed)
+        execution_status = ExecutionStatus.PENDING
+    else:
+        execution_status = ExecutionStatus.DENIED
+    for execution in executions:
+        execution.status = execution_status
+
+    batch = SaveBatch()
+    batch.extend([*changed, *executions])
+    return PermissionTransition(
+        permissions=changed, executions=executions, report=await batch.submit()
+    )
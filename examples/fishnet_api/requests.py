@@ -1,7 +1,7 @@
-from typing import List, Optional, Tuple
+from typing import List, Optional, Tuple, Union
 
-from fishnet_cod import Execution, Permission, Timeseries
-from pydantic import BaseModel
+from fishnet_cod import Execution, ParamsMode, Permission, Timeseries
+from pydantic import BaseModel, root_validator
 
 
 class TimeseriesItem(BaseModel):
@@ -33,11 +33,75 @@ class UploadAlgorithmRequest(BaseModel):
     code: str
 
 
+def check_params(cls, values):
+    """Checks that `params` has the shape `paramsMode` expects."""
+    params, mode = values["params"], values["paramsMode"]
+    if mode == ParamsMode.SINGLE and not isinstance(params, (dict, type(None))):
+        raise ValueError("SINGLE params must be a parameter set")
+    if mode == ParamsMode.LIST and not isinstance(params, (list, type(None))):
+        raise ValueError("LIST params must be a list of parameter sets")
+    if mode == ParamsMode.GRID and not (
+        params is None
+        or isinstance(params, dict)
+        and all(isinstance(param_values, list) for param_values in params.values())
+    ):
+        raise ValueError("GRID params must map parameters to lists of values")
+    if values["parallelism"] is not None and values["parallelism"] < 1:
+        raise ValueError("parallelism must be at least 1")
+    return values
+
+
 class RequestExecutionRequest(BaseModel):
     algorithmID: str
     datasetID: str
     owner: str
     status: Optional[str]
+    priority: int = 0
+    cpuTimeLimit: Optional[float]
+    wallTimeLimit: Optional[float]
+    memoryLimit: Optional[int]
+    params: Optional[Union[List[dict], dict]]
+    paramsMode: ParamsMode = ParamsMode.SINGLE
+    parallelism: Optional[int]
+
+    _check_params = root_validator(skip_on_failure=True, allow_reuse=True)(check_params)
+
+
+class RequestExecutionBatchRequest(BaseModel):
+    """Executions of an algorithm over several datasets, or of several algorithms over a dataset."""
+
+    algorithmIDs: List[str]
+    datasetIDs: List[str]
+    owner: str
+    priority: int = 0
+    cpuTimeLimit: Optional[float]
+    wallTimeLimit: Optional[float]
+    memoryLimit: Optional[int]
+    params: Optional[Union[List[dict], dict]]
+    paramsMode: ParamsMode = ParamsMode.SINGLE
+    parallelism: Optional[int]
+
+    @root_validator(skip_on_failure=True)
+    def check_single_side(cls, values):
+        if not values["algorithmIDs"] or not values["datasetIDs"]:
+            raise ValueError("At least one algorithm and one dataset are required")
+        if len(values["algorithmIDs"]) != 1 and len(values["datasetIDs"]) != 1:
+            raise ValueError(
+                "Either a single algorithm or a single dataset is required"
+            )
+        return values
+
+    _check_params = root_validator(skip_on_failure=True, allow_reuse=True)(check_params)
+
+    def get_requests(self) -> List[RequestExecutionRequest]:
+        fields = self.dict(exclude={"algorithmIDs", "datasetIDs"})
+        return [
+            RequestExecutionRequest(
+                algorithmID=algorithm_id, datasetID=dataset_id, **fields
+            )
+            for algorithm_id in self.algorithmIDs
+            for dataset_id in self.datasetIDs
+        ]
 
 
 class ExecutionStatusHistory(BaseModel):
@@ -55,3 +119,49 @@ class RequestExecutionResponse(BaseModel):
     execution: Execution
     permissionRequests: Optional[List[Permission]]
     unavailableTimeseries: Optional[List[Timeseries]]
+
+
+class SaveItemReport(BaseModel):
+    position: int  # position of the record among the saved ones
+    type: str
+    id_hash: Optional[str]
+    saved: bool
+    attempts: int
+    error: Optional[str]
+
+
+class SaveReportResponse(BaseModel):
+    saved: int
+    failed: int
+    items: List[SaveItemReport]
+
+
+class TimeseriesSummary(BaseModel):
+    """A timeseries without its data, but the count and bounds of its points."""
+
+    id_hash: Optional[str]
+    name: str
+    owner: str
+    desc: Optional[str]
+    available: bool
+    count: int
+    first: Optional[int]  # earliest timestamp
+    last: Optional[int]  # latest timestamp
+    min: Optional[float]
+    max: Optional[float]
+
+    @classmethod
+    def from_timeseries(cls, timeseries: Timeseries) -> "TimeseriesSummary":
+        timestamps, values = zip(*timeseries.data) if timeseries.data else ((), ())
+        return cls(
+            id_hash=timeseries.id_hash,
+            name=timeseries.name,
+            owner=timeseries.owner,
+            desc=timeseries.desc,
+            available=timeseries.available,
+            count=len(timestamps),
+            first=min(timestamps, default=None),
+            last=max(timestamps, default=None),
+            min=min(values, default=None),
+            max=max(values, default=None),
+        )
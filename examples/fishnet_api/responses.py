@@ -0,0 +1,302 @@
+"""
+JSON responses rendered with orjson, straight from the records returned by the
+endpoints.
+
+FastAPI validates what endpoints return against their response model, then
+converts it to plain Python objects with `jsonable_encoder` before encoding it,
+copying every record and every point of timeseries data twice. Routes of the API
+skip both steps when what they return already is an instance of their response
+model, and let orjson encode the records, their fields being read from the
+models as they are. The revision metadata of records, which clients have no use
+for, is left out. NumPy arrays and scalars are encoded natively.
+
+Clients accepting MessagePack (`Accept: application/msgpack`) get responses in
+this format instead, and can send request bodies in it. In MessagePack, the
+points of timeseries are sent as two columns, `timestamps` and `values`, of
+little-endian int64 and float64 binary arrays, instead of a `data` list of pairs.
+"""
+
+import functools
+import inspect
+import sys
+from array import array
+from contextvars import ContextVar
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    get_args,
+    get_origin,
+)
+
+import msgpack
+import orjson
+from aars import Record
+from fastapi import HTTPException
+from fastapi.routing import APIRoute
+from pydantic import BaseModel, ValidationError
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+from fishnet_cod import Timeseries
+
+from .compression import parse_qualities
+
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+MSGPACK_MEDIA_TYPES = ["application/msgpack", "application/x-msgpack"]
+
+# Media type negotiated for the response of the request being handled
+response_media_type: ContextVar[str] = ContextVar(
+    "response_media_type", default="application/json"
+)
+
+
+# Fields of records kept by AARS to track their revisions, not sent to clients
+RECORD_INTERNAL_FIELDS = frozenset({"forgotten", "current_revision", "revision_hashes"})
+
+
+def model_fields(obj: BaseModel) -> Dict[str, Any]:
+    """Field values of `obj`, without copying them like `obj.dict()`."""
+    if isinstance(obj, Record):
+        return {
+            name: value
+            for name, value in obj.__dict__.items()
+            if name not in RECORD_INTERNAL_FIELDS
+        }
+    return obj.__dict__
+
+
+def default(obj: Any) -> Any:
+    if isinstance(obj, BaseModel):
+        return model_fields(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=default, option=ORJSON_OPTIONS)
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def pack_points(points: List[Tuple[int, float]]) -> Tuple[bytes, bytes]:
+    """Returns the timestamps and values of `points` as little-endian binary arrays."""
+    timestamps = array("q", [point[0] for point in points])
+    values = array("d", [point[1] for point in points])
+    if sys.byteorder == "big":
+        timestamps.byteswap()
+        values.byteswap()
+    return timestamps.tobytes(), values.tobytes()
+
+
+def unpack_points(timestamps: bytes, values: bytes) -> List[Tuple[int, float]]:
+    timestamp_array = array("q")
+    value_array = array("d")
+    timestamp_array.frombytes(timestamps)
+    value_array.frombytes(values)
+    if len(timestamp_array) != len(value_array):
+        raise ValueError("Timestamps and values have different lengths")
+    if sys.byteorder == "big":
+        timestamp_array.byteswap()
+        value_array.byteswap()
+    return list(zip(timestamp_array, value_array))
+
+
+def msgpack_default(obj: Any) -> Any:
+    if isinstance(obj, Timeseries):
+        fields = {
+            name: value for name, value in model_fields(obj).items() if name != "data"
+        }
+        fields["timestamps"], fields["values"] = pack_points(obj.data)
+        return fields
+    if isinstance(obj, BaseModel):
+        return model_fields(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if hasattr(obj, "tolist"):  # NumPy arrays and scalars
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} cannot be packed")
+
+
+def columns_to_points(obj: Dict[str, Any]) -> Dict[str, Any]:
+    """Turns `timestamps` and `values` binary columns back into `data` points."""
+    timestamps = obj.get("timestamps")
+    values = obj.get("values")
+    if isinstance(timestamps, bytes) and isinstance(values, bytes):
+        obj = {
+            name: value
+            for name, value in obj.items()
+            if name not in ("timestamps", "values")
+        }
+        obj["data"] = unpack_points(timestamps, values)
+    return obj
+
+
+def unpackb(body: bytes) -> Any:
+    return msgpack.unpackb(
+        body, object_hook=columns_to_points, raw=False, strict_map_key=False
+    )
+
+
+class MsgpackResponse(Response):
+    media_type = "application/msgpack"
+
+    def render(self, content: Any) -> bytes:
+        return msgpack.packb(content, default=msgpack_default, use_bin_type=True)
+
+
+def negotiate_media_type(accept: Optional[str]) -> str:
+    """Returns MessagePack if preferred over JSON by an `Accept` header."""
+    if not accept:
+        return "application/json"
+    qualities = parse_qualities(accept)
+    msgpack_quality = max(
+        qualities.get(media_type, 0.0) for media_type in MSGPACK_MEDIA_TYPES
+    )
+    json_quality = qualities.get(
+        "application/json", qualities.get("application/*", qualities.get("*/*", 0.0))
+    )
+    if msgpack_quality > 0 and msgpack_quality >= json_quality:
+        return MSGPACK_MEDIA_TYPES[0]
+    return "application/json"
+
+
+class MsgpackRequest(Request):
+    """Request with a MessagePack body, which is decoded in place of JSON."""
+
+    def __init__(self, scope, receive):
+        scope = dict(scope)
+        scope["headers"] = [
+            (key, b"application/json" if key == b"content-type" else value)
+            for key, value in scope["headers"]
+        ]
+        super().__init__(scope, receive)
+
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            try:
+                self._json = unpackb(await self.body())
+            except (ValueError, msgpack.UnpackException) as error:
+                raise HTTPException(
+                    status_code=400, detail=f"Invalid MessagePack body: {error}"
+                )
+        return self._json
+
+
+def conforms(content: Any, annotation: Any) -> bool:
+    """
+    Whether `content` already is of the type `annotation`, checking the type of
+    models without validating their fields again, and of each item of lists.
+    """
+    if annotation is Any:
+        return True
+    origin = get_origin(annotation)
+    args = get_args(annotation)
+    if origin is Union:
+        return any(conforms(content, arg) for arg in args)
+    if origin is list:
+        return isinstance(content, list) and all(
+            conforms(item, args[0]) for item in content
+        )
+    if origin is tuple:
+        if not isinstance(content, tuple):
+            return False
+        if len(args) == 2 and args[1] is Ellipsis:
+            return all(conforms(item, args[0]) for item in content)
+        return len(content) == len(args) and all(
+            conforms(item, arg) for item, arg in zip(content, args)
+        )
+    if annotation is type(None):
+        return content is None
+    if isinstance(annotation, type) and origin is None:
+        return isinstance(content, annotation)
+    return False
+
+
+def negotiated_response(
+    content: Any, status_code: int = 200, headers: Optional[Dict[str, str]] = None
+) -> Response:
+    """Responds with `content` in the media type negotiated for the request."""
+    if response_media_type.get() in MSGPACK_MEDIA_TYPES:
+        return MsgpackResponse(content, status_code=status_code, headers=headers)
+    return FastJSONResponse(content, status_code=status_code, headers=headers)
+
+
+class FastJSONRoute(APIRoute):
+    """
+    Route responding with a `FastJSONResponse` of what its endpoint returns, or a
+    `MsgpackResponse` if the client prefers it. What does not conform to the
+    response model already is validated against it, as FastAPI does. Headers and
+    status code set on a `Response` parameter of the endpoint are kept.
+    """
+
+    def get_route_handler(self):
+        if not getattr(self.dependant.call, "renders_json", False):
+            self.dependant.call = self.wrap_endpoint(self.dependant.call)
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request) -> Response:
+            content_type = request.headers.get("content-type", "")
+            if content_type.split(";")[0].strip().lower() in MSGPACK_MEDIA_TYPES:
+                request = MsgpackRequest(request.scope, request.receive)
+            token = response_media_type.set(
+                negotiate_media_type(request.headers.get("accept"))
+            )
+            try:
+                return await handler(request)
+            finally:
+                response_media_type.reset(token)
+
+        return route_handler
+
+    def enforce_response_model(self, content: Any) -> Any:
+        if self.response_field is None or conforms(content, self.response_model):
+            return content
+        value, errors = self.secure_cloned_response_field.validate(
+            content, {}, loc=("response",)
+        )
+        if errors:
+            errors = errors if isinstance(errors, list) else [errors]
+            raise ValidationError(errors, self.response_field.type_)
+        return value
+
+    def make_response(self, content: Any, values: dict) -> Response:
+        if isinstance(content, Response):
+            return content
+        content = self.enforce_response_model(content)
+        sub_response: Optional[Response] = None
+        if self.dependant.response_param_name:
+            sub_response = values.get(self.dependant.response_param_name)
+        status_code = self.status_code or 200
+        if sub_response is not None and sub_response.status_code:
+            status_code = sub_response.status_code
+        response = negotiated_response(content, status_code=status_code)
+        if sub_response is not None:
+            response.headers.raw.extend(sub_response.headers.raw)
+        return response
+
+    def wrap_endpoint(self, call: Callable) -> Callable:
+        if inspect.iscoroutinefunction(call):
+
+            @functools.wraps(call)
+            async def endpoint(**values):
+                return self.make_response(await call(**values), values)
+
+        else:
+
+            @functools.wraps(call)
+            async def endpoint(**values):
+                content = await run_in_threadpool(call, **values)
+                return self.make_response(content, values)
+
+        endpoint.renders_json = True
+        return endpoint
@@ -0,0 +1,172 @@
+"""
+Streaming of the partial results of executions as server-sent events.
+
+Algorithms whose `run` is a generator have the values they yield saved by the
+executor as `ResultChunk` records while they run. A stream sends the chunks of
+an execution as `chunk` events, in order and with their index as event id, the
+changes of its status as `status` events, and ends with a `result` event once
+it finished and all its chunks were sent.
+
+Streams are woken up when the records of their execution are indexed, instead
+of polling the channel. They end after `STREAM_MAX_DURATION` seconds, as the
+VM runtime only forwards a response once complete, and clients resume them
+from the last chunk they received with the `Last-Event-ID` header.
+"""
+
+import asyncio
+import json
+from os import getenv
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+from aars import AARS
+
+from fishnet_cod import Execution, Result, ResultChunk
+from fishnet_cod.index import lookup
+from fishnet_cod.scheduler import FINISHED_STATUSES
+
+from .responses import RECORD_INTERNAL_FIELDS
+
+# Seconds after which a stream ends, to be resumed by the client
+STREAM_MAX_DURATION = float(getenv("FISHNET_STREAM_MAX_DURATION", "60"))
+# Seconds between two comments keeping an idle stream open
+STREAM_KEEPALIVE_INTERVAL = float(getenv("FISHNET_STREAM_KEEPALIVE_INTERVAL", "15"))
+# Milliseconds clients wait for before resuming a stream
+STREAM_RETRY = int(getenv("FISHNET_STREAM_RETRY", "1000"))
+# Seconds the chunks of a finished execution are waited for, if not indexed yet
+CHUNK_GRACE_PERIOD = float(getenv("FISHNET_CHUNK_GRACE_PERIOD", "10"))
+
+
+def format_event(event: str, data: dict, event_id: Optional[int] = None) -> str:
+    lines = [] if event_id is None else [f"id: {event_id}"]
+    lines += [f"event: {event}", f"data: {json.dumps(data, default=str)}"]
+    return "\n".join(lines) + "\n\n"
+
+
+def parse_last_event_id(last_event_id: Optional[str]) -> int:
+    """Index of the first chunk to send, following the last one a client received."""
+    try:
+        return int(last_event_id) + 1 if last_event_id else 0
+    except ValueError:
+        return 0
+
+
+class ExecutionWatcher:
+    """Wakes up the streams of executions when their records are indexed."""
+
+    def __init__(self):
+        # execution id -> events of the streams following it
+        self.events: Dict[str, Set[asyncio.Event]] = {}
+
+    def add(self, execution_id: str, event: asyncio.Event):
+        self.events.setdefault(execution_id, set()).add(event)
+
+    def discard(self, execution_id: str, event: asyncio.Event):
+        events = self.events.get(execution_id)
+        if events is not None:
+            events.discard(event)
+            if not events:
+                del self.events[execution_id]
+
+    def notify(self, execution_id: str):
+        for event in self.events.get(execution_id, ()):
+            event.set()
+
+
+class ChunkReader:
+    """Reads the chunks of an execution in order, fetching each of them once."""
+
+    def __init__(self, execution_id: str, start: int = 0):
+        self.execution_id = execution_id
+        self.next_index = start
+        self.seen: Set[str] = set()
+        # index -> chunk fetched before the ones preceding it
+        self.pending: Dict[int, ResultChunk] = {}
+
+    async def read(self) -> List[ResultChunk]:
+        id_hashes, _ = lookup(ResultChunk, executionID=self.execution_id)
+        new_ids = list(id_hashes - self.seen)
+        if new_ids:
+            async for chunk in AARS.fetch_records(ResultChunk, new_ids):
+                self.seen.add(chunk.id_hash)
+                if chunk.index >= self.next_index:
+                    self.pending[chunk.index] = chunk
+        chunks = []
+        while self.next_index in self.pending:
+            chunks.append(self.pending.pop(self.next_index))
+            self.next_index += 1
+        return chunks
+
+
+async def stream_execution(
+    execution_id: str,
+    watcher: ExecutionWatcher,
+    start: int = 0,
+    max_duration: float = STREAM_MAX_DURATION,
+) -> AsyncIterator[str]:
+    """
+    Yields the server-sent events of an execution, starting from its chunk of
+    index `start`.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_duration
+    updated = asyncio.Event()
+    watched = {execution_id}
+    watcher.add(execution_id, updated)
+    reader = ChunkReader(execution_id, start)
+    status = None
+    finished_at: Optional[float] = None
+    try:
+        yield f"retry: {STREAM_RETRY}\n\n"
+        while True:
+            updated.clear()
+            execution = await Execution.fetch(execution_id).first()
+            if execution is None:
+                return
+            if execution.status != status:
+                status = execution.status
+                yield format_event(
+                    "status", {"status": status, "resultID": execution.resultID}
+                )
+
+            result: Optional[Result] = None
+            expected: Optional[int] = None
+            if status in FINISHED_STATUSES:
+                finished_at = finished_at or loop.time()
+                if execution.resultID is not None:
+                    result = await Result.fetch(execution.resultID).first()
+                expected = (result.chunkCount or 0) if result is not None else 0
+                # memoized results point at the chunks of their own execution
+                if result is not None and result.executionID != reader.execution_id:
+                    reader = ChunkReader(result.executionID, start)
+                    watched.add(result.executionID)
+                    watcher.add(result.executionID, updated)
+
+            for chunk in await reader.read():
+                yield format_event(
+                    "chunk", {"index": chunk.index, "data": chunk.data}, chunk.index
+                )
+
+            if expected is not None and (
+                reader.next_index >= expected
+                or loop.time() - finished_at >= CHUNK_GRACE_PERIOD
+            ):
+                if result is not None:
+                    yield format_event(
+                        "result", result.dict(exclude=set(RECORD_INTERNAL_FIELDS))
+                    )
+                return
+
+            if loop.time() >= deadline:
+                return
+            timeout = min(STREAM_KEEPALIVE_INTERVAL, deadline - loop.time())
+            if expected is not None:
+                timeout = min(timeout, finished_at + CHUNK_GRACE_PERIOD - loop.time())
+            try:
+                await asyncio.wait_for(updated.wait(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                if loop.time() >= deadline:
+                    return
+                yield ": keepalive\n\n"
+    finally:
+        for watched_id in watched:
+            watcher.discard(watched_id, updated)
@@ -1,11 +1,84 @@
+import asyncio
+import gzip
+import json
+import os
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+import zstandard
+from aars import AARS, Record
+from aleph.sdk.exceptions import BroadcastError
+from aleph.sdk.vm.cache import TestVmCache
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
 from fastapi.testclient import TestClient
+from pydantic import BaseModel, ValidationError
 
-from .main import app
+from . import indexing
+from .compression import BodyTooLarge, CompressionMiddleware, compress, decompress
+from .indexing import INDEX_SNAPSHOT_KEY, Reindexer, ReindexState, indices
+from .permissions import PermissionMatrix, transition_permissions
+from .main import app, get_permission_updates
+from .streaming import ExecutionWatcher, stream_execution
+from .responses import RECORD_INTERNAL_FIELDS, FastJSONRoute, conforms, unpackb
 from .requests import *
 from fishnet_cod import *
+from fishnet_cod import scheduler
+from fishnet_cod.execution import (
+    AlgorithmRun,
+    ExecutionInputs,
+    ExecutionLimits,
+    ResultStream,
+    get_memo_key,
+    run_executions,
+    run_isolated,
+)
+from fishnet_cod.index import AllOf, InvertedIndex, Range, SortedIndex, lookup, where
 
 client = TestClient(app)
 
+# Cold start budget of the API VM for importing its entrypoint, in microseconds
+IMPORT_TIME_BUDGET_US = 2_000_000
+# Modules only needed by the executor, which the API VM must not import
+EXECUTOR_ONLY_MODULES = {"pandas", "numpy"}
+
+
+def measure_import_times(module: str) -> Dict[str, int]:
+    """
+    Import `module` in a fresh interpreter with `python -X importtime`.
+    :return: the cumulative import time in microseconds of every imported module
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env={**os.environ, "TEST_CACHE": "true"},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    import_times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if cumulative.strip().isdigit():
+            import_times[name.strip()] = int(cumulative)
+    return import_times
+
+
+def test_import_time_budget():
+    cod_import_times = measure_import_times("fishnet_cod")
+    assert not EXECUTOR_ONLY_MODULES & cod_import_times.keys()
+
+    api_import_times = measure_import_times("fishnet_api.main")
+    assert not EXECUTOR_ONLY_MODULES & api_import_times.keys()
+    assert api_import_times["fishnet_api.main"] <= IMPORT_TIME_BUDGET_US
+
 
 def test_full_request_execution_flow_with_own_dataset():
     req: UploadTimeseriesRequest = UploadTimeseriesRequest(
@@ -86,3 +159,1211 @@ def test_dataset():
     page = 1
     page_size = 1
     response = client.get("/datasets")
+
+
+def make_message(
+    item_hash: str,
+    time: float,
+    content: dict,
+    post_type: str,
+    ref: Optional[str] = None,
+) -> SimpleNamespace:
+    """A post message of the channel, with the fields the indices read."""
+    return SimpleNamespace(
+        item_hash=item_hash,
+        time=time,
+        content=SimpleNamespace(type=post_type, ref=ref, content=content),
+    )
+
+
+class FakeChannel:
+    """Serves `messages` by pages, like `AlephClient.get_messages`."""
+
+    def __init__(self, messages: List[SimpleNamespace]):
+        self.messages = messages
+        self.fetches = 0
+        # fetch number -> called on that fetch, to simulate concurrent events
+        self.on_fetch: Dict[int, Callable[[], None]] = {}
+
+    async def get_messages(
+        self,
+        pagination=200,
+        page=1,
+        start_date=None,
+        refs=None,
+        content_types=None,
+        **kwargs,
+    ):
+        self.fetches += 1
+        if self.fetches in self.on_fetch:
+            self.on_fetch[self.fetches]()
+        messages = [
+            message
+            for message in self.messages
+            if (start_date is None or message.time >= start_date)
+            and (refs is None or message.content.ref in refs)
+            and (content_types is None or message.content.type in content_types)
+        ]
+        return SimpleNamespace(
+            messages=messages[(page - 1) * pagination : page * pagination],
+            pagination_per_page=pagination,
+            pagination_total=len(messages),
+        )
+
+
+def execution_content(owner: str, status: ExecutionStatus) -> dict:
+    return {"algorithmID": "a", "datasetID": "d", "owner": owner, "status": status}
+
+
+def test_reindexer_sync_builds_persists_and_restores_indices(monkeypatch):
+    channel = FakeChannel(
+        [
+            make_message(
+                f"e{i}",
+                i,
+                execution_content("alice", ExecutionStatus.PENDING),
+                "Execution",
+            )
+            for i in range(1, 5)
+        ]
+        + [
+            make_message(
+                "e1-amend",
+                10,
+                execution_content("alice", ExecutionStatus.SUCCESS),
+                "amend",
+                ref="e1",
+            )
+        ]
+    )
+    monkeypatch.setattr(AARS, "session", channel)
+    monkeypatch.setattr(indexing, "SYNC_PAGE_SIZE", 2)
+    indices.replace_with(indices.empty_copy())
+    cache = TestVmCache()
+
+    reindexer = Reindexer(cache)
+    asyncio.run(reindexer.sync(full=False))
+    assert reindexer.status.state == ReindexState.DONE
+    assert reindexer.status.full  # nothing to restore, so rebuilt
+    assert lookup(Execution, owner="alice")[0] == {"e1", "e2", "e3", "e4"}
+    assert lookup(Execution, status=ExecutionStatus.SUCCESS)[0] == {"e1"}
+    assert lookup(Execution, status=ExecutionStatus.PENDING)[0] == {"e2", "e3", "e4"}
+    assert indices.mark.item_hash == "e1-amend"
+    assert asyncio.run(cache.get(INDEX_SNAPSHOT_KEY)) is not None
+
+    # a restarted API restores the snapshot and only applies the newer messages
+    indices.replace_with(indices.empty_copy())
+    channel.messages.append(
+        make_message(
+            "e5", 20, execution_content("bob", ExecutionStatus.PENDING), "Execution"
+        )
+    )
+    reindexer = Reindexer(cache)
+    asyncio.run(reindexer.sync(full=False))
+    assert reindexer.status.state == ReindexState.DONE
+    assert not reindexer.status.full
+    assert reindexer.status.messagesApplied == 1
+    assert lookup(Execution, owner="alice")[0] == {"e1", "e2", "e3", "e4"}
+    assert lookup(Execution, owner="bob")[0] == {"e5"}
+
+
+def test_reindexer_applies_late_messages_and_saves_events(monkeypatch):
+    content = execution_content("alice", ExecutionStatus.PENDING)
+    channel = FakeChannel([make_message("e1", 1000, content, "Execution")])
+    monkeypatch.setattr(AARS, "session", channel)
+    monkeypatch.setattr(indexing, "SNAPSHOT_INTERVAL", 0)
+    indices.replace_with(indices.empty_copy())
+    cache = TestVmCache()
+
+    async def receive():
+        reindexer = Reindexer(cache)
+        await reindexer.sync(full=False)
+        # events advance the mark, and are saved without waiting for a sync
+        reindexer.apply_event(make_message("e2", 2000, content, "Execution"))
+        await reindexer.saving
+        snapshot = json.loads(await cache.get(INDEX_SNAPSHOT_KEY))
+        assert snapshot["mark"]["item_hash"] == "e2"
+
+    asyncio.run(receive())
+    # messages which reached the node after e2 despite being older, and an
+    # older revision of e2
+    finished = execution_content("alice", ExecutionStatus.SUCCESS)
+    channel.messages += [
+        make_message("e3", 1900, content, "Execution"),
+        make_message("e2-old", 1950, finished, "amend", ref="e2"),
+        make_message("e4", 1500 - indexing.SYNC_MARGIN, content, "Execution"),
+    ]
+    indices.replace_with(indices.empty_copy())
+    reindexer = Reindexer(cache)
+    asyncio.run(reindexer.sync(full=False))
+    assert not reindexer.status.full
+    assert reindexer.status.messagesApplied == 1
+    assert lookup(Execution, status=ExecutionStatus.PENDING)[0] == {"e1", "e2", "e3"}
+
+
+def test_full_rebuild_keeps_events_received_while_it_runs(monkeypatch):
+    channel = FakeChannel(
+        [
+            make_message(
+                "e1",
+                1,
+                execution_content("alice", ExecutionStatus.PENDING),
+                "Execution",
+            )
+        ]
+    )
+    monkeypatch.setattr(AARS, "session", channel)
+    indices.replace_with(indices.empty_copy())
+    reindexer = Reindexer(TestVmCache())
+
+    # an amend is received as event while the rebuild catches up, before the
+    # node returns it in the messages of the channel
+    amend = make_message(
+        "e1-amend",
+        5,
+        execution_content("alice", ExecutionStatus.SUCCESS),
+        "amend",
+        ref="e1",
+    )
+    channel.on_fetch[2] = lambda: reindexer.apply_event(amend)
+    asyncio.run(reindexer.sync(full=True))
+
+    assert reindexer.status.state == ReindexState.DONE
+    assert lookup(Execution, status=ExecutionStatus.SUCCESS)[0] == {"e1"}
+    assert not lookup(Execution, status=ExecutionStatus.PENDING)[0]
+    assert reindexer.buffered is None
+
+
+def make_record(record_type, id_hash: str, **fields):
+    record = record_type(**fields)
+    record.id_hash = id_hash
+    return record
+
+
+def make_permission(
+    id_hash: str,
+    requestor: str,
+    timeseries_id: str,
+    status: PermissionStatus = PermissionStatus.GRANTED,
+    max_count: Optional[int] = None,
+    count: int = 0,
+) -> Permission:
+    return make_record(
+        Permission,
+        id_hash,
+        timeseriesID=timeseries_id,
+        algorithmID=None,
+        owner="owner",
+        status=status,
+        executionCount=count,
+        maxExecutionCount=max_count,
+        requestor=requestor,
+    )
+
+
+def test_permission_matrix_counts_follow_grants_and_datasets():
+    matrix = PermissionMatrix()
+    for timeseries_id in ["t1", "t2", "t3"]:
+        matrix.apply_record(
+            make_record(Timeseries, timeseries_id, name="", owner="owner", data=[])
+        )
+    matrix.apply_record(make_permission("p1", "alice", "t1", max_count=5, count=2))
+    matrix.apply_record(make_permission("p2", "alice", "t2"))
+    matrix.apply_record(make_permission("p3", "bob", "t3", max_count=1))
+    dataset = make_record(
+        Dataset,
+        "d1",
+        name="",
+        owner="owner",
+        ownsAllTimeseries=True,
+        timeseriesIDs=["t1", "t2"],
+    )
+    matrix.apply_record(dataset)
+
+    assert matrix.get_count("alice", "d1") == 3
+    assert matrix.get_count("bob", "d1") == 0
+    assert matrix.get_count("owner", "d1") is None
+    assert matrix.requestors_by_timeseries == {
+        "t1": {"alice"},
+        "t2": {"alice"},
+        "t3": {"bob"},
+    }
+
+    # only the cells of the requestors granted on its new timeseries are added
+    dataset.timeseriesIDs = ["t1", "t3"]
+    matrix.apply_record(dataset)
+    assert matrix.counts[("alice", "d1")] == 0
+    assert matrix.counts[("bob", "d1")] == 0
+    assert ("carol", "d1") not in matrix.counts
+
+    # revoking the last grant of a requestor on a timeseries forgets them
+    matrix.apply_record(make_permission("p3", "bob", "t3", PermissionStatus.DENIED))
+    assert "t3" not in matrix.requestors_by_timeseries
+
+    restored = PermissionMatrix.restore(matrix.dump())
+    assert restored.requestors_by_timeseries == matrix.requestors_by_timeseries
+    assert restored.get_count("alice", "d1") == 0
+    dataset.timeseriesIDs = ["t1"]
+    restored.apply_record(dataset)
+    assert restored.get_count("alice", "d1") == 3
+
+
+class FakeStore:
+    """
+    Records served by `AARS.fetch_records` and written by `Record.save`, in
+    memory. Records are indexed when put, changing `records` afterwards serves
+    revisions the indices do not know of.
+    """
+
+    def __init__(self, monkeypatch):
+        self.records: Dict[str, Record] = {}
+        self.saved: List[Record] = []
+        self.time = 0.0
+        indices.replace_with(indices.empty_copy())
+        monkeypatch.setattr(AARS, "fetch_records", self.fetch_records)
+        monkeypatch.setattr(Record, "save", self.make_save())
+
+    async def fetch_records(self, record_type, item_hashes=None, **kwargs):
+        # not in the requested order, which AARS does not guarantee
+        for id_hash in reversed(item_hashes or []):
+            record = self.records.get(id_hash)
+            if isinstance(record, record_type):
+                yield record.copy()
+
+    def make_save(self):
+        store = self
+
+        async def save(record):
+            if record.id_hash is None:
+                record.id_hash = f"{type(record).__name__.lower()}{len(store.saved)}"
+            store.saved.append(record)
+            store.records[record.id_hash] = record.copy()
+            return record
+
+        return save
+
+    def put(self, record: Record) -> Record:
+        self.time += 1
+        indices.apply_message(
+            make_message(
+                record.id_hash, self.time, record.content, type(record).__name__
+            )
+        )
+        self.records[record.id_hash] = record.copy()
+        return record
+
+    def amend(self, record: Record) -> Record:
+        """Indexes a new revision of `record`."""
+        self.time += 1
+        indices.apply_message(
+            make_message(
+                f"{record.id_hash}-{self.time:g}",
+                self.time,
+                record.content,
+                "amend",
+                ref=record.id_hash,
+            )
+        )
+        self.records[record.id_hash] = record.copy()
+        return record
+
+
+def test_transition_permissions_skips_executions_finished_since_indexed(monkeypatch):
+    store = FakeStore(monkeypatch)
+    store.put(make_record(Timeseries, "t1", name="", owner="owner", data=[]))
+    store.put(
+        make_record(
+            Dataset,
+            "d1",
+            name="",
+            owner="owner",
+            ownsAllTimeseries=True,
+            timeseriesIDs=["t1"],
+        )
+    )
+    permission = store.put(
+        make_permission("p1", "alice", "t1", PermissionStatus.REQUESTED)
+    )
+    for id_hash in ["e1", "e2"]:
+        store.put(
+            make_record(
+                Execution,
+                id_hash,
+                algorithmID="a",
+                datasetID="d1",
+                owner="alice",
+                status=ExecutionStatus.REQUESTED,
+            )
+        )
+    # e2 was denied meanwhile, but its status bucket was not updated yet
+    store.records["e2"].status = ExecutionStatus.DENIED
+
+    transition = asyncio.run(
+        transition_permissions([permission], PermissionStatus.GRANTED)
+    )
+    assert [execution.id_hash for execution in transition.executions] == ["e1"]
+    assert transition.executions[0].status == ExecutionStatus.PENDING
+    assert store.records["e2"].status == ExecutionStatus.DENIED
+
+
+def test_granted_permissions_authorize_the_executions_they_have_left(monkeypatch):
+    store = FakeStore(monkeypatch)
+    for timeseries_id in ["t1", "t2"]:
+        store.put(
+            make_record(Timeseries, timeseries_id, name="", owner="owner", data=[])
+        )
+    store.put(
+        make_record(
+            Dataset,
+            "d1",
+            name="",
+            owner="owner",
+            ownsAllTimeseries=False,
+            timeseriesIDs=["t1", "t2"],
+        )
+    )
+    # two executions left on t1, no limit on t2
+    p1 = store.put(
+        make_permission("p1", "alice", "t1", PermissionStatus.REQUESTED, 3, 1)
+    )
+    p2 = store.put(make_permission("p2", "alice", "t2", PermissionStatus.REQUESTED))
+    for id_hash in ["e1", "e2", "e3"]:
+        store.put(make_execution(id_hash, status=ExecutionStatus.REQUESTED))
+
+    transition = asyncio.run(transition_permissions([p1, p2], PermissionStatus.GRANTED))
+    assert [execution.id_hash for execution in transition.executions] == ["e1", "e2"]
+    assert store.records["e3"].status == ExecutionStatus.REQUESTED
+
+
+def make_execution(id_hash: str, owner: str = "alice", **fields) -> Execution:
+    fields = {
+        "algorithmID": "a",
+        "datasetID": "d1",
+        "status": ExecutionStatus.PENDING,
+        **fields,
+    }
+    return make_record(Execution, id_hash, owner=owner, **fields)
+
+
+def test_where_checks_conditions_on_records_amended_since_indexed(monkeypatch):
+    store = FakeStore(monkeypatch)
+    for id_hash in ["e1", "e2", "e3"]:
+        store.put(make_execution(id_hash))
+    store.records["e2"].status = ExecutionStatus.RUNNING
+    store.records["e3"].owner = "bob"
+
+    async def query(**conditions):
+        return sorted(
+            record.id_hash for record in await where(Execution, **conditions).all()
+        )
+
+    assert asyncio.run(query(status=ExecutionStatus.PENDING)) == ["e1", "e3"]
+    assert asyncio.run(query(status=ExecutionStatus.PENDING, owner="alice")) == ["e1"]
+    # timestamps are those of the indexed revisions, and are not checked again
+    assert asyncio.run(query(timestamp=Range(start=2))) == ["e2", "e3"]
+
+    # records being saved have no timestamp yet, and are indexed by it only
+    # once their message is received
+    (timestamp_index,) = [
+        index for index in Execution.get_indices() if isinstance(index, SortedIndex)
+    ]
+    e4 = make_execution("e4")
+    for index in Execution.get_indices():
+        index.add_record(e4)
+    assert (None,) not in timestamp_index.hashmap
+    store.put(e4)
+    assert asyncio.run(query(timestamp=Range(start=4))) == ["e4"]
+    assert (None,) not in timestamp_index.hashmap
+    timestamp_index.load({(None,): {"e5"}, (4,): {"e4"}})
+    assert timestamp_index.hashmap == {(4,): {"e4"}}
+
+
+def test_fetch_page_fills_pages_in_id_order_despite_stale_entries(monkeypatch):
+    store = FakeStore(monkeypatch)
+    for i in range(10):
+        store.put(make_execution(f"e{i}"))
+    for id_hash in ["e1", "e2", "e5"]:
+        store.records[id_hash].status = ExecutionStatus.SUCCESS
+
+    def fetch(**kwargs) -> Tuple[List[str], Optional[str]]:
+        page = asyncio.run(
+            fetch_page(Execution, status=ExecutionStatus.PENDING, **kwargs)
+        )
+        return [record.id_hash for record in page.records], page.next_cursor
+
+    assert fetch(limit=3) == (["e0", "e3", "e4"], "e4")
+    assert fetch(limit=3, after="e4") == (["e6", "e7", "e8"], "e8")
+    assert fetch(limit=3, after="e8") == (["e9"], None)
+    assert fetch(limit=2, offset=2) == (["e4", "e6"], "e6")
+    assert fetch() == (["e0", "e3", "e4", "e6", "e7", "e8", "e9"], None)
+    # conditions without index are checked on the records, in the same order
+    assert fetch(limit=2, algorithmID="a", after="e3") == (["e4", "e6"], "e6")
+
+
+def test_list_endpoints_return_a_bounded_page_by_default(monkeypatch):
+    store = FakeStore(monkeypatch)
+    for i in range(25):
+        store.put(make_execution(f"e{i:02}"))
+
+    response = client.get("/executions")
+    assert response.status_code == 200
+    assert len(response.json()) == 20
+    assert response.headers["X-Next-Cursor"] == "e19"
+    response = client.get("/executions", params={"cursor": "e19"})
+    assert [e["id_hash"] for e in response.json()] == [f"e{i}" for i in range(20, 25)]
+
+
+def test_save_batch_retries_amends_but_not_posts_that_may_have_been_sent(
+    monkeypatch,
+):
+    store = FakeStore(monkeypatch)
+    save = Record.save
+    errors: Dict[str, List[BaseException]] = {
+        "amended": [asyncio.TimeoutError(), BroadcastError("busy")],
+        "posted": [asyncio.TimeoutError()],
+        "refused": [ConnectionRefusedError()],
+        "invalid": [ValueError("invalid")],
+    }
+
+    async def failing_save(record):
+        failures = errors[record.algorithmID]
+        if failures:
+            raise failures.pop(0)
+        return await save(record)
+
+    monkeypatch.setattr(Record, "save", failing_save)
+    batch = SaveBatch(retries=2, retry_delay=0)
+    batch.add(make_execution("e1", algorithmID="amended"))
+    batch.extend(
+        Execution(algorithmID=algorithm_id, datasetID="d1", owner="alice")
+        for algorithm_id in ["posted", "refused", "invalid"]
+    )
+    report = asyncio.run(batch.submit())
+
+    assert [(o.record.algorithmID, o.ok, o.attempts) for o in report.outcomes] == [
+        ("amended", True, 3),
+        ("posted", False, 1),
+        ("refused", True, 2),
+        ("invalid", False, 1),
+    ]
+    assert [record.algorithmID for record in report.saved] == ["amended", "refused"]
+    assert [type(error) for _, error in report.failed] == [
+        asyncio.TimeoutError,
+        ValueError,
+    ]
+    assert len(store.saved) == 2
+
+
+def test_responses_leave_out_revision_metadata_of_records(monkeypatch):
+    store = FakeStore(monkeypatch)
+    execution = make_execution("e1")
+    execution.revision_hashes = ["e1", "r1"]
+    execution.current_revision = 1
+    store.put(execution)
+
+    for accept in ["application/json", "application/msgpack"]:
+        response = client.get("/executions", headers={"Accept": accept})
+        assert response.status_code == 200
+        if accept == "application/json":
+            (returned,) = response.json()
+        else:
+            (returned,) = unpackb(response.content)
+        assert returned["id_hash"] == "e1"
+        assert not RECORD_INTERNAL_FIELDS & set(returned)
+
+    response = client.get("/executions", params={"fields": "revision_hashes"})
+    assert response.status_code == 400
+
+
+def test_routes_validate_what_does_not_conform_to_their_response_model():
+    class Stats(BaseModel):
+        name: str
+        keys: int
+
+    router_app = FastAPI()
+    router_app.router.route_class = FastJSONRoute
+
+    @router_app.get("/stats")
+    async def stats(valid: bool = True) -> List[Stats]:
+        if valid:
+            return [{"name": "i", "keys": "1"}]
+        return [{"name": "i"}]
+
+    stats_client = TestClient(router_app)
+    response = stats_client.get("/stats")
+    assert response.json() == [{"name": "i", "keys": 1}]
+    with pytest.raises(ValidationError):
+        stats_client.get("/stats", params={"valid": False})
+
+    status = DatasetPermissionStatus.GRANTED
+    annotation = List[Tuple[Dataset, Optional[DatasetPermissionStatus]]]
+    dataset = Dataset(name="d", owner="alice", ownsAllTimeseries=True, timeseriesIDs=[])
+    assert conforms([(dataset, status), (dataset, None)], annotation)
+    assert not conforms([(dataset.dict(), status)], annotation)
+    assert not conforms([(dataset,)], annotation)
+
+
+def test_executor_reads_every_page_of_amends_and_queued_executions(monkeypatch):
+    statuses = {
+        "e1": [ExecutionStatus.PENDING],
+        "e2": [ExecutionStatus.PENDING, ExecutionStatus.RUNNING],
+        "e3": [ExecutionStatus.PENDING, ExecutionStatus.RUNNING]
+        + [ExecutionStatus.RUNNING] * 4
+        + [ExecutionStatus.SUCCESS],
+        "e4": [ExecutionStatus.REQUESTED],
+    }
+    messages = []
+    for id_hash, revisions in statuses.items():
+        for revision, status in enumerate(revisions):
+            content = execution_content("alice", status)
+            if revision == 0:
+                messages.append(make_message(id_hash, 1, content, "Execution"))
+            else:
+                item_hash = f"{id_hash}-{revision}"
+                message = make_message(item_hash, 1 + revision, content, "amend")
+                message.content.ref = id_hash
+                messages.append(message)
+    messages.append(make_message("p1-1", 9, {"status": "PENDING"}, "amend", ref="p1"))
+    channel = FakeChannel(messages)
+    monkeypatch.setattr(AARS, "session", channel)
+    monkeypatch.setattr(scheduler, "MESSAGES_PAGE_SIZE", 2)
+
+    amends = asyncio.run(scheduler.fetch_amends(make_execution("e3")))
+    assert len(amends) == 6
+    assert scheduler.get_lease_holder(amends) is None
+
+    queued = asyncio.run(scheduler.fetch_queued_executions())
+    assert sorted((e.id_hash, e.status) for e in queued) == [
+        ("e1", ExecutionStatus.PENDING),
+        ("e2", ExecutionStatus.RUNNING),
+    ]
+
+
+def make_timeseries(id_hash: str, owner: str, data=None, **fields) -> Timeseries:
+    return make_record(
+        Timeseries, id_hash, name=id_hash, owner=owner, data=data or [], **fields
+    )
+
+
+def make_dataset(id_hash: str, owner: str, timeseries_ids: List[str]) -> Dataset:
+    return make_record(
+        Dataset,
+        id_hash,
+        name=id_hash,
+        owner=owner,
+        ownsAllTimeseries=False,
+        timeseriesIDs=timeseries_ids,
+    )
+
+
+def test_batch_request_raises_pending_permission_requests(monkeypatch):
+    store = FakeStore(monkeypatch)
+    store.put(make_timeseries("t1", "bob"))
+    store.put(make_timeseries("t2", "carol"))
+    store.put(make_dataset("d1", "bob", ["t1"]))
+    store.put(make_dataset("d2", "carol", ["t1", "t2"]))
+    # an execution of alice already waits for the request of one execution
+    store.put(make_permission("p1", "alice", "t1", PermissionStatus.REQUESTED, 1))
+
+    response = client.post(
+        "/executions/request/batch",
+        json={"algorithmIDs": ["a"], "datasetIDs": ["d1", "d2"], "owner": "alice"},
+    )
+    assert response.status_code == 200
+    executions = [item["execution"] for item in response.json()]
+    assert [e["status"] for e in executions] == ["REQUESTED", "REQUESTED"]
+    assert len({e["batchID"] for e in executions}) == 1
+    saved = {
+        record.timeseriesID: record
+        for record in store.saved
+        if isinstance(record, Permission)
+    }
+    assert saved["t1"].id_hash == "p1"
+    assert saved["t1"].maxExecutionCount == 3
+    assert saved["t2"].status == PermissionStatus.REQUESTED
+    assert saved["t2"].maxExecutionCount == 1
+
+    granted = make_permission("p2", "alice", "t1", max_count=3, count=2)
+    assert get_permission_updates(granted.copy(), 1) is None
+    raised = get_permission_updates(granted.copy(), 2)
+    assert (raised.status, raised.maxExecutionCount) == (PermissionStatus.REQUESTED, 4)
+    denied = make_permission("p3", "alice", "t1", PermissionStatus.DENIED, 1, 1)
+    raised = get_permission_updates(denied, 1)
+    assert (raised.status, raised.maxExecutionCount) == (PermissionStatus.REQUESTED, 2)
+
+
+def test_execution_queue_pops_executions_of_a_batch_together():
+    queue = ExecutionQueue()
+    for id_hash, owner, priority, batch_id in [
+        ("e1", "alice", 0, "b"),
+        ("e2", "bob", 1, None),
+        ("e3", "alice", 0, "b"),
+        ("e4", "alice", 0, "b"),
+        ("e5", "carol", 0, "c"),
+    ]:
+        execution = make_execution(
+            id_hash, owner=owner, priority=priority, batchID=batch_id
+        )
+        execution.timestamp = int(id_hash[1:])
+        queue.push(execution)
+
+    assert [e.id_hash for e in queue.pop_batch()] == ["e2"]
+    assert [e.id_hash for e in queue.pop_batch(limit=2)] == ["e1", "e3"]
+    assert [e.id_hash for e in queue.pop_batch()] == ["e5"]
+    assert [e.id_hash for e in queue.pop_batch()] == ["e4"]
+    assert queue.pop_batch() == [] and not queue.batches
+
+
+def test_run_executions_saves_results_then_executions(monkeypatch):
+    store = FakeStore(monkeypatch)
+    store.put(make_timeseries("t1", "bob", [(1, 1.0), (2, 2.0)]))
+    store.put(make_dataset("d1", "bob", ["t1"]))
+    algorithm = make_record(
+        Algorithm,
+        "a",
+        name="sum",
+        desc="",
+        owner="bob",
+        code="def run(df, factor=1):\n    return float(df['t1'].sum()) * factor\n",
+    )
+    store.put(algorithm)
+    executions = [
+        make_execution("e1", params={"factor": 2}),
+        make_execution("e2", algorithmID="missing"),
+        make_execution("e3", params={"factor": 2}, owner="bob"),
+    ]
+
+    async def run():
+        cache = TestVmCache()
+        first = await run_executions(executions[:2], cache=cache)
+        second = await run_executions(executions[2:], cache=cache)
+        return first + second
+
+    e1, e2, e3 = asyncio.run(run())
+
+    results = [record for record in store.saved if isinstance(record, Result)]
+    assert [(r.executionID, r.data) for r in results] == [
+        ("e1", "6.0"),
+        ("e2", "Algorithm missing not found"),
+    ]
+    assert (e1.status, e1.resultID) == (ExecutionStatus.SUCCESS, results[0].id_hash)
+    assert (e2.status, e2.resultID) == (ExecutionStatus.FAILED, results[1].id_hash)
+    # e3 has the same inputs as e1, and reuses its result
+    assert (e3.status, e3.resultID) == (ExecutionStatus.SUCCESS, results[0].id_hash)
+    # set to RUNNING, then saved with their result
+    saved_executions = [r for r in store.saved if isinstance(r, Execution)]
+    assert [e.id_hash for e in saved_executions] == ["e1", "e2", "e1", "e2", "e3", "e3"]
+    assert store.records["e3"].status == ExecutionStatus.SUCCESS
+
+
+def test_sweep_processes_share_the_limits_of_the_execution():
+    code = (
+        "import time\n"
+        "def run(df, seconds):\n"
+        "    end = time.process_time() + seconds\n"
+        "    while time.process_time() < end:\n"
+        "        pass\n"
+        "    return seconds\n"
+    )
+    limits = ExecutionLimits(cpu_time=3, wall_time=30)
+    df = pd.DataFrame({"t1": [1.0]})
+
+    def sweep(seconds: float) -> Tuple[bool, str]:
+        job = AlgorithmRun(code, [{"seconds": seconds}] * 3, limits, parallelism=3)
+        succeeded, result, _ = asyncio.run(run_isolated(job, df))
+        return succeeded, result
+
+    succeeded, result = sweep(0.2)
+    assert succeeded and json.loads(result)["result"] == [0.2] * 3
+    # each process gets a second, where the execution is allowed three
+    succeeded, result = sweep(1.5)
+    assert not succeeded and "1/3 of the CPU time" in result
+
+
+def test_execution_requests_reject_params_not_matching_their_mode():
+    request = {"algorithmID": "a", "datasetID": "d1", "owner": "alice"}
+    batch = {"algorithmIDs": ["a"], "datasetIDs": ["d1"], "owner": "alice"}
+    for invalid in [
+        {"params": [{"x": 1}]},
+        {"params": {"x": 1}, "paramsMode": "LIST"},
+        {"params": {"x": 1}, "paramsMode": "GRID"},
+        {"params": [{"x": 1}], "paramsMode": "GRID"},
+        {"params": [{"x": 1}], "paramsMode": "LIST", "parallelism": -1},
+    ]:
+        response = client.post("/executions/request", json={**request, **invalid})
+        assert response.status_code == 422, invalid
+        response = client.post("/executions/request/batch", json={**batch, **invalid})
+        assert response.status_code == 422, invalid
+
+    for valid in [
+        {"params": {"x": 1}},
+        {"params": [{"x": 1}], "paramsMode": "LIST", "parallelism": 2},
+        {"params": {"x": [1, 2]}, "paramsMode": "GRID"},
+        {"paramsMode": "GRID"},
+    ]:
+        RequestExecutionRequest(**request, **valid)
+        RequestExecutionBatchRequest(**batch, **valid).get_requests()
+
+
+def test_list_params_with_several_keys_are_kept_as_a_list():
+    params = [{"fast": 5, "slow": 20}, {"fast": 10, "slow": 30}]
+    request = RequestExecutionRequest(
+        algorithmID="a", datasetID="d1", owner="alice", params=params, paramsMode="LIST"
+    )
+    assert request.params == params
+    batch = RequestExecutionBatchRequest(
+        algorithmIDs=["a"],
+        datasetIDs=["d1"],
+        owner="alice",
+        params=params,
+        paramsMode="LIST",
+    )
+    assert [r.params for r in batch.get_requests()] == [params]
+    execution = Execution(**request.dict(exclude_none=True))
+    assert execution.params == params
+
+
+def test_incremental_runs_start_over_when_rows_fed_before_changed():
+    code = (
+        "def run(df):\n"
+        "    return float(df['t1'].sum())\n"
+        "def update(state, new_rows):\n"
+        "    total = (state or 0.0) + float(new_rows['t1'].sum())\n"
+        "    return total, f'{total}/{len(new_rows)}'\n"
+    )
+    algorithm = make_record(Algorithm, "a", name="sum", desc="", owner="bob", code=code)
+    dataset = make_dataset("d1", "bob", ["t1"])
+    execution = make_execution("e1")
+    cache = TestVmCache()
+
+    def run(data) -> str:
+        timeseries = make_timeseries("t1", "bob", data)
+        inputs = ExecutionInputs(
+            {"a": algorithm}, {"d1": dataset}, {"t1": timeseries}, cache
+        )
+        outcome = asyncio.run(inputs.run(execution))
+        assert outcome.succeeded, outcome.data
+        return outcome.data
+
+    assert run([(1, 1.0), (2, 2.0)]) == "3.0/2"
+    # only the appended row is fed
+    assert run([(1, 1.0), (2, 2.0), (3, 3.0)]) == "6.0/1"
+    # a row fed before changed, all of them are fed again
+    assert run([(1, 10.0), (2, 2.0), (3, 3.0), (4, 4.0)]) == "19.0/4"
+    assert run([(1, 10.0), (2, 2.0), (3, 3.0), (4, 4.0)]) == "19.0/0"
+
+
+def test_user_results_include_memoized_results_of_other_users(monkeypatch):
+    store = FakeStore(monkeypatch)
+    result = make_record(Result, "r1", executionID="e1", owner="alice", data="6.0")
+    store.put(result)
+    store.put(make_execution("e1", status=ExecutionStatus.SUCCESS, resultID="r1"))
+    # memoized executions of bob, reusing the result of alice
+    for id_hash in ["e2", "e3"]:
+        store.put(
+            make_execution(
+                id_hash, owner="bob", status=ExecutionStatus.SUCCESS, resultID="r1"
+            )
+        )
+    store.put(make_execution("e4", owner="bob"))
+
+    for address in ["alice", "bob"]:
+        response = client.get(f"/user/{address}/results")
+        assert response.status_code == 200
+        assert [r["id_hash"] for r in response.json()] == ["r1"]
+    response = client.get("/user/carol/results")
+    assert response.json() == []
+
+
+def test_memoized_results_are_keyed_by_timeseries_content(monkeypatch):
+    code = "def run(df):\n    return float(df['t1'].sum())\n"
+    algorithm = make_record(Algorithm, "a", name="sum", desc="", owner="bob", code=code)
+    dataset = make_dataset("d1", "bob", ["t1"])
+    execution = make_execution("e1")
+    cache = TestVmCache()
+
+    def memo_key(data, revision_hashes) -> str:
+        timeseries = make_timeseries("t1", "bob", data)
+        timeseries.revision_hashes = revision_hashes
+        inputs = ExecutionInputs(
+            {"a": algorithm}, {"d1": dataset}, {"t1": timeseries}, cache
+        )
+        return get_memo_key(execution, code, inputs.get_timeseries_hashes("d1"))
+
+    key = memo_key([(1, 1.0)], ["h1"])
+    assert memo_key([(1, 1.0)], ["h1", "h2"]) == key
+    assert memo_key([(1, 2.0)], ["h1"]) != key
+
+    asyncio.run(cache.set(key, "r1"))
+    inputs = ExecutionInputs(
+        {"a": algorithm},
+        {"d1": dataset},
+        {"t1": make_timeseries("t1", "bob", [(1, 1.0)])},
+        cache,
+    )
+
+    def build_dataframe(dataset_id):
+        raise AssertionError("dataframe built for a memoized result")
+
+    monkeypatch.setattr(inputs, "build_dataframe", build_dataframe)
+    outcome = asyncio.run(inputs.run(execution))
+    assert outcome.succeeded and outcome.resultID == "r1"
+
+    missing = ExecutionInputs({"a": algorithm}, {"d1": dataset}, {}, cache)
+    outcome = asyncio.run(missing.run(execution))
+    assert not outcome.succeeded and "not found" in outcome.data
+
+
+def test_result_stream_keeps_parts_of_chunks_that_failed_to_save(monkeypatch):
+    store = FakeStore(monkeypatch)
+    save = Record.save
+    failures = [asyncio.TimeoutError()]
+    node = SimpleNamespace(down=False)
+
+    async def failing_save(record):
+        if node.down:
+            raise ConnectionResetError()
+        if failures:
+            raise failures.pop(0)
+        return await save(record)
+
+    monkeypatch.setattr(Record, "save", failing_save)
+    execution = make_execution("e1")
+
+    async def stream_parts() -> int:
+        stream = ResultStream(execution, flush_interval=100)
+        stream.add("a")
+        await stream.flush()
+        stream.add("b")
+        await stream.flush()
+        stream.add("c")
+        return await stream.close()
+
+    assert asyncio.run(stream_parts()) == 2
+    chunks = [record for record in store.saved if isinstance(record, ResultChunk)]
+    assert [(chunk.index, chunk.data) for chunk in chunks] == [
+        (0, ["a", "b"]),
+        (1, ["c"]),
+    ]
+
+    async def close_failing() -> int:
+        stream = ResultStream(execution, flush_interval=0)
+        node.down = True
+        stream.add("d")
+        await asyncio.sleep(0.01)
+        # closing does not wait for the node to be back
+        return await asyncio.wait_for(stream.close(), 5)
+
+    assert asyncio.run(close_failing()) == 0
+
+
+def test_indices_move_records_between_buckets_on_amends(monkeypatch):
+    store = FakeStore(monkeypatch)
+    d1 = store.put(make_dataset("d1", "bob", ["t1", "t2"]))
+    store.put(make_dataset("d2", "bob", ["t2", "t3"]))
+    e1 = store.put(make_execution("e1"))
+    store.put(make_execution("e2"))
+    store.put(make_execution("e3"))
+
+    def ids(record_type, **conditions):
+        id_hashes, unresolved = lookup(record_type, **conditions)
+        assert not unresolved
+        return sorted(id_hashes)
+
+    # inverted index: any of the values of a list, or all of them
+    assert ids(Dataset, timeseriesIDs="t2") == ["d1", "d2"]
+    assert ids(Dataset, timeseriesIDs=["t1", "t3"]) == ["d1", "d2"]
+    assert ids(Dataset, timeseriesIDs=AllOf(["t2", "t3"])) == ["d2"]
+    # sorted index: records of a range of timestamps, bounds included
+    assert ids(Execution, timestamp=Range(start=3)) == ["e1", "e2", "e3"]
+    assert ids(Execution, timestamp=Range(start=3, end=3)) == ["e1"]
+    assert ids(Execution, timestamp=Range(end=2)) == []
+
+    d1.timeseriesIDs = ["t3"]
+    store.amend(d1)
+    e1.status = ExecutionStatus.RUNNING
+    store.amend(e1)
+    assert ids(Dataset, timeseriesIDs="t1") == []
+    assert ids(Dataset, timeseriesIDs=AllOf(["t2", "t3"])) == ["d2"]
+    assert ids(Dataset, timeseriesIDs="t3") == ["d1", "d2"]
+    assert ids(Execution, status=ExecutionStatus.PENDING) == ["e2", "e3"]
+    assert ids(Execution, timestamp=Range(start=7)) == ["e1"]
+    assert ids(Execution, timestamp=Range(end=3)) == []
+    # emptied buckets are dropped, along with their sorted keys
+    (timeseries_index,) = [
+        index for index in Dataset.get_indices() if isinstance(index, InvertedIndex)
+    ]
+    assert ("t1",) not in timeseries_index.hashmap
+    (timestamp_index,) = [
+        index for index in Execution.get_indices() if isinstance(index, SortedIndex)
+    ]
+    assert timestamp_index.sorted_keys == [(4,), (5,), (7,)]
+    assert asyncio.run(where(Dataset, timeseriesIDs="t1").all()) == []
+
+
+def test_event_queue_applies_the_latest_revision_of_each_record():
+    batches: List[List[str]] = []
+
+    async def handler(messages):
+        batches.append([message.item_hash for message in messages])
+
+    async def receive():
+        queue = EventQueue(handler, flush_interval=0.05, max_batch=3)
+        content = execution_content("alice", ExecutionStatus.PENDING)
+        # amends of e1 collapse into the latest, which follows its post even
+        # though its clock is behind
+        queue.put(make_message("e1-2", 3, content, "amend", ref="e1"))
+        queue.put(make_message("e1-1", 2, content, "amend", ref="e1"))
+        queue.put(make_message("e1", 5, content, "Execution"))
+        queue.put(make_message("e2-1", 4, content, "amend", ref="e2"))
+        await asyncio.sleep(0.1)
+        assert batches == [["e2-1", "e1", "e1-2"]]
+        # a full buffer is applied without waiting
+        for position in range(3):
+            queue.put(make_message(f"e{position + 3}", 6, content, "Execution"))
+        await asyncio.sleep(0.01)
+        assert len(queue) == 0
+        await queue.task
+
+    asyncio.run(receive())
+    assert batches[1] == ["e3", "e4", "e5"]
+
+
+def test_event_queue_applies_failed_batches_again_up_to_its_retries():
+    attempts: List[List[str]] = []
+    content = execution_content("alice", ExecutionStatus.PENDING)
+
+    async def receive():
+        async def handler(messages):
+            attempts.append([message.item_hash for message in messages])
+            if len(attempts) == 1:
+                # received while the failing batch is applied
+                queue.put(make_message("e3", 3, content, "Execution"))
+            if len(attempts) == 1 or "e4" in attempts[-1]:
+                raise RuntimeError("node down")
+
+        queue = EventQueue(handler, flush_interval=0.01, retries=2)
+        queue.put(make_message("e1", 1, content, "Execution"))
+        queue.put(make_message("e2", 2, content, "Execution"))
+        await queue.task
+        queue.put(make_message("e4", 4, content, "Execution"))
+        await queue.task
+        assert queue.attempts == {}
+
+    asyncio.run(receive())
+    # failed messages are applied again along with the next ones, and dropped
+    # once out of retries
+    assert attempts == [["e1", "e2"], ["e1", "e2", "e3"]] + [["e4"]] * 3
+
+
+def test_compression_middleware_negotiates_encodings():
+    compressed_app = FastAPI()
+    compressed_app.add_middleware(CompressionMiddleware)
+
+    @compressed_app.post("/echo")
+    async def echo(request: Request):
+        return PlainTextResponse(await request.body())
+
+    compressed_client = TestClient(compressed_app)
+    body = b"fishnet " * 100
+
+    def post(content: bytes, **headers) -> SimpleNamespace:
+        headers.setdefault("Accept-Encoding", "identity")
+        with compressed_client.stream(
+            "POST", "/echo", content=content, headers=headers
+        ) as response:
+            # as sent, without the decoding of the test client
+            raw = b"".join(response.iter_raw())
+        return SimpleNamespace(
+            status_code=response.status_code, headers=response.headers, content=raw
+        )
+
+    response = post(body, **{"Accept-Encoding": "gzip;q=0.5, zstd"})
+    assert response.headers["Content-Encoding"] == "zstd"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert zstandard.ZstdDecompressor().decompress(response.content) == body
+    response = post(body, **{"Accept-Encoding": "zstd;q=0, *"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.content) == body
+    # small bodies are sent as they are
+    response = post(b"fishnet", **{"Accept-Encoding": "zstd"})
+    assert "Content-Encoding" not in response.headers
+    assert response.content == b"fishnet"
+
+    response = post(gzip.compress(body), **{"Content-Encoding": "gzip"})
+    assert response.content == body
+    response = post(b"not gzip", **{"Content-Encoding": "gzip"})
+    assert response.status_code == 400
+    response = post(body, **{"Content-Encoding": "br"})
+    assert response.status_code == 415
+    for encoding in ["gzip", "zstd"]:
+        with pytest.raises(BodyTooLarge):
+            decompress(compress(body, encoding), encoding, max_size=100)
+
+
+def claim_message(
+    item_hash: str, time: float, worker: str, expires_at: float, ref: str = "e1"
+) -> SimpleNamespace:
+    content = {
+        **execution_content("alice", ExecutionStatus.RUNNING),
+        "worker": worker,
+        "leaseExpiresAt": expires_at,
+    }
+    return make_message(item_hash, time, content, "amend", ref=ref)
+
+
+def test_first_valid_claim_holds_the_lease_of_an_execution(monkeypatch):
+    get_lease_holder = scheduler.get_lease_holder
+    assert get_lease_holder([]) is None
+    # concurrent claims, the first one wins
+    first, second = claim_message("a", 2, "w2", 60), claim_message("b", 1, "w1", 61)
+    assert get_lease_holder([first, second]) == "w1"
+    # heartbeats of the holder keep its lease, claims of others while valid don't
+    heartbeat = claim_message("c", 50, "w1", 110)
+    assert get_lease_holder([second, first, heartbeat]) == "w1"
+    assert get_lease_holder([second, claim_message("d", 70, "w2", 130)]) == "w2"
+    finished = make_message(
+        "e", 80, execution_content("alice", ExecutionStatus.SUCCESS), "amend", "e1"
+    )
+    assert get_lease_holder([second, heartbeat, finished]) == "w1"
+    assert get_lease_holder([second, finished, claim_message("f", 200, "w2", 260)]) == (
+        "w1"
+    )
+
+    channel = FakeChannel([])
+    node = SimpleNamespace(competing_claim=None)
+
+    async def save(record):
+        if node.competing_claim is not None:
+            channel.messages.append(node.competing_claim)
+        channel.messages.append(
+            claim_message("own", time.time(), record.worker, record.leaseExpiresAt)
+        )
+        return record
+
+    monkeypatch.setattr(AARS, "session", channel)
+    monkeypatch.setattr(Record, "save", save)
+    worker = Scheduler(run=None, worker="w1", settle_delay=0)
+
+    # the claim of w2 reached the node first
+    node.competing_claim = claim_message("other", 0, "w2", time.time() + 60)
+    assert not asyncio.run(worker.claim(make_execution("e1")))
+    # the lease of w2 is still valid, w1 does not claim it
+    node.competing_claim = None
+    channel.messages = [claim_message("other", 0, "w2", time.time() + 60)]
+    execution = make_execution("e1")
+    assert not asyncio.run(worker.claim(execution))
+    assert execution.status == ExecutionStatus.PENDING
+    # once expired, w1 claims it
+    channel.messages = [claim_message("other", 0, "w2", time.time() - 1)]
+    assert asyncio.run(worker.claim(execution))
+    assert (execution.status, execution.worker) == (ExecutionStatus.RUNNING, "w1")
+
+
+def test_executions_are_stopped_once_their_lease_could_not_be_renewed(monkeypatch):
+    runs = SimpleNamespace(started=0, cancelled=0)
+
+    async def run(executions):
+        runs.started += 1
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            runs.cancelled += 1
+            raise
+
+    async def save(record):
+        raise BroadcastError("node down")
+
+    monkeypatch.setattr(Record, "save", save)
+    worker = Scheduler(run=run, worker="w1", heartbeat_interval=0.01)
+    execution = make_execution("e1", status=ExecutionStatus.RUNNING)
+    asyncio.run(asyncio.wait_for(worker.run_leased([execution]), 5))
+    assert (runs.started, runs.cancelled) == (1, 1)
+
+
+def parse_events(stream: str) -> List[Tuple[str, dict]]:
+    events = []
+    for block in stream.split("\n\n"):
+        fields = dict(
+            line.split(": ", 1) for line in block.splitlines() if ": " in line
+        )
+        if "event" in fields:
+            events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+def test_execution_streams_send_chunks_in_order_then_the_result(monkeypatch):
+    store = FakeStore(monkeypatch)
+    execution = store.put(make_execution("e1", status=ExecutionStatus.RUNNING))
+    watcher = ExecutionWatcher()
+
+    def make_chunk(index: int) -> ResultChunk:
+        return make_record(
+            ResultChunk, f"c{index}", executionID="e1", index=index, data=[str(index)]
+        )
+
+    async def follow() -> List[str]:
+        return [
+            event async for event in stream_execution("e1", watcher, max_duration=5)
+        ]
+
+    async def run() -> List[str]:
+        following = asyncio.create_task(follow())
+        await asyncio.sleep(0.05)
+        # chunks indexed out of order, then the execution finishes
+        store.put(make_chunk(1))
+        watcher.notify("e1")
+        await asyncio.sleep(0.05)
+        store.put(make_chunk(0))
+        store.put(make_record(Result, "r1", executionID="e1", data="1", chunkCount=2))
+        execution.status = ExecutionStatus.SUCCESS
+        execution.resultID = "r1"
+        store.amend(execution)
+        watcher.notify("e1")
+        return await asyncio.wait_for(following, 5)
+
+    events = asyncio.run(run())
+    assert events[0].startswith("retry: ")
+    assert [
+        (name, data.get("status", data.get("index")))
+        for name, data in parse_events("".join(events))
+    ] == [
+        ("status", ExecutionStatus.RUNNING),
+        ("status", ExecutionStatus.SUCCESS),
+        ("chunk", 0),
+        ("chunk", 1),
+        ("result", None),
+    ]
+    assert not watcher.events
+
+    # resumed after the last chunk received
+    response = client.get("/executions/e1/stream", headers={"Last-Event-ID": "0"})
+    assert response.headers["Content-Type"].startswith("text/event-stream")
+    assert [
+        (name, data.get("index")) for name, data in parse_events(response.text)
+    ] == [("status", None), ("chunk", 1), ("result", None)]
+    result = parse_events(response.text)[-1][1]
+    assert result["id_hash"] == "r1"
+    assert not RECORD_INTERNAL_FIELDS & set(result)
+
+
+def test_algorithms_are_stopped_at_their_limits():
+    df = pd.DataFrame({"t1": [1.0]})
+
+    def run(code: str, **limits) -> Tuple[bool, str]:
+        job = AlgorithmRun(code, {}, ExecutionLimits(**limits))
+        succeeded, result, _ = asyncio.run(run_isolated(job, df))
+        return succeeded, result
+
+    assert run("def run(df):\n    return df['t1'].sum()\n") == (True, "1.0")
+    assert run("import time\ndef run(df):\n    time.sleep(10)\n", wall_time=0.5) == (
+        False,
+        "Wall-clock time limit of 0.5s exceeded",
+    )
+    assert run("def run(df):\n    while True:\n        pass\n", cpu_time=1) == (
+        False,
+        "CPU time limit of 1s exceeded",
+    )
+    assert run(
+        "def run(df):\n    return len(bytearray(2 ** 30))\n", memory=64 * 1024**2
+    ) == (False, "Memory limit exceeded")
@@ -1,2 +1,20 @@
+import importlib
+
 from .model import *
-from .execution import *
+from .index import *
+from .batch import *
+from .events import *
+from .scheduler import *
+
+# Attributes loaded from their module on first access, as their module imports
+# heavy dependencies that programs only using the model do not need.
+_LAZY_ATTRIBUTES = {
+    "run_execution": ".execution",
+}
+
+
+def __getattr__(name):
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(module_name, __name__), name)
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import random
+from dataclasses import dataclass, field
+from os import getenv
+from typing import Any, Dict, Generic, Iterable, List, Optional, Tuple, TypeVar
+
+import aiohttp
+from aars import Record
+from aleph.sdk.exceptions import BroadcastError
+
+__all__ = ["SaveBatch", "SaveOutcome", "SaveReport"]
+
+logger = logging.getLogger(__name__)
+
+R = TypeVar("R", bound=Record)
+
+# Maximum number of messages posted at a time by a batch
+SAVE_CONCURRENCY = int(getenv("FISHNET_SAVE_CONCURRENCY", "16"))
+# Retries of a failed save, waiting a random delay of up to
+# SAVE_RETRY_DELAY * 2 ** retry seconds before each of them
+SAVE_RETRIES = int(getenv("FISHNET_SAVE_RETRIES", "2"))
+SAVE_RETRY_DELAY = float(getenv("FISHNET_SAVE_RETRY_DELAY", "0.5"))
+
+# Errors of the connection to the node, after which a save may succeed
+RETRIED_ERRORS = (
+    aiohttp.ClientError,
+    asyncio.TimeoutError,
+    ConnectionError,
+    BroadcastError,
+)
+# Errors raised before a message was sent, after which posting it again cannot
+# create a duplicate of the record
+UNSENT_ERRORS = (
+    aiohttp.ClientConnectorError,
+    ConnectionRefusedError,
+)
+
+
+@dataclass
+class SaveOutcome(Generic[R]):
+    record: R
+    error: Optional[BaseException] = None
+    attempts: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class SaveReport(Generic[R]):
+    """Outcome of the saves of a `SaveBatch`, in the order the records were added."""
+
+    outcomes: List[SaveOutcome[R]] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return all(outcome.ok for outcome in self.outcomes)
+
+    @property
+    def saved(self) -> List[R]:
+        return [outcome.record for outcome in self.outcomes if outcome.ok]
+
+    @property
+    def failed(self) -> List[Tuple[R, BaseException]]:
+        return [
+            (outcome.record, outcome.error)
+            for outcome in self.outcomes
+            if not outcome.ok
+        ]
+
+
+class SaveBatch(Generic[R]):
+    """
+    Collects the records to save while handling a request, and saves them together
+    with at most `concurrency` messages being posted at a time. A record added
+    several times, or under the same `id_hash`, is only saved once, as last added.
+    Saves failing on connection errors are retried up to `retries` times. As the
+    message of a new record may have been posted despite an error, creating it
+    again, new records are only retried if their message was not sent.
+
+    >>> async with SaveBatch() as batch:
+    ...     batch.add(record)
+    >>> batch.report.saved
+    """
+
+    def __init__(
+        self,
+        concurrency: int = SAVE_CONCURRENCY,
+        retries: int = SAVE_RETRIES,
+        retry_delay: float = SAVE_RETRY_DELAY,
+    ):
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.records: Dict[Any, R] = {}
+        self.report: Optional[SaveReport[R]] = None
+
+    def add(self, record: R) -> R:
+        self.records[record.id_hash or id(record)] = record
+        return record
+
+    def extend(self, records: Iterable[R]):
+        for record in records:
+            self.add(record)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    async def save(self, record: R, semaphore: asyncio.Semaphore) -> SaveOutcome[R]:
+        outcome = SaveOutcome(record)
+        # amends of a record are repeated, new records would be posted twice
+        retried = RETRIED_ERRORS if record.id_hash is not None else UNSENT_ERRORS
+        while True:
+            outcome.attempts += 1
+            try:
+                async with semaphore:
+                    outcome.record = await record.save()
+                outcome.error = None
+                return outcome
+            except retried as error:
+                outcome.error = error
+                if outcome.attempts > self.retries:
+                    return outcome
+            except Exception as error:
+                outcome.error = error
+                return outcome
+            delay = random.uniform(0, self.retry_delay * 2 ** (outcome.attempts - 1))
+            logger.info(
+                f"Retrying to save {type(record).__name__} in {delay:.2f}s: "
+                f"{outcome.error!r}"
+            )
+            await asyncio.sleep(delay)
+
+    async def submit(self) -> SaveReport[R]:
+        """Saves the records added since the last submission."""
+        records = list(self.records.values())
+        self.records = {}
+        semaphore = asyncio.Semaphore(self.concurrency)
+        self.report = SaveReport(
+            list(
+                await asyncio.gather(
+                    *[self.save(record, semaphore) for record in records]
+                )
+            )
+        )
+        return self.report
+
+    async def __aenter__(self) -> "SaveBatch[R]":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.submit()
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+from os import getenv
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from aleph_message.models import PostMessage
+
+__all__ = ["EventQueue"]
+
+logger = logging.getLogger(__name__)
+
+# Seconds events are buffered for before being applied
+EVENT_FLUSH_INTERVAL = float(getenv("FISHNET_EVENT_FLUSH_INTERVAL", "0.5"))
+# Number of buffered records after which events are applied without waiting
+EVENT_MAX_BATCH = int(getenv("FISHNET_EVENT_MAX_BATCH", "1000"))
+# Times the messages of a batch the handler failed to apply are applied again
+EVENT_RETRIES = int(getenv("FISHNET_EVENT_RETRIES", "3"))
+
+
+def get_record_id(message: PostMessage) -> str:
+    """Item hash of the original post of the record posted or amended by `message`."""
+    return message.content.ref or message.item_hash
+
+
+def get_order(message: PostMessage) -> Tuple[float, str]:
+    return message.time, message.item_hash
+
+
+class EventQueue:
+    """
+    Buffers the messages received as events and hands them to `handler` in
+    batches, every `flush_interval` seconds or once `max_batch` records have
+    pending messages.
+
+    Of the messages received for a record since the last flush, only its
+    original post, if received, and its latest revision are kept, so that a
+    burst of amends costs a single update. Batches are sorted by message time,
+    and applied one after the other. The messages of a batch the handler failed
+    to apply are buffered again with the next ones, up to `retries` times.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[List[PostMessage]], Awaitable[None]],
+        flush_interval: float = EVENT_FLUSH_INTERVAL,
+        max_batch: int = EVENT_MAX_BATCH,
+        retries: int = EVENT_RETRIES,
+    ):
+        self.handler = handler
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.retries = retries
+        # record id -> original post, if buffered
+        self.posts: Dict[str, PostMessage] = {}
+        # record id -> latest amend
+        self.amends: Dict[str, PostMessage] = {}
+        self.record_ids: Set[str] = set()
+        self.received = 0
+        # item hash -> failed attempts to apply the message
+        self.attempts: Dict[str, int] = {}
+        self.lock = asyncio.Lock()
+        self.full = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.record_ids)
+
+    def put(self, message: PostMessage):
+        self.received += 1
+        record_id = get_record_id(message)
+        self.record_ids.add(record_id)
+        if message.content.ref is None:
+            self.posts[record_id] = message
+        else:
+            latest = self.amends.get(record_id)
+            if latest is None or get_order(message) > get_order(latest):
+                self.amends[record_id] = message
+
+        if len(self) >= self.max_batch:
+            self.full.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while len(self):
+            try:
+                await asyncio.wait_for(self.full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.full.clear()
+            await self.flush()
+
+    def get_batch_order(self, message: PostMessage) -> Tuple[float, bool, str]:
+        """
+        Orders messages by time, the amends of a record always following its
+        original post, even if their clocks disagree.
+        """
+        time = message.time
+        if message.content.ref is not None:
+            post = self.posts.get(message.content.ref)
+            if post is not None:
+                time = max(time, post.time)
+        return time, message.content.ref is not None, message.item_hash
+
+    def take_batch(self) -> List[PostMessage]:
+        messages = sorted(
+            [*self.posts.values(), *self.amends.values()], key=self.get_batch_order
+        )
+        if self.received > len(messages):
+            logger.debug(
+                f"Collapsed {self.received} events into {len(messages)} messages"
+            )
+        self.posts, self.amends, self.record_ids, self.received = {}, {}, set(), 0
+        # forget the failed messages superseded by newer revisions
+        self.attempts = {
+            message.item_hash: self.attempts[message.item_hash]
+            for message in messages
+            if message.item_hash in self.attempts
+        }
+        return messages
+
+    def requeue(self, messages: List[PostMessage]):
+        """Buffers the messages of a failed batch again, unless out of retries."""
+        for message in messages:
+            attempts = self.attempts.get(message.item_hash, 0) + 1
+            if attempts > self.retries:
+                logger.error(f"Dropping event {message.item_hash}, out of retries")
+                self.attempts.pop(message.item_hash, None)
+                continue
+            self.attempts[message.item_hash] = attempts
+            self.put(message)
+
+    async def flush(self):
+        """Applies the buffered messages, after the batches being applied."""
+        async with self.lock:
+            messages = self.take_batch()
+            if not messages:
+                return
+            try:
+                await self.handler(messages)
+            except Exception:
+                logger.exception(f"Failed to apply a batch of {len(messages)} events")
+                self.requeue(messages)
+            else:
+                for message in messages:
+                    self.attempts.pop(message.item_hash, None)
@@ -1,58 +1,601 @@
+import ast
+import asyncio
+import base64
+import hashlib
+import inspect
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import pickle
+import resource
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from os import getenv
+from typing import Any, Callable, Dict, List, Tuple, Union
+
 import pandas as pd
+from aleph.sdk.vm.cache import BaseVmCache
+from pydantic import BaseModel
+
+from .batch import SaveBatch
 from .model import *
 
+logger = logging.getLogger(__name__)
 
-async def run_execution(execution: Execution) -> Optional[Execution]:
-    async def set_failed(execution, reason):
-        execution.status = ExecutionStatus.FAILED
-        result = await Result(executionID=execution.id_hash, data=reason).save()
-        execution.resultID = result.id_hash
-        return await execution.save()
+# Ceilings of the resources an algorithm can use, executions can only lower them
+CPU_TIME_LIMIT = float(getenv("FISHNET_CPU_TIME_LIMIT", "300"))  # seconds
+WALL_TIME_LIMIT = float(getenv("FISHNET_WALL_TIME_LIMIT", "600"))  # seconds
+# Bytes of memory an algorithm can allocate, on top of the memory of the worker
+MEMORY_LIMIT = int(getenv("FISHNET_MEMORY_LIMIT", str(2 * 1024**3)))
+# How the processes running the algorithms are started, see multiprocessing
+START_METHOD = getenv("FISHNET_START_METHOD", "fork")
+# Parameter sets of a LIST or GRID execution, and processes evaluating them
+MAX_PARAM_SETS = int(getenv("FISHNET_MAX_PARAM_SETS", "10000"))
+MAX_PARALLELISM = int(getenv("FISHNET_MAX_PARALLELISM", str(os.cpu_count() or 1)))
+# Partial results of generator algorithms are saved as a ResultChunk every that
+# many seconds, or once they reach that many characters
+CHUNK_FLUSH_INTERVAL = float(getenv("FISHNET_CHUNK_FLUSH_INTERVAL", "5"))
+CHUNK_MAX_SIZE = int(getenv("FISHNET_CHUNK_MAX_SIZE", str(256 * 1024)))
 
-    assert isinstance(execution, Execution)
-    if execution.status != ExecutionStatus.PENDING:
-        return execution
 
-    execution.status = ExecutionStatus.RUNNING
-    await execution.save()
+@dataclass
+class ExecutionLimits:
+    cpu_time: float = CPU_TIME_LIMIT
+    wall_time: float = WALL_TIME_LIMIT
+    memory: int = MEMORY_LIMIT
+
+    @classmethod
+    def of(cls, execution: Execution) -> "ExecutionLimits":
+        def lower(requested, ceiling):
+            return ceiling if requested is None else min(requested, ceiling)
+
+        return cls(
+            cpu_time=lower(execution.cpuTimeLimit, CPU_TIME_LIMIT),
+            wall_time=lower(execution.wallTimeLimit, WALL_TIME_LIMIT),
+            memory=lower(execution.memoryLimit, MEMORY_LIMIT),
+        )
+
 
+@dataclass
+class AlgorithmRun:
+    """What a worker process runs, besides the dataframe."""
+
+    code: str
+    params: Union[List[dict], dict]
+    limits: ExecutionLimits
+    # sweeps over `params` as a list of parameter sets, in that many processes
+    # sharing the limits
+    parallelism: Optional[int] = None
+    # calls update(state, new_rows) instead of run, with the pickled `state`
+    incremental: bool = False
+    state: Optional[bytes] = None
+
+
+def get_address_space() -> int:
+    """Bytes of virtual memory used by the current process."""
     try:
-        try:
-            algorithm = (await Algorithm.fetch(execution.algorithmID))[0]
-        except IndexError:
-            return await set_failed(
-                execution, f"Algorithm {execution.algorithmID} not found"
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[0]) * resource.getpagesize()
+    except OSError:
+        return 0
+
+
+def set_limits(cpu_time: float, memory: int):
+    """Limits the CPU time and the memory the current process can use."""
+    cpu_time = math.ceil(cpu_time)
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_time, cpu_time + 1))
+    address_space = get_address_space() + memory
+    _, ceiling = resource.getrlimit(resource.RLIMIT_AS)
+    if ceiling != resource.RLIM_INFINITY:
+        address_space = min(address_space, ceiling)
+    resource.setrlimit(resource.RLIMIT_AS, (address_space, address_space))
+
+
+def get_param_sets(execution: Execution) -> List[Dict[str, Any]]:
+    """The keyword arguments of every run of a LIST or GRID execution."""
+    params = execution.params or ([] if execution.paramsMode == ParamsMode.LIST else {})
+    if execution.paramsMode == ParamsMode.LIST:
+        if not isinstance(params, list):
+            raise ExecutionFailed("LIST params must be a list of parameter sets")
+        param_sets = params
+    else:
+        if not isinstance(params, dict) or not all(
+            isinstance(values, list) for values in params.values()
+        ):
+            raise ExecutionFailed("GRID params must map parameters to lists of values")
+        names = list(params)
+        count = math.prod(len(params[name]) for name in names)
+        if count > MAX_PARAM_SETS:
+            raise ExecutionFailed(
+                f"{count} parameter sets exceed the limit of {MAX_PARAM_SETS}"
             )
+        param_sets = [
+            dict(zip(names, values))
+            for values in itertools.product(*(params[name] for name in names))
+        ]
+    if len(param_sets) > MAX_PARAM_SETS:
+        raise ExecutionFailed(
+            f"{len(param_sets)} parameter sets exceed the limit of {MAX_PARAM_SETS}"
+        )
+    return param_sets
+
 
+def exhaust(generator, on_part: Optional[Callable[[Any], None]] = None) -> Any:
+    """
+    Runs a generator algorithm to its end, passing every value it yields to
+    `on_part`. Its result is the value it returns, or else the last one it yielded.
+    """
+    last = None
+    while True:
         try:
-            exec(algorithm.code)
-        except Exception as e:
-            return await set_failed(execution, f"Failed to parse algorithm code: {e}")
+            part = next(generator)
+        except StopIteration as stop:
+            return last if stop.value is None else stop.value
+        if on_part is not None:
+            on_part(part)
+        last = part
+
+
+def to_scalar(value: Any) -> Any:
+    if hasattr(value, "item") and getattr(value, "ndim", None) == 0:
+        value = value.item()  # NumPy scalar
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def to_fields(result: Any) -> Dict[str, Any]:
+    """
+    Columns of the row of a run in the result of a sweep: one per item of a
+    dict or Series result, or a single `result` column.
+    """
+    if isinstance(result, pd.Series):
+        result = result.to_dict()
+    if isinstance(result, dict):
+        return {str(name): to_scalar(value) for name, value in result.items()}
+    return {"result": to_scalar(result)}
+
+
+# run function and dataframe of the sweep being evaluated, inherited by the
+# processes evaluating its parameter sets
+sweep_run = None
+sweep_df = None
+
+
+def run_param_set(params: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        result = sweep_run(sweep_df, **params)
+        if inspect.isgenerator(result):
+            result = exhaust(result)
+        fields = to_fields(result)
+        error = None
+    except Exception as e:
+        fields, error = {}, f"{type(e).__name__}: {e}"
+    return {**params, **fields, "error": error}
 
-        if "run" not in locals():
-            return await set_failed(execution, "No run(df: DataFrame) function found")
 
+def run_sweep(
+    run,
+    df: pd.DataFrame,
+    param_sets: List[dict],
+    parallelism: int,
+    limits: ExecutionLimits,
+) -> str:
+    """
+    Runs `run` with every parameter set, returning the rows of the runs as JSON
+    columns: the parameters, the fields of the result, and the error of failed runs.
+    Parallel runs are evaluated by processes which each get an equal share of the
+    CPU time and memory `limits`, as limits only apply to a single process.
+    """
+    global sweep_run, sweep_df
+    sweep_run, sweep_df = run, df
+    if parallelism > 1 and len(param_sets) > 1:
+        with ProcessPoolExecutor(
+            parallelism,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=set_limits,
+            initargs=(limits.cpu_time / parallelism, limits.memory // parallelism),
+        ) as pool:
+            chunksize = max(len(param_sets) // (parallelism * 4), 1)
+            rows = list(pool.map(run_param_set, param_sets, chunksize=chunksize))
+    else:
+        rows = [run_param_set(params) for params in param_sets]
+
+    names = list(dict.fromkeys(name for row in rows for name in row))
+    columns = {name: [row.get(name) for row in rows] for name in names}
+    return json.dumps(columns, default=str)
+
+
+def run_algorithm(connection, job: AlgorithmRun, df: pd.DataFrame):
+    """
+    Runs the algorithm in a worker process, within its limits, and sends back
+    whether it succeeded, its result or the reason it failed, and the pickled
+    state returned by `update` on incremental runs. The values yielded by a
+    generator `run` are sent as they come, with None instead of the first item.
+    """
+
+    def fail(reason: str):
+        connection.send((False, reason, None))
+
+    # in its own process group, to kill the processes of sweeps along with it
+    os.setpgid(0, 0)
+    set_limits(job.limits.cpu_time, job.limits.memory)
+
+    namespace = dict(globals())
+    namespace.pop("run", None)
+    try:
+        exec(job.code, namespace)
+    except MemoryError:
+        return fail("Memory limit exceeded")
+    except Exception as e:
+        return fail(f"Failed to parse algorithm code: {e}")
+    function = "update" if job.incremental else "run"
+    if not callable(namespace.get(function)):
+        if job.incremental:
+            return fail("No update(state, new_rows) function found")
+        return fail("No run(df: DataFrame) function found")
+
+    state = None
+    try:
+        if job.incremental:
+            previous = None if job.state is None else pickle.loads(job.state)
+            new_state, result = namespace["update"](previous, df, **job.params)
+            result, state = str(result), pickle.dumps(new_state)
+        elif job.parallelism is None:
+            result = namespace["run"](df, **job.params)
+            if inspect.isgenerator(result):
+                result = exhaust(
+                    result, lambda part: connection.send((None, str(part), None))
+                )
+            result = str(result)
+        else:
+            result = run_sweep(
+                namespace["run"], df, job.params, job.parallelism, job.limits
+            )
+    except MemoryError:
+        return fail("Memory limit exceeded")
+    except BrokenProcessPool:
+        return fail(
+            "A sweep process exceeded its share of the limits, "
+            f"1/{job.parallelism} of the CPU time and memory"
+        )
+    except Exception as e:
+        return fail(f"Failed to run algorithm: {e}")
+    connection.send((True, result, state))
+
+
+def describe_exit(exitcode: Optional[int], limits: ExecutionLimits) -> str:
+    if exitcode in (-signal.SIGXCPU, -signal.SIGKILL):
+        return f"CPU time limit of {limits.cpu_time}s exceeded"
+    return f"Algorithm worker exited with code {exitcode}"
+
+
+async def run_isolated(
+    job: AlgorithmRun,
+    df: pd.DataFrame,
+    on_part: Optional[Callable[[str], None]] = None,
+) -> Tuple[bool, str, Optional[bytes]]:
+    """
+    Runs the algorithm in its own process, which is killed along with its
+    children once the wall-clock time limit is reached. The partial results it
+    yields are passed to `on_part`, if given.
+    :return: whether the algorithm succeeded, its result or the reason it failed,
+        and its new state if incremental
+    """
+    limits = job.limits
+    context = multiprocessing.get_context(START_METHOD)
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(
+        target=run_algorithm,
+        args=(sender, job, df),
+    )
+    process.start()
+    sender.close()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + limits.wall_time
+    try:
+        while True:
+            timeout = deadline - loop.time()
+            if timeout <= 0 or not await loop.run_in_executor(
+                None, receiver.poll, timeout
+            ):
+                return (
+                    False,
+                    f"Wall-clock time limit of {limits.wall_time}s exceeded",
+                    None,
+                )
+            try:
+                message = receiver.recv()
+            except EOFError:
+                break  # the worker died without sending a result
+            if message[0] is not None:
+                return message
+            if on_part is not None:
+                on_part(message[1])
+    finally:
         try:
-            dataset = (await Dataset.fetch(execution.datasetID))[0]
-        except IndexError:
-            return await set_failed(
-                execution, f"Dataset {execution.datasetID} not found"
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass  # the worker and its children already exited
+        if process.is_alive():
+            process.kill()
+        await loop.run_in_executor(None, process.join)
+        receiver.close()
+    return False, describe_exit(process.exitcode, limits), None
+
+
+class ExecutionFailed(Exception):
+    """An execution failed, for the reason given as message."""
+
+
+class ResultStream:
+    """
+    Saves the partial results of an execution as ResultChunks, every
+    `flush_interval` seconds or once they reach `max_size` characters, so that
+    they can be followed while the algorithm runs. Partial results whose chunk
+    failed to save are kept for the next flush.
+    """
+
+    def __init__(
+        self,
+        execution: Execution,
+        flush_interval: float = CHUNK_FLUSH_INTERVAL,
+        max_size: int = CHUNK_MAX_SIZE,
+    ):
+        self.execution = execution
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.parts: List[str] = []
+        self.size = 0
+        self.count = 0  # chunks saved
+        self.flushed_at = time.monotonic()
+        self.full = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.closed = False
+
+    def add(self, part: str):
+        self.parts.append(part)
+        self.size += len(part)
+        if self.size >= self.max_size:
+            self.full.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        while self.parts and not self.closed:
+            delay = self.flushed_at + self.flush_interval - time.monotonic()
+            try:
+                await asyncio.wait_for(self.full.wait(), max(delay, 0))
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self):
+        self.full.clear()
+        self.flushed_at = time.monotonic()
+        parts, self.parts, self.size = self.parts, [], 0
+        if not parts:
+            return
+        chunk = ResultChunk(
+            executionID=self.execution.id_hash,
+            owner=self.execution.owner,
+            index=self.count,
+            data=parts,
+        )
+        batch = SaveBatch()
+        batch.add(chunk)
+        for _, error in (await batch.submit()).failed:
+            logger.error(
+                f"Failed to save {len(parts)} partial results of "
+                f"{self.execution.id_hash}, retrying on the next flush: {error!r}"
+            )
+            # before the parts added since, to be saved in order
+            self.parts = parts + self.parts
+            self.size += sum(len(part) for part in parts)
+            return
+        self.count += 1
+
+    async def close(self) -> int:
+        """Saves the remaining partial results, returning the number of chunks."""
+        self.closed = True
+        if self.task is not None:
+            self.full.set()
+            await self.task
+        await self.flush()
+        if self.parts:
+            logger.error(
+                f"Dropped {len(self.parts)} partial results of "
+                f"{self.execution.id_hash}"
             )
+        return self.count
+
+
+class IncrementalState(BaseModel):
+    """State returned by the `update` of an algorithm, as of the last row fed to it."""
+
+    codeHash: str
+    timeseriesIDs: List[str]
+    last: Any  # index of the last row
+    rowsHash: Optional[str]  # hash of the rows up to `last`
+    state: str  # base64 of the pickled state
+
+
+def get_state_key(execution: Execution) -> str:
+    params = json.dumps(execution.params or {}, sort_keys=True, default=str)
+    key = f"{execution.algorithmID}:{execution.datasetID}:{params}"
+    return "fishnet_state_" + hashlib.sha256(key.encode()).hexdigest()
+
+
+def get_code_hash(code: str) -> str:
+    return hashlib.sha256(code.encode()).hexdigest()
+
+
+def get_rows_hash(df: pd.DataFrame) -> str:
+    """Hash of the index and values of the rows of `df`."""
+    row_hashes = pd.util.hash_pandas_object(df, index=True).to_numpy()
+    return hashlib.sha256(row_hashes.tobytes()).hexdigest()
+
+
+@dataclass
+class ExecutionOutcome:
+    succeeded: bool
+    data: Optional[str] = None  # result, or reason of the failure
+    resultID: Optional[str] = None  # memoized result, saved by a previous execution
+    memoKey: Optional[str] = None
+    chunkCount: Optional[int] = None
 
-        timeseries = await Timeseries.fetch(dataset.timeseriesIDs)
+
+def get_content_hash(timeseries: Timeseries) -> str:
+    """Hash of the content of `timeseries` as fetched, its name and data included."""
+    canonical = json.dumps(
+        timeseries.content, sort_keys=True, separators=(",", ":"), default=str
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def get_memo_key(execution: Execution, code: str, timeseries_hashes: List[str]) -> str:
+    """
+    Hash of everything the result of an execution depends on: the algorithm code,
+    the content hashes of the timeseries of its dataset and its canonicalized params.
+    """
+    inputs = {
+        "code": get_code_hash(code),
+        "timeseries": timeseries_hashes,
+        "paramsMode": execution.paramsMode,
+        "params": execution.params or {},
+    }
+    canonical = json.dumps(inputs, sort_keys=True, separators=(",", ":"), default=str)
+    return "fishnet_memo_" + hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def defines_update(code: str) -> bool:
+    """Whether the algorithm opts in to incremental runs with an `update` function."""
+    return any(
+        isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+        and node.name == "update"
+        for node in ast.parse(code).body
+    )
+
+
+class ExecutionInputs:
+    """
+    Algorithms, datasets and timeseries of a group of executions, fetched at once.
+    The code of each algorithm is checked, and the dataframe of each dataset is
+    built, only once for all the executions using them.
+    """
+
+    def __init__(
+        self,
+        algorithms: Dict[str, Algorithm],
+        datasets: Dict[str, Dataset],
+        timeseries: Dict[str, Timeseries],
+        cache: Optional[BaseVmCache] = None,
+    ):
+        self.algorithms = algorithms
+        self.datasets = datasets
+        self.timeseries = timeseries
+        # where the states of incremental algorithms are kept, if any
+        self.cache = cache
+        self.codes: Dict[str, Union[str, ExecutionFailed]] = {}
+        self.dataframes: Dict[str, Union[pd.DataFrame, ExecutionFailed]] = {}
+        self.content_hashes: Dict[str, str] = {}
+
+    @classmethod
+    async def fetch(
+        cls, executions: List[Execution], cache: Optional[BaseVmCache] = None
+    ) -> "ExecutionInputs":
+        algorithms, datasets = await asyncio.gather(
+            Algorithm.fetch(sorted({e.algorithmID for e in executions})).all(),
+            Dataset.fetch(sorted({e.datasetID for e in executions})).all(),
+        )
+        timeseries_ids = sorted({ts for d in datasets for ts in d.timeseriesIDs})
+        timeseries = (
+            await Timeseries.fetch(timeseries_ids).all() if timeseries_ids else []
+        )
+        return cls(
+            {algorithm.id_hash: algorithm for algorithm in algorithms},
+            {dataset.id_hash: dataset for dataset in datasets},
+            {ts.id_hash: ts for ts in timeseries},
+            cache,
+        )
+
+    def get_code(self, algorithm_id: str) -> str:
+        if algorithm_id not in self.codes:
+            try:
+                self.codes[algorithm_id] = self.check_code(algorithm_id)
+            except ExecutionFailed as failure:
+                self.codes[algorithm_id] = failure
+        code = self.codes[algorithm_id]
+        if isinstance(code, ExecutionFailed):
+            raise code
+        return code
+
+    def check_code(self, algorithm_id: str) -> str:
+        algorithm = self.algorithms.get(algorithm_id)
+        if algorithm is None:
+            raise ExecutionFailed(f"Algorithm {algorithm_id} not found")
+        try:
+            compile(algorithm.code, f"<algorithm {algorithm_id}>", "exec")
+        except Exception as e:
+            raise ExecutionFailed(f"Failed to parse algorithm code: {e}")
+        return algorithm.code
+
+    def get_timeseries_hashes(self, dataset_id: str) -> List[str]:
+        """
+        Content hashes of the timeseries of a dataset, failing like its dataframe
+        would if the dataset or any of its timeseries was not found.
+        """
+        dataset = self.datasets.get(dataset_id)
+        if dataset is None or any(
+            timeseries_id not in self.timeseries
+            for timeseries_id in dataset.timeseriesIDs
+        ):
+            self.get_dataframe(dataset_id)
+        for timeseries_id in dataset.timeseriesIDs:
+            if timeseries_id not in self.content_hashes:
+                self.content_hashes[timeseries_id] = get_content_hash(
+                    self.timeseries[timeseries_id]
+                )
+        return [self.content_hashes[ts] for ts in dataset.timeseriesIDs]
+
+    def get_dataframe(self, dataset_id: str) -> pd.DataFrame:
+        if dataset_id not in self.dataframes:
+            try:
+                self.dataframes[dataset_id] = self.build_dataframe(dataset_id)
+            except ExecutionFailed as failure:
+                self.dataframes[dataset_id] = failure
+        df = self.dataframes[dataset_id]
+        if isinstance(df, ExecutionFailed):
+            raise df
+        return df
+
+    def build_dataframe(self, dataset_id: str) -> pd.DataFrame:
+        dataset = self.datasets.get(dataset_id)
+        if dataset is None:
+            raise ExecutionFailed(f"Dataset {dataset_id} not found")
+        timeseries = [
+            self.timeseries[timeseries_id]
+            for timeseries_id in dataset.timeseriesIDs
+            if timeseries_id in self.timeseries
+        ]
         if len(timeseries) != len(dataset.timeseriesIDs):
             if len(timeseries) == 0:
-                return await set_failed(
-                    execution, f"Timeseries for dataset {dataset.id_hash} not found"
+                raise ExecutionFailed(
+                    f"Timeseries for dataset {dataset.id_hash} not found"
                 )
-            return await set_failed(
-                execution,
-                f"Timeseries incomplete: {len(timeseries)} out of {len(dataset.timeseriesIDs)} found",
+            raise ExecutionFailed(
+                f"Timeseries incomplete: {len(timeseries)} out of {len(dataset.timeseriesIDs)} found"
             )
 
         try:
             # parse all timeseries as series and join them into a dataframe
-            df = pd.concat(
+            return pd.concat(
                 [
                     pd.Series(
                         [x[1] for x in ts.data],
@@ -64,22 +607,188 @@ async def run_execution(execution: Execution) -> Optional[Execution]:
                 axis=1,
             )
         except Exception as e:
-            return await set_failed(execution, f"Failed to create dataframe: {e}")
+            raise ExecutionFailed(f"Failed to create dataframe: {e}")
 
+    async def run(self, execution: Execution) -> ExecutionOutcome:
+        """
+        Runs the execution, unless the cache holds the result of an execution
+        with the same code, timeseries content and params. The cache is looked up
+        before the dataframe of the dataset is built.
+        """
         try:
-            assert "run" in locals()
-            result = locals()["run"](df, **execution.params)
-        except Exception as e:
-            return await set_failed(execution, f"Failed to run algorithm: {e}")
-
-        result_message = await Result(
-            executionID=execution.id_hash, data=str(result)
-        ).save()
-        execution.status = ExecutionStatus.SUCCESS
-        execution.resultID = result_message.id_hash
-        await execution.save()
+            code = self.get_code(execution.algorithmID)
+            limits = ExecutionLimits.of(execution)
+            if execution.paramsMode == ParamsMode.SINGLE:
+                params = execution.params or {}
+                if not isinstance(params, dict):
+                    raise ExecutionFailed("SINGLE params must be a parameter set")
+                job = AlgorithmRun(code, params, limits)
+            else:
+                parallelism = max(min(execution.parallelism or 1, MAX_PARALLELISM), 1)
+                job = AlgorithmRun(code, get_param_sets(execution), limits, parallelism)
+
+            memo_key = None
+            if self.cache is not None:
+                memo_key = get_memo_key(
+                    execution, code, self.get_timeseries_hashes(execution.datasetID)
+                )
+                result_id = await self.cache.get(memo_key)
+                if result_id is not None:
+                    return ExecutionOutcome(
+                        True, resultID=result_id.decode(), memoKey=memo_key
+                    )
+
+            df = self.get_dataframe(execution.datasetID)
+        except ExecutionFailed as failure:
+            return ExecutionOutcome(False, str(failure))
+
+        if job.parallelism is None and self.cache is not None and defines_update(code):
+            succeeded, result = await self.run_incremental(execution, job, df)
+        elif job.parallelism is not None:
+            succeeded, result, _ = await run_isolated(job, df)
+        else:
+            stream = ResultStream(execution)
+            try:
+                succeeded, result, _ = await run_isolated(job, df, stream.add)
+            finally:
+                chunk_count = await stream.close()
+            return ExecutionOutcome(
+                succeeded, result, memoKey=memo_key, chunkCount=chunk_count or None
+            )
+        return ExecutionOutcome(succeeded, result, memoKey=memo_key)
+
+    async def run_incremental(
+        self, execution: Execution, job: AlgorithmRun, df: pd.DataFrame
+    ) -> Tuple[bool, str]:
+        """
+        Feeds the rows appended to the dataframe since the previous run of the
+        algorithm on the dataset, with the same params, to its `update` function,
+        along with the state it returned then. Without a state, or if the code,
+        the timeseries of the dataset or any of the rows fed then changed, all
+        the rows are fed.
+        """
+        key = get_state_key(execution)
+        code_hash = get_code_hash(job.code)
+        timeseries_ids = self.datasets[execution.datasetID].timeseriesIDs
+        previous = None
+        cached = await self.cache.get(key)
+        if cached is not None:
+            previous = IncrementalState.parse_raw(cached)
+            if (
+                previous.codeHash != code_hash
+                or previous.timeseriesIDs != timeseries_ids
+                or previous.rowsHash != get_rows_hash(df[df.index <= previous.last])
+            ):
+                previous = None
+
+        job.incremental = True
+        rows = df
+        if previous is not None:
+            job.state = base64.b64decode(previous.state)
+            rows = df[df.index > previous.last]
+        succeeded, result, state = await run_isolated(job, rows)
+        if succeeded and len(df):
+            await self.cache.set(
+                key,
+                IncrementalState(
+                    codeHash=code_hash,
+                    timeseriesIDs=timeseries_ids,
+                    last=to_scalar(df.index.max()),
+                    rowsHash=get_rows_hash(df),
+                    state=base64.b64encode(state).decode(),
+                ).json(),
+            )
+        return succeeded, result
+
+
+async def save_outcomes(
+    executions: List[Execution],
+    outcomes: Dict[str, ExecutionOutcome],
+    cache: Optional[BaseVmCache] = None,
+) -> List[Execution]:
+    """
+    Saves the new result of every execution, then the executions, in two batches.
+    Successful results are memoized in `cache`, if given.
+    """
+    results = {
+        execution.id_hash: Result(
+            executionID=execution.id_hash,
+            owner=execution.owner,
+            data=outcomes[execution.id_hash].data,
+            memoKey=outcomes[execution.id_hash].memoKey,
+            chunkCount=outcomes[execution.id_hash].chunkCount,
+        )
+        for execution in executions
+        if outcomes[execution.id_hash].resultID is None
+    }
+    batch = SaveBatch()
+    batch.extend(results.values())
+    for result, error in (await batch.submit()).failed:
+        logger.error(f"Failed to save the result of {result.executionID}: {error!r}")
+
+    for execution in executions:
+        outcome = outcomes[execution.id_hash]
+        result = results.get(execution.id_hash)
+        if result is not None:
+            outcome.resultID = result.id_hash
+            if outcome.succeeded and outcome.memoKey and result.id_hash is not None:
+                await cache.set(outcome.memoKey, result.id_hash)
+        execution.resultID = outcome.resultID
+        if outcome.succeeded and outcome.resultID is not None:
+            execution.status = ExecutionStatus.SUCCESS
+        else:
+            execution.status = ExecutionStatus.FAILED
+    batch.extend(executions)
+    for execution, error in (await batch.submit()).failed:
+        logger.error(f"Failed to save execution {execution.id_hash}: {error!r}")
+    return executions
+
+
+async def run_executions(
+    executions: List[Execution],
+    claimed: bool = False,
+    cache: Optional[BaseVmCache] = None,
+) -> List[Execution]:
+    """
+    Runs PENDING executions together, loading their shared inputs only once.
+    Claimed executions have already been set to RUNNING by the scheduler of the
+    worker. Results are memoized, and the states of incremental algorithms are
+    kept, in `cache`, if given.
+    """
+    if not claimed:
+        executions = [e for e in executions if e.status == ExecutionStatus.PENDING]
+        for execution in executions:
+            execution.status = ExecutionStatus.RUNNING
+        async with SaveBatch() as batch:
+            batch.extend(executions)
+    if not executions:
+        return []
+
+    outcomes: Dict[str, ExecutionOutcome] = {}
+    try:
+        inputs = await ExecutionInputs.fetch(executions, cache)
+        for execution in executions:
+            outcomes[execution.id_hash] = await inputs.run(execution)
     except Exception as e:
-        return await set_failed(execution, f"Unexpected error occurred: {e}")
-    finally:
-        del locals()["run"]
+        for execution in executions:
+            outcomes.setdefault(
+                execution.id_hash,
+                ExecutionOutcome(False, f"Unexpected error occurred: {e}"),
+            )
+    return await save_outcomes(executions, outcomes, cache)
+
+
+async def run_execution(
+    execution: Execution,
+    claimed: bool = False,
+    cache: Optional[BaseVmCache] = None,
+) -> Optional[Execution]:
+    """
+    Runs a PENDING execution. A `claimed` execution has already been set to
+    RUNNING by the scheduler of the worker.
+    """
+    assert isinstance(execution, Execution)
+    if not claimed and execution.status != ExecutionStatus.PENDING:
         return execution
+    await run_executions([execution], claimed, cache)
+    return execution
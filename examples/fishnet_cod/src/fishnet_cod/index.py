@@ -0,0 +1,427 @@
+import bisect
+from dataclasses import dataclass
+from itertools import product
+from operator import attrgetter
+from typing import (
+    Any,
+    Dict,
+    Generic,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    TypeVar,
+)
+
+from aars import AARS, Index, Record
+from aars.utils import EmptyAsyncIterator, IndexQuery, PageableResponse
+
+__all__ = [
+    "AllOf",
+    "InvertedIndex",
+    "Range",
+    "RecordPage",
+    "SortedIndex",
+    "fetch_page",
+    "load_index",
+    "where",
+]
+
+R = TypeVar("R", bound=Record)
+
+
+@dataclass(frozen=True)
+class Range:
+    """
+    Condition matching the values between `start` and `end`, both included.
+    A bound set to None leaves the range open on that side.
+    """
+
+    start: Any = None
+    end: Any = None
+
+    def __contains__(self, value) -> bool:
+        if value is None:
+            return False
+        if self.start is not None and value < self.start:
+            return False
+        if self.end is not None and value > self.end:
+            return False
+        return True
+
+
+@dataclass(frozen=True)
+class AllOf:
+    """
+    Condition on a list property, matching the records whose list contains all
+    of `values`. A plain list of values matches the ones containing any of them.
+    """
+
+    values: Tuple[Any, ...]
+
+    def __init__(self, values: Iterable[Any]):
+        object.__setattr__(self, "values", tuple(values))
+
+
+class InvertedIndex(Index[R]):
+    """
+    Index on a list property, with a bucket for every element found in the lists,
+    to look up the records containing some elements instead of a whole list.
+
+    >>> InvertedIndex(Dataset, 'timeseriesIDs')
+    >>> await where(Dataset, timeseriesIDs=[timeseries_id, other_id]).all()  # any of
+    >>> await where(Dataset, timeseriesIDs=AllOf([timeseries_id, other_id])).all()
+    """
+
+    def __init__(self, record_type: Type[R], on: str):
+        if not isinstance(on, str):
+            raise ValueError("An InvertedIndex can only be declared on one property")
+        super().__init__(record_type, on)
+
+    def get_keys(self, obj: R) -> Set[Tuple]:
+        return {(value,) for value in getattr(obj, self.index_on[0]) or ()}
+
+    def add_record(self, obj: R):
+        assert obj.id_hash is not None
+        for key in self.get_keys(obj):
+            add_to_bucket(self, key, obj.id_hash)
+
+    def remove_record(self, obj: R):
+        assert obj.id_hash is not None
+        for key in self.get_keys(obj):
+            remove_from_bucket(self, key, obj.id_hash)
+
+    def lookup_any(self, values: Iterable[Any]) -> Set[str]:
+        """Returns the id hashes of the records containing any of `values`."""
+        id_hashes: Set[str] = set()
+        for value in set(values):
+            id_hashes.update(self.hashmap.get((value,), ()))
+        return id_hashes
+
+    def lookup_all(self, values: Iterable[Any]) -> Set[str]:
+        """Returns the id hashes of the records containing all of `values`."""
+        buckets = sorted(
+            (self.hashmap.get((value,), set()) for value in set(values)), key=len
+        )
+        if not buckets:
+            return set()
+        return buckets[0].intersection(*buckets[1:])
+
+
+class SortedIndex(Index[R]):
+    """
+    Index on a single property which also keeps its keys sorted, to look up the
+    records of a `Range` of keys. Records with a None key, such as the timestamp
+    of a record being saved, are left out until they have one.
+
+    >>> SortedIndex(MyRecord, 'timestamp')
+    >>> await where(MyRecord, timestamp=Range(start=1672531200)).all()
+    """
+
+    sorted_keys: List[Tuple] = []
+
+    def get_key(self, obj: R) -> Tuple:
+        key = attrgetter(*self.index_on)(obj)
+        return key if len(self.index_on) > 1 else (key,)
+
+    def add_record(self, obj: R):
+        assert obj.id_hash is not None
+        key = self.get_key(obj)
+        if None not in key:
+            add_to_bucket(self, key, obj.id_hash)
+
+    def remove_record(self, obj: R):
+        assert obj.id_hash is not None
+        remove_from_bucket(self, self.get_key(obj), obj.id_hash)
+
+    def regenerate(self, items: List[R]):
+        self.sorted_keys = []
+        super().regenerate(items)
+
+    def load(self, hashmap: Dict[Tuple, Set[str]]):
+        # snapshots may hold records indexed before they had a key
+        self.hashmap = {key: ids for key, ids in hashmap.items() if None not in key}
+        self.sorted_keys = sorted(self.hashmap)
+
+    def lookup_range(self, key_range: Range) -> Set[str]:
+        """Returns the id hashes of the records with a key in `key_range`."""
+        start = 0
+        end = len(self.sorted_keys)
+        if key_range.start is not None:
+            start = bisect.bisect_left(self.sorted_keys, (key_range.start,))
+        if key_range.end is not None:
+            end = bisect.bisect_right(self.sorted_keys, (key_range.end,))
+        id_hashes: Set[str] = set()
+        for key in self.sorted_keys[start:end]:
+            id_hashes.update(self.hashmap[key])
+        return id_hashes
+
+
+def as_key(key: Any) -> Tuple:
+    """The key of an index bucket as a tuple, as `Index` only wraps single strings."""
+    return key if isinstance(key, tuple) else (key,)
+
+
+def get_keys(index: Index, obj: Any) -> Set[Any]:
+    """The keys of the buckets of `index` holding `obj`, as stored in its hashmap."""
+    if isinstance(index, InvertedIndex):
+        return index.get_keys(obj)
+    if isinstance(index, SortedIndex):
+        key = index.get_key(obj)
+        return set() if None in key else {key}
+    key = attrgetter(*index.index_on)(obj)
+    return {(key,) if isinstance(key, str) else key}
+
+
+def add_to_bucket(index: Index, key: Any, id_hash: str):
+    if key not in index.hashmap:
+        index.hashmap[key] = set()
+        if isinstance(index, SortedIndex):
+            bisect.insort(index.sorted_keys, key)
+    index.hashmap[key].add(id_hash)
+
+
+def remove_from_bucket(index: Index, key: Any, id_hash: str):
+    """Removes `id_hash` from a bucket, and the bucket itself once empty."""
+    bucket = index.hashmap.get(key)
+    if bucket is None:
+        return
+    bucket.discard(id_hash)
+    if not bucket:
+        del index.hashmap[key]
+        if isinstance(index, SortedIndex):
+            sorted_keys = index.sorted_keys
+            del sorted_keys[bisect.bisect_left(sorted_keys, key)]
+
+
+def move_record(index: Index, id_hash: str, old_keys: Set[Any], new_keys: Set[Any]):
+    """Moves a record from the buckets of `old_keys` to those of `new_keys`."""
+    for key in old_keys - new_keys:
+        remove_from_bucket(index, key, id_hash)
+    for key in new_keys - old_keys:
+        add_to_bucket(index, key, id_hash)
+
+
+def load_index(index: Index, hashmap: Dict[Tuple, Set[str]]):
+    """Replaces the buckets of `index` with the ones of `hashmap`."""
+    if isinstance(index, SortedIndex):
+        index.load(hashmap)
+    elif isinstance(index, InvertedIndex):
+        index.hashmap = hashmap
+    else:
+        index.hashmap = {
+            key[0] if len(key) == 1 and not isinstance(key[0], str) else key: ids
+            for key, ids in hashmap.items()
+        }
+
+
+def matches(value: Any, condition: Any) -> bool:
+    """
+    Whether `value` fulfills a query condition: a value, a list of values, a `Range`
+    or, for list properties, `AllOf` values.
+    """
+    if isinstance(condition, Range):
+        return value in condition
+    if isinstance(value, list):
+        if isinstance(condition, AllOf):
+            return set(condition.values).issubset(value)
+        return any(element in value for element in as_values(condition))
+    if isinstance(condition, (list, tuple, set, frozenset)):
+        return value in condition
+    return value == condition
+
+
+def as_values(condition: Any) -> Iterable[Any]:
+    if isinstance(condition, (list, tuple, set, frozenset)):
+        return condition
+    return [condition]
+
+
+def lookup_index(index: Index, conditions: Dict[str, Any]) -> Set[str]:
+    """
+    Returns the id hashes of the records of `index` fulfilling `conditions`,
+    given for each of the properties of the index.
+    """
+    if isinstance(index, InvertedIndex):
+        condition = conditions[index.index_on[0]]
+        if isinstance(condition, AllOf):
+            return index.lookup_all(condition.values)
+        if isinstance(condition, Range):
+            raise IndexError(f"{index} cannot look up ranges")
+        return index.lookup_any(as_values(condition))
+    ranges = [
+        key for key, condition in conditions.items() if isinstance(condition, Range)
+    ]
+    if ranges:
+        if not isinstance(index, SortedIndex) or index.index_on != ranges:
+            raise IndexError(f"{index} cannot look up ranges of {', '.join(ranges)}")
+        return index.lookup_range(conditions[ranges[0]])
+    id_hashes: Set[str] = set()
+    for key in product(*[as_values(conditions[name]) for name in index.index_on]):
+        id_hashes.update(index.hashmap.get(key, ()))
+    return id_hashes
+
+
+def get_exact_index(record_type: Type[Record], keys: List[str]) -> Optional[Index]:
+    name = IndexQuery(record_type, **{key: None for key in keys}).get_index_name()
+    for index in record_type.get_indices():
+        if repr(index) == name:
+            return index
+    return None
+
+
+def lookup(record_type: Type[R], **conditions) -> Tuple[Set[str], Dict[str, Any]]:
+    """
+    Looks up the id hashes of the records fulfilling `conditions` in the indices of
+    `record_type`. An index on all the queried properties is used if declared.
+    Otherwise, the results of the indices on single properties are intersected.
+    :return: the id hashes and the conditions that no index could resolve
+    """
+    index = get_exact_index(record_type, list(conditions))
+    if index is not None:
+        return lookup_index(index, conditions), {}
+
+    id_hashes: Optional[Set[str]] = None
+    unresolved = {}
+    for name, condition in conditions.items():
+        index = get_exact_index(record_type, [name])
+        if index is None:
+            unresolved[name] = condition
+            continue
+        found = lookup_index(index, {name: condition})
+        id_hashes = found if id_hashes is None else id_hashes & found
+    if id_hashes is None:
+        raise IndexError(
+            f"No index found for {IndexQuery(record_type, **conditions).get_index_name()}"
+        )
+    return id_hashes, unresolved
+
+
+async def filter_records(records, conditions: Dict[str, Any]):
+    async for record in records:
+        if all(
+            matches(getattr(record, name, None), condition)
+            for name, condition in conditions.items()
+        ):
+            yield record
+
+
+def get_checked_conditions(conditions: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    The conditions to check again on the fetched records, as indices may not
+    have applied their latest revision yet. Conditions on the metadata of the
+    records, like their `timestamp`, are left to the indices: they are taken
+    from the message of the revision that was indexed.
+    """
+    return {
+        name: condition
+        for name, condition in conditions.items()
+        if name not in Record.__fields__
+    }
+
+
+def where(record_type: Type[R], **conditions) -> PageableResponse[R]:
+    """
+    Queries records through the indices of `record_type`, like `Record.where_eq`.
+    Conditions can also be lists, matching any of their values, or a `Range`
+    on a property with a `SortedIndex`. On a property with an `InvertedIndex`,
+    they match the records whose list contains any of the values, or all of them
+    if given as `AllOf`.
+
+    >>> await where(Execution, status=[ExecutionStatus.PENDING, ExecutionStatus.RUNNING]).all()
+    >>> await where(Execution, owner=address, timestamp=Range(start=since)).all()
+
+    Conditions with a None value are ignored. All conditions are also checked on
+    the fetched records, so that records amended since they were indexed, or on
+    properties that are not indexed, are filtered out.
+    """
+    conditions = {
+        name: value for name, value in conditions.items() if value is not None
+    }
+    id_hashes, unresolved = lookup(record_type, **conditions)
+    if not id_hashes:
+        return PageableResponse(EmptyAsyncIterator())
+    records = AARS.fetch_records(record_type, sorted(id_hashes))
+    checked = {**get_checked_conditions(conditions), **unresolved}
+    if checked:
+        records = filter_records(records, checked)
+    return PageableResponse(records)
+
+
+def get_all_ids(record_type: Type[Record]) -> Set[str]:
+    """
+    Returns the id hashes of all the indexed records of `record_type`, from an
+    index on a single property which every record has a value for.
+    """
+    for index in record_type.get_indices():
+        if isinstance(index, InvertedIndex) or len(index.index_on) != 1:
+            continue
+        field = record_type.__fields__.get(index.index_on[0])
+        if field is not None and field.required:
+            return set().union(*index.hashmap.values())
+    raise IndexError(f"No index found on a required property of {record_type}")
+
+
+@dataclass
+class RecordPage(Generic[R]):
+    records: List[R]
+    next_cursor: Optional[str] = None  # id hash of the last record, if more follow
+
+
+async def fetch_page(
+    record_type: Type[R],
+    after: Optional[str] = None,
+    limit: Optional[int] = None,
+    offset: int = 0,
+    **conditions,
+) -> RecordPage[R]:
+    """
+    Fetches a page of the records fulfilling `conditions`, ordered by id hash.
+    The page starts after the id hash `after`, the cursor returned with the previous
+    page, and skips `offset` records. The ids are looked up in the indices, and only
+    fetched until the page is full, checking the conditions on the fetched records
+    as `where` does.
+    """
+    conditions = {
+        name: value for name, value in conditions.items() if value is not None
+    }
+    if conditions:
+        id_hashes, unresolved = lookup(record_type, **conditions)
+    else:
+        id_hashes, unresolved = get_all_ids(record_type), {}
+    ids = sorted(id_hashes)
+    if after is not None:
+        ids = ids[bisect.bisect_right(ids, after) :]
+    checked = {**get_checked_conditions(conditions), **unresolved}
+    if not checked:
+        # every id looked up is a record of the page
+        ids = ids[offset:]
+        offset = 0
+
+    records: List[R] = []
+    skipped = 0
+    position = 0
+    while position < len(ids) and (limit is None or len(records) < limit):
+        wanted = len(ids) if limit is None else limit - len(records) + offset - skipped
+        batch_ids = ids[position : position + wanted]
+        position += len(batch_ids)
+        fetched = {
+            record.id_hash: record
+            async for record in filter_records(
+                AARS.fetch_records(record_type, batch_ids), checked
+            )
+        }
+        for id_hash in batch_ids:
+            record = fetched.get(id_hash)
+            if record is None:
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            if limit is not None and len(records) == limit:
+                return RecordPage(records, records[-1].id_hash)
+            records.append(record)
+    has_more = position < len(ids)
+    return RecordPage(records, ids[position - 1] if has_more else None)
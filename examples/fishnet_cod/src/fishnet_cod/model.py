@@ -1,8 +1,10 @@
 from enum import Enum
-from typing import List, Tuple, Optional, Dict
+from typing import List, Tuple, Optional, Dict, Union
 
 from aars import Record, Index
 
+from .index import InvertedIndex, SortedIndex
+
 
 class UserInfo(Record):
     datasetIDs: List[str]
@@ -63,13 +65,30 @@ class ExecutionStatus(str, Enum):
     FAILED = "FAILED"
 
 
+class ParamsMode(str, Enum):
+    SINGLE = "SINGLE"  # params are the keyword arguments of run
+    LIST = "LIST"  # params are a list of keyword arguments, run with each of them
+    GRID = "GRID"  # params map arguments to values, run with every combination
+
+
 class Execution(Record):
     algorithmID: str
     datasetID: str
     owner: str
     status: ExecutionStatus = ExecutionStatus.REQUESTED
     resultID: Optional[str]
-    params: Optional[dict]
+    params: Optional[Union[List[dict], dict]]
+    paramsMode: ParamsMode = ParamsMode.SINGLE
+    # processes evaluating the parameter sets of a LIST or GRID execution
+    parallelism: Optional[int]
+    priority: int = 0  # executions of higher priority are run first
+    worker: Optional[str]  # worker holding the lease of the execution
+    leaseExpiresAt: Optional[float]
+    batchID: Optional[str]  # executions requested together, run together
+    # resources the algorithm can use, lowering the limits of the executor
+    cpuTimeLimit: Optional[float]  # seconds
+    wallTimeLimit: Optional[float]  # seconds
+    memoryLimit: Optional[int]  # bytes
 
 
 class PermissionStatus(str, Enum):
@@ -97,7 +116,20 @@ class Permission(Record):
 
 class Result(Record):
     executionID: str
+    owner: Optional[str]  # owner of the execution, missing on older results
     data: str
+    # hash of the algorithm code, timeseries revisions and params of the
+    # execution, which later executions with the same ones reuse this result for
+    memoKey: Optional[str]
+    # partial results streamed as ResultChunks while the algorithm was running
+    chunkCount: Optional[int]
+
+
+class ResultChunk(Record):
+    executionID: str
+    owner: Optional[str]
+    index: int  # position among the chunks of the execution
+    data: List[str]  # values yielded by the algorithm, in order
 
 
 # indexes to fetch data for permissions
@@ -106,20 +138,29 @@ Index(Permission, ["requestor", "timeseriesID"])
 Index(Permission, "timeseriesID")
 Index(Permission, ["timeseriesID", "requestor"])
 Index(Permission, "requestor")
+SortedIndex(Permission, "timestamp")
 
 
 # indexes to fetch data for Executions
 Index(Execution, "owner")
 Index(Execution, "datasetID")
 Index(Execution, "status")
+SortedIndex(Execution, "timestamp")
 
 # indexes to fetch data for Timeseries
 Index(Timeseries, "owner")
 
 # indexes to fetch data for Algorithms
 Index(Algorithm, "owner")
+Index(Algorithm, "name")
 
 # indexes to fetch data for Datasets
 Index(Dataset, "owner")
-Index(Dataset, "timeseriesIDs")
+InvertedIndex(Dataset, "timeseriesIDs")
+
+# indexes to fetch data for Results
+Index(Result, "owner")
+Index(Result, "executionID")
 
+# indexes to fetch data for ResultChunks
+Index(ResultChunk, "executionID")
@@ -0,0 +1,371 @@
+"""
+Scheduling of the executions run by executor nodes.
+
+Every executor receives every execution, and keeps the PENDING ones in a queue,
+ordered by priority and taking turns between their owners. Idle workers claim
+the next execution of their queue by amending it to RUNNING with a lease: their
+worker id and the time until which the execution is theirs. The lease is renewed
+by heartbeats while the execution runs, and executions whose lease expired are
+claimed again.
+
+Aleph has no atomic updates, so concurrent claims are all posted. After a settle
+delay, a worker replays the revisions of the execution and only runs it if its
+claim is the first one made while no other lease was valid. Every worker comes
+to the same conclusion, as long as the claims reached the node before the end of
+the settle delay.
+"""
+
+import asyncio
+import heapq
+import logging
+import time
+from os import getenv
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from uuid import uuid4
+
+from aars import AARS
+from aleph_message.models import MessageType, PostMessage
+from pydantic import ValidationError
+
+from .batch import SaveBatch
+from .events import get_order, get_record_id
+from .model import Execution, ExecutionStatus
+
+__all__ = ["ExecutionQueue", "Scheduler"]
+
+logger = logging.getLogger(__name__)
+
+WORKER_ID = getenv("FISHNET_WORKER_ID") or uuid4().hex
+# Executions run at the same time by a worker
+WORKER_CONCURRENCY = int(getenv("FISHNET_WORKER_CONCURRENCY", "1"))
+# Seconds a claim or heartbeat keeps an execution leased for
+LEASE_DURATION = float(getenv("FISHNET_LEASE_DURATION", "60"))
+HEARTBEAT_INTERVAL = float(getenv("FISHNET_HEARTBEAT_INTERVAL", "20"))
+# Executions of a batch claimed and run together by a worker
+MAX_BATCH_SIZE = int(getenv("FISHNET_MAX_BATCH_SIZE", "50"))
+# Seconds waited for concurrent claims to reach the node before checking them
+CLAIM_SETTLE_DELAY = float(getenv("FISHNET_CLAIM_SETTLE_DELAY", "2"))
+# Messages fetched per page when reading the history of the channel
+MESSAGES_PAGE_SIZE = int(getenv("FISHNET_MESSAGES_PAGE_SIZE", "200"))
+
+FINISHED_STATUSES = [
+    ExecutionStatus.DENIED,
+    ExecutionStatus.SUCCESS,
+    ExecutionStatus.FAILED,
+]
+
+
+class ExecutionQueue:
+    """
+    Queued executions, popped by descending priority. Between owners whose next
+    executions have the same priority, the one served least recently goes first,
+    so that an owner requesting many executions does not starve the others.
+    """
+
+    def __init__(self):
+        # owner -> heap of (-priority, timestamp, id_hash)
+        self.queues: Dict[str, List[Tuple[int, float, str]]] = {}
+        self.entries: Dict[str, Tuple[int, float, str]] = {}
+        self.executions: Dict[str, Execution] = {}
+        # batch id -> ids of its queued executions
+        self.batches: Dict[str, Set[str]] = {}
+        # owner -> turn at which their last execution was popped
+        self.served: Dict[str, int] = {}
+        self.turn = 0
+
+    def __len__(self) -> int:
+        return len(self.executions)
+
+    def __contains__(self, id_hash: str) -> bool:
+        return id_hash in self.executions
+
+    def push(self, execution: Execution):
+        """Queues `execution`, or updates it if already queued."""
+        entry = (-execution.priority, execution.timestamp or 0, execution.id_hash)
+        self.executions[execution.id_hash] = execution
+        if execution.batchID is not None:
+            self.batches.setdefault(execution.batchID, set()).add(execution.id_hash)
+        if self.entries.get(execution.id_hash) != entry:
+            self.entries[execution.id_hash] = entry
+            heapq.heappush(self.queues.setdefault(execution.owner, []), entry)
+
+    def remove(self, id_hash: str) -> Optional[Execution]:
+        # the heap entry is dropped when reaching the top of the owner's queue
+        self.entries.pop(id_hash, None)
+        execution = self.executions.pop(id_hash, None)
+        if execution is not None and execution.batchID is not None:
+            batch = self.batches[execution.batchID]
+            batch.discard(id_hash)
+            if not batch:
+                del self.batches[execution.batchID]
+        return execution
+
+    def peek_entry(self, owner: str) -> Optional[Tuple[int, float, str]]:
+        queue = self.queues[owner]
+        while queue and self.entries.get(queue[0][2]) != queue[0]:
+            heapq.heappop(queue)
+        return queue[0] if queue else None
+
+    def pop(self) -> Optional[Execution]:
+        best: Optional[Tuple[Tuple[int, int, float], str]] = None
+        for owner in list(self.queues):
+            entry = self.peek_entry(owner)
+            if entry is None:
+                del self.queues[owner]
+                continue
+            priority, timestamp, _ = entry
+            order = (priority, self.served.get(owner, -1), timestamp)
+            if best is None or order < best[0]:
+                best = (order, owner)
+        if best is None:
+            return None
+
+        owner = best[1]
+        self.turn += 1
+        self.served[owner] = self.turn
+        _, _, id_hash = heapq.heappop(self.queues[owner])
+        return self.remove(id_hash)
+
+    def pop_batch(self, limit: int = MAX_BATCH_SIZE) -> List[Execution]:
+        """Pops the next execution, along with the queued ones of its batch."""
+        execution = self.pop()
+        if execution is None:
+            return []
+        executions = [execution]
+        if execution.batchID is not None:
+            for id_hash in sorted(self.batches.get(execution.batchID, ()))[: limit - 1]:
+                executions.append(self.remove(id_hash))
+        return executions
+
+
+def get_lease_holder(revisions: List[PostMessage]) -> Optional[str]:
+    """
+    Replays the amends of an execution, returning the worker holding its lease,
+    or the one which finished it. A claim is only taken into account if made
+    while no other lease was valid.
+    """
+    holder: Optional[str] = None
+    expires_at = 0.0
+    for message in sorted(revisions, key=lambda m: (m.time, m.item_hash)):
+        content = message.content.content
+        status = content.get("status")
+        if status == ExecutionStatus.RUNNING:
+            worker = content.get("worker")
+            if holder is None or message.time > expires_at or worker == holder:
+                holder = worker
+                expires_at = content.get("leaseExpiresAt") or 0.0
+        elif status in FINISHED_STATUSES:
+            expires_at = float("inf")
+        else:
+            holder = None
+    return holder
+
+
+async def fetch_all_messages(**filters) -> List[PostMessage]:
+    """Fetches every message of the channel matching `filters`, page after page."""
+    messages: List[PostMessage] = []
+    page = 1
+    while True:
+        response = await AARS.session.get_messages(
+            channels=[AARS.channel],
+            pagination=MESSAGES_PAGE_SIZE,
+            page=page,
+            **filters,
+        )
+        messages.extend(response.messages)
+        if page * response.pagination_per_page >= response.pagination_total:
+            return messages
+        page += 1
+
+
+async def fetch_amends(execution: Execution) -> List[PostMessage]:
+    messages = await fetch_all_messages(refs=[execution.id_hash])
+    return [
+        message
+        for message in messages
+        if getattr(message.content, "type", None) == "amend"
+    ]
+
+
+async def fetch_queued_executions() -> List[Execution]:
+    """
+    Fetches the executions which are PENDING or RUNNING as of their latest
+    revision. The messages of executions and amends are read once, as the
+    channel cannot be queried by status, instead of fetching every execution
+    and then its revisions.
+    """
+    messages = await fetch_all_messages(
+        message_type=MessageType.post, content_types=["Execution", "amend"]
+    )
+    execution_ids: Set[str] = set()
+    latest: Dict[str, PostMessage] = {}
+    for message in sorted(messages, key=get_order):
+        if message.content.type == "Execution":
+            execution_ids.add(message.item_hash)
+        latest[get_record_id(message)] = message
+
+    executions = []
+    for id_hash in execution_ids:
+        message = latest[id_hash]
+        if message.content.content.get("status") not in (
+            ExecutionStatus.PENDING,
+            ExecutionStatus.RUNNING,
+        ):
+            continue
+        try:
+            execution = Execution(**message.content.content)
+        except ValidationError:
+            continue
+        execution.id_hash = id_hash
+        execution.timestamp = message.time
+        executions.append(execution)
+    return executions
+
+
+def is_lease_expired(execution: Execution, now: Optional[float] = None) -> bool:
+    return (execution.leaseExpiresAt or 0.0) < (now or time.time())
+
+
+class Scheduler:
+    """
+    Queues the executions received by a worker and runs the ones it claims with
+    `run`, up to `concurrency` batches at a time. Executions requested together
+    are claimed and run together, so that their shared inputs are loaded once.
+    """
+
+    def __init__(
+        self,
+        run: Callable[[List[Execution]], Awaitable[List[Execution]]],
+        worker: str = WORKER_ID,
+        concurrency: int = WORKER_CONCURRENCY,
+        lease_duration: float = LEASE_DURATION,
+        heartbeat_interval: float = HEARTBEAT_INTERVAL,
+        settle_delay: float = CLAIM_SETTLE_DELAY,
+    ):
+        self.run = run
+        self.worker = worker
+        self.concurrency = concurrency
+        self.lease_duration = lease_duration
+        self.heartbeat_interval = heartbeat_interval
+        self.settle_delay = settle_delay
+        self.queue = ExecutionQueue()
+        # executions leased by other workers, claimed again once expired
+        self.leased: Dict[str, Execution] = {}
+        # id_hash -> task running the batch of the execution
+        self.running: Dict[str, asyncio.Task] = {}
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def submit(self, execution: Execution):
+        """Updates the queue with the latest revision of `execution`."""
+        id_hash = execution.id_hash
+        if id_hash in self.running:
+            return
+        self.queue.remove(id_hash)
+        self.leased.pop(id_hash, None)
+        if execution.status == ExecutionStatus.PENDING:
+            self.queue.push(execution)
+        elif execution.status == ExecutionStatus.RUNNING:
+            self.leased[id_hash] = execution
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.dispatch())
+
+    def requeue_expired(self):
+        now = time.time()
+        for id_hash, execution in list(self.leased.items()):
+            if is_lease_expired(execution, now):
+                logger.info(f"Lease of execution {id_hash} expired")
+                del self.leased[id_hash]
+                self.queue.push(execution)
+
+    async def dispatch(self):
+        while self.queue or self.leased or self.running:
+            self.wakeup.clear()
+            self.requeue_expired()
+            while len(set(self.running.values())) < self.concurrency:
+                executions = self.queue.pop_batch()
+                if not executions:
+                    break
+                task = asyncio.create_task(self.work(executions))
+                for execution in executions:
+                    self.running[execution.id_hash] = task
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.heartbeat_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def work(self, executions: List[Execution]):
+        try:
+            claims = await asyncio.gather(
+                *[self.claim(execution) for execution in executions]
+            )
+            claimed = [execution for execution, won in zip(executions, claims) if won]
+            if claimed:
+                await self.run_leased(claimed)
+        except Exception:
+            logger.exception(f"Failed to run {len(executions)} executions")
+        finally:
+            for execution in executions:
+                del self.running[execution.id_hash]
+            self.wakeup.set()
+
+    async def claim(self, execution: Execution) -> bool:
+        """Leases `execution` to this worker, if no other worker claimed it first."""
+        amends = await fetch_amends(execution)
+        if amends:
+            latest = max(amends, key=lambda m: (m.time, m.item_hash))
+            latest_execution = Execution(**latest.content.content)
+            if latest_execution.status in FINISHED_STATUSES or (
+                latest_execution.status == ExecutionStatus.RUNNING
+                and not is_lease_expired(latest_execution)
+            ):
+                return False
+
+        execution.status = ExecutionStatus.RUNNING
+        execution.worker = self.worker
+        execution.leaseExpiresAt = time.time() + self.lease_duration
+        await execution.save()
+        await asyncio.sleep(self.settle_delay)
+
+        holder = get_lease_holder(await fetch_amends(execution))
+        if holder != self.worker:
+            logger.info(f"Execution {execution.id_hash} was claimed by {holder}")
+            return False
+        return True
+
+    async def run_leased(self, executions: List[Execution]):
+        """
+        Runs the claimed executions while renewing their lease, and stops them if
+        it could not be renewed, as other workers claim them once it expired.
+        """
+        run = asyncio.create_task(self.run(executions))
+        heartbeat = asyncio.create_task(self.heartbeat(executions))
+        try:
+            await asyncio.wait({run, heartbeat}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            heartbeat.cancel()
+            if not run.done():
+                run.cancel()
+        try:
+            await run
+        except asyncio.CancelledError:
+            logger.warning(f"Stopped {len(executions)} executions, lease lost")
+
+    async def heartbeat(self, executions: List[Execution]):
+        """Renews the lease of the running executions, until it fails to."""
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            batch = SaveBatch()
+            for execution in executions:
+                if execution.status == ExecutionStatus.RUNNING:
+                    execution.leaseExpiresAt = time.time() + self.lease_duration
+                    batch.add(execution)
+            report = await batch.submit()
+            if not report.ok:
+                for execution, error in report.failed:
+                    logger.warning(
+                        f"Could not renew the lease of execution {execution.id_hash}: "
+                        f"{error!r}"
+                    )
+                return
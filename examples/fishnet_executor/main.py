@@ -1,5 +1,6 @@
+import functools
 import logging
-from typing import Optional
+from typing import List
 
 logger = logging.getLogger(__name__)
 
@@ -9,13 +10,17 @@ from aleph_client.vm.cache import VmCache
 from aleph_client.vm.app import AlephApp
 
 logger.debug("import aars")
-from aars import AARS, Record
+from aars import AARS
 
 logger.debug("import fastapi")
 from fastapi import FastAPI
+from pydantic import ValidationError
 
 logger.debug("import fishnet-cod")
-from fishnet_cod import Execution, run_execution
+from fishnet_cod import EventQueue, Execution, Scheduler
+from fishnet_cod.events import get_record_id
+from fishnet_cod.execution import run_executions
+from fishnet_cod.scheduler import fetch_queued_executions
 
 logger.debug("imports done")
 
@@ -39,12 +44,37 @@ filters = [
 ]
 
 
+def get_execution(event: PostMessage) -> Execution:
+    """The execution as of `event`, queued at the time it was posted."""
+    execution = Execution(**event.content.content)
+    execution.id_hash = get_record_id(event)
+    execution.timestamp = event.time
+    return execution
+
+
+scheduler = Scheduler(functools.partial(run_executions, claimed=True, cache=cache))
+
+
+async def handle_executions(events: List[PostMessage]):
+    # only the latest revision of an execution tells whether it is still pending
+    latest = {get_record_id(event): event for event in events}
+    for event in latest.values():
+        try:
+            scheduler.submit(get_execution(event))
+        except ValidationError:
+            pass  # amend of another record type
+
+
+execution_events = EventQueue(handle_executions)
+
+
+@http_app.on_event("startup")
+async def startup():
+    # executions requested while the worker was down
+    for execution in await fetch_queued_executions():
+        scheduler.submit(execution)
+
+
 @app.event(filters=filters)
-async def handle_execution(event: PostMessage) -> Optional[Execution]:
-    if event.content.type in ["Execution"]:
-        cls: Record = globals()[event.content.type]
-        execution = await cls.from_post(event)
-    else:  # amend
-        execution = await Record.fetch(event.content.ref)
-    assert isinstance(execution, Execution)
-    return await run_execution(execution)
+async def queue_execution(event: PostMessage):
+    execution_events.put(event)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Write the index of the top-level modules available in a package volume.
+
+The index is written at the root of the volume, where `init1.py` in the VM
+reads it, and maps every module to its directory relative to that root. The
+listed modules are imported directly from the volume instead of scanning every
+entry of `sys.path`. Modules are looked up in the given directories of the
+volume, or at its root if none is given.
+
+Usage: build_module_index.py ROOT [DIRECTORY ...]
+"""
+import json
+import os
+import sys
+from importlib.machinery import EXTENSION_SUFFIXES, SOURCE_SUFFIXES
+from typing import Dict, List
+
+INDEX_FILENAME = ".module_index.json"
+
+
+def find_modules(root: str) -> List[str]:
+    """List the top-level modules and regular packages found in `root`.
+
+    Namespace packages are left out, as they may be split across several
+    directories of `sys.path` and must be found by the default finders.
+    """
+    modules = set()
+    for entry in os.listdir(root):
+        path = os.path.join(root, entry)
+        if os.path.isdir(path):
+            if entry.isidentifier() and os.path.isfile(
+                os.path.join(path, "__init__.py")
+            ):
+                modules.add(entry)
+            continue
+        for suffix in SOURCE_SUFFIXES + EXTENSION_SUFFIXES:
+            if entry.endswith(suffix):
+                name = entry[: -len(suffix)]
+                if name.isidentifier():
+                    modules.add(name)
+                break
+    return sorted(modules)
+
+
+def write_index(root: str, directories: List[str]) -> str:
+    modules: Dict[str, str] = {}
+    for directory in directories or [root]:
+        relative = os.path.relpath(directory, root)
+        if relative.startswith(os.pardir):
+            raise ValueError(f"{directory} is not in the volume root {root}")
+        for module in find_modules(directory):
+            modules.setdefault(module, relative)
+    path = os.path.join(root, INDEX_FILENAME)
+    with open(path, "w") as fd:
+        json.dump({"modules": modules}, fd)
+    return path
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__.strip().splitlines()[-1], file=sys.stderr)
+        sys.exit(1)
+    path = write_index(sys.argv[1], sys.argv[2:])
+    print(f"Module index written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
 #!/bin/sh
+# Build volume-venv.squashfs, a volume of Python packages to mount on /opt/packages.
+# The image compiles the packages and indexes their modules, like the
+# test-build-examples workflow does.
 
 set -euf
 
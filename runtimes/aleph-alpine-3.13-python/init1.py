@@ -12,11 +12,17 @@ logger.debug("Imports starting")
 
 import ctypes
 import asyncio
+import importlib
+import importlib.abc
+import importlib.machinery
+import importlib.util
+import json
 import os
 import socket
 from enum import Enum
 import subprocess
 import sys
+import sysconfig
 import traceback
 from contextlib import redirect_stdout
 from dataclasses import dataclass, field
@@ -75,6 +81,116 @@ class RunCodePayload:
     scope: Dict
 
 
+MODULE_INDEX_FILENAME = ".module_index.json"
+
+
+class IndexedModuleFinder(importlib.abc.MetaPathFinder):
+    """Finds top-level modules listed in the module indices shipped with volumes,
+    without scanning every entry of `sys.path`.
+
+    An index sits at the root of its volume, and maps every module to the
+    directory holding it, relative to that root. Modules listed in an index take
+    precedence over the ones of the rootfs, except for the runtime modules
+    already imported by init1.py. Submodules are found through the `__path__`
+    of their parent package.
+    """
+
+    def __init__(self):
+        self.locations: Dict[str, str] = {}
+
+    def add_index(self, root: str) -> bool:
+        path = os.path.join(root, MODULE_INDEX_FILENAME)
+        if not os.path.isfile(path):
+            return False
+        with open(path) as fd:
+            index = json.load(fd)
+        modules = index.get("modules", {})
+        if isinstance(modules, list):  # indices of a single directory, the root
+            modules = dict.fromkeys(modules, ".")
+        for module_name, directory in modules.items():
+            self.locations.setdefault(
+                module_name, os.path.normpath(os.path.join(root, directory))
+            )
+        logger.debug(f"Loaded module index {path}")
+        return True
+
+    def find_spec(self, fullname, path=None, target=None):
+        if path is not None:
+            return None
+        location = self.locations.get(fullname)
+        if location is None:
+            return None
+        return importlib.machinery.PathFinder.find_spec(fullname, [location], target)
+
+
+module_finder = IndexedModuleFinder()
+
+
+def setup_module_finder(roots: List[str]):
+    """Loads the module indices found in `roots`, installing the finder once."""
+    for root in roots:
+        try:
+            module_finder.add_index(root)
+        except (OSError, ValueError) as error:
+            logger.warning(f"Ignoring module index of {root}: {error}")
+    if module_finder.locations and module_finder not in sys.meta_path:
+        sys.meta_path.insert(0, module_finder)
+
+
+PRELOAD_MODULES_FILE = "/root/preload_modules.txt"
+# Third-party modules init1.py depends on, which are loaded in any case
+RUNTIME_MODULES = ("aiohttp", "msgpack")
+
+
+def is_runtime_module(module_name: str) -> bool:
+    """Whether a module belongs to the standard library or to the runtime itself,
+    and therefore cannot shadow a package shipped on a volume."""
+    top_level = module_name.split(".")[0]
+    if top_level in RUNTIME_MODULES or top_level in sys.builtin_module_names:
+        return True
+    spec = importlib.util.find_spec(top_level)
+    if spec is None or spec.origin is None:
+        return False
+    stdlib = sysconfig.get_paths()["stdlib"]
+    return spec.origin in ("built-in", "frozen") or (
+        spec.origin.startswith(stdlib + os.sep) and "site-packages" not in spec.origin
+    )
+
+
+def preload_modules(path: str = PRELOAD_MODULES_FILE):
+    """Import the modules listed in `path` before the VM reports ready.
+
+    Programs are imported in this same interpreter, so the standard library
+    and runtime modules they share with init1.py are not imported again while
+    the first request waits. The packages of a program, such as pandas or
+    fastapi, are not preloaded: they are only found once its volumes are
+    mounted, and still load when the program is set up.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path) as fd:
+        module_names = [
+            line.strip() for line in fd if line.strip() and not line.startswith("#")
+        ]
+    for module_name in module_names:
+        try:
+            if not is_runtime_module(module_name):
+                logger.warning(f"Not preloading {module_name}, not a runtime module")
+                continue
+            importlib.import_module(module_name)
+            logger.debug(f"Preloaded {module_name}")
+        except Exception as error:
+            logger.warning(f"Could not preload {module_name}: {error}")
+
+
+# Configure aleph-client to use the guest API
+os.environ["ALEPH_API_HOST"] = "http://localhost"
+os.environ["ALEPH_API_UNIX_SOCKET"] = "/tmp/socat-socket"
+os.environ["ALEPH_REMOTE_CRYPTO_HOST"] = "http://localhost"
+os.environ["ALEPH_REMOTE_CRYPTO_UNIX_SOCKET"] = "/tmp/socat-socket"
+
+preload_modules()
+
 # Open a socket to receive instructions from the host
 s = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)
 s.bind((socket.VMADDR_CID_ANY, 52))
@@ -85,12 +201,6 @@ s0 = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)
 s0.connect((2, 52))
 s0.close()
 
-# Configure aleph-client to use the guest API
-os.environ["ALEPH_API_HOST"] = "http://localhost"
-os.environ["ALEPH_API_UNIX_SOCKET"] = "/tmp/socat-socket"
-os.environ["ALEPH_REMOTE_CRYPTO_HOST"] = "http://localhost"
-os.environ["ALEPH_REMOTE_CRYPTO_UNIX_SOCKET"] = "/tmp/socat-socket"
-
 logger.debug("init1.py is launching")
 
 
@@ -181,6 +291,7 @@ def setup_code_asgi(
             logger.debug("Run unzip")
             os.system("unzip -q /opt/archive.zip -d /opt")
         sys.path.append("/opt")
+        setup_module_finder(["/opt"])
         module_name, app_name = entrypoint.split(":", 1)
         logger.debug("import module")
         module = __import__(module_name)
@@ -232,6 +343,8 @@ def setup_code_executable(
 def setup_code(
     code: bytes, encoding: Encoding, entrypoint: str, interface: Interface
 ) -> Union[ASGIApplication, subprocess.Popen]:
+    # Zip archives are extracted by setup_code_asgi, which adds their index
+    setup_module_finder(["/opt/packages", "/opt/code"])
 
     if interface == Interface.asgi:
         return setup_code_asgi(code=code, encoding=encoding, entrypoint=entrypoint)
@@ -253,8 +366,15 @@ async def run_python_code_http(
 
         # The body should not be part of the ASGI scope itself
         body: bytes = scope.pop("body")
+        body_received = False
 
         async def receive():
+            nonlocal body_received
+            if body_received:
+                # The client stays connected until the response is complete,
+                # streaming responses listening for a disconnection are cancelled
+                await asyncio.Future()
+            body_received = True
             type_ = (
                 "http.request"
                 if scope["type"] in ("http", "websocket")
@@ -280,6 +400,12 @@ async def run_python_code_http(
 
         logger.debug("Waiting for body")
         body: Dict = await send_queue.get()
+        # Streaming responses are sent in parts, forwarded together
+        parts = [body.get("body", b"")]
+        while body.get("more_body", False):
+            body = await send_queue.get()
+            parts.append(body.get("body", b""))
+        body = {**body, "body": b"".join(parts), "more_body": False}
 
         logger.debug("Waiting for buffer")
         output = buf.getvalue()
@@ -8,6 +8,7 @@ mount ./rootfs.ext4 /mnt/rootfs
 
 cp ./init0.sh /mnt/rootfs/sbin/init
 cp ./init1.py /mnt/rootfs/root/init1.py
+cp ./preload_modules.txt /mnt/rootfs/root/preload_modules.txt
 chmod +x /mnt/rootfs/sbin/init
 chmod +x /mnt/rootfs/root/init1.py
 